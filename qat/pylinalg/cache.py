@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+"""
+
+import hashlib
+from collections import OrderedDict
+from thrift.TSerialization import serialize
+
+
+class LRUCache:
+    """
+    Least-recently-used cache, bounded in number of entries, or in total
+    weight of the entries (e.g. their size in bytes)
+
+    Args:
+        maxsize (int): maximal number of entries, or maximal total weight
+            if :code:`weigh` is given
+        weigh (callable, optional): function returning the weight of a value
+    """
+
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        """
+        Returns the value stored for a key (and marks it as recently used),
+        or None if the key is not in the cache
+        """
+        if key not in self._data:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def _weight(self, value):
+        return self.weigh(value) if self.weigh is not None else 1
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if needed.
+        A value heavier than the maximal size is not stored.
+        """
+        if key in self._data:
+            self.size -= self._weight(self._data.pop(key))
+        if self._weight(value) > self.maxsize:
+            return
+        self._data[key] = value
+        self.size += self._weight(value)
+        while self.size > self.maxsize:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= self._weight(evicted)
+
+    def clear(self):
+        """
+        Empties the cache and resets its counters
+        """
+        self._data.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def gate_key(gate_name, gate_dic):
+    """
+    Returns a key identifying a gate definition across circuits: gate names
+    are only unique within a circuit, so the key contains the serialized
+    definitions of the gate and of its controlled subgates.
+
+    Args:
+        gate_name (str): name of the gate in the gate dictionary
+        gate_dic (dict): the gate dictionary of the circuit
+
+    Returns:
+        tuple: a hashable key
+    """
+    gate_definition = gate_dic[gate_name]
+    key = [serialize(gate_definition)]
+    while gate_definition.is_ctrl or gate_definition.nbctrls:
+        gate_definition = gate_dic[gate_definition.subgate]
+        key.append(serialize(gate_definition))
+    return tuple(key)
+
+
+def circuit_key(circuit):
+    """
+    Returns a key identifying a circuit, i.e. a hash of its serialized form
+    (which contains its operations and the matrices of its gates): circuits
+    with equal keys have the same final state.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): a circuit
+
+    Returns:
+        bytes: a hashable key
+    """
+    return hashlib.sha256(serialize(circuit)).digest()
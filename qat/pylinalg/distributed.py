@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Distributed simulation: the state vector is partitioned across
+:math:`R = 2^g` ranks, the :math:`g` most significant (global) qubits
+indexing the ranks, each rank holding the :math:`2^{n - g}` amplitudes of
+its part.
+
+Every rank runs the same steps (see
+:func:`~qat.pylinalg.outofcore.plan_swaps`):
+    - gates on local qubits are applied independently by each rank (global
+      controls only select the ranks applying the gate)
+    - before a gate targeting a global qubit, this qubit is swapped with a
+      local one: ranks differing by the global qubit exchange half of their
+      amplitudes, pairwise
+
+Each rank initializes its own part, and the parts are finally gathered on
+the rank 0 (the calling process). Ranks only communicate through
+:class:`SharedMemoryComm`, which runs them as processes of this machine.
+Running ranks on several nodes only requires another implementation of its
+:code:`sendrecv` and :code:`gather` methods (e.g. with MPI).
+"""
+
+import os
+import threading
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+import qat.comm.exceptions.ttypes as exceptions_types
+from .kernels import apply_gate, allocate_scratch
+from .outofcore import plan_swaps, SWAP
+from .simulator import batch_signature
+
+
+class SharedMemoryComm:
+    """
+    Communicator of ranks running as processes of the same machine: each
+    rank has a mailbox in a shared memory block, and exchanges are
+    synchronized by a barrier.
+
+    Args:
+        rank (int): the rank of this process
+        mailboxes (str): the name of the shared memory block containing
+            the mailboxes
+        barrier (:class:`multiprocessing.Barrier`): a barrier shared by all
+            the ranks
+        shape (tuple): the shape of the messages
+        dtype (numpy.dtype): the type of the messages
+    """
+
+    def __init__(self, rank, mailboxes, barrier, shape, dtype):
+        self.rank = rank
+        self.size = barrier.parties
+        self.barrier = barrier
+        self._shm = SharedMemory(name=mailboxes)
+        self._mailboxes = np.ndarray((self.size,) + tuple(shape), dtype=dtype, buffer=self._shm.buf)
+
+    def sendrecv(self, data, partner):
+        """
+        Sends data to a rank and receives the data this rank sends. All the
+        ranks should call this method at the same time.
+
+        Args:
+            data (numpy.ndarray): the data to send
+            partner (int): the rank to exchange data with
+
+        Returns:
+            numpy.ndarray: the received data
+        """
+        self._mailboxes[self.rank] = data
+        self.barrier.wait()
+        received = self._mailboxes[partner].copy()
+        self.barrier.wait()  # the mailbox of the partner can be reused
+        return received
+
+    def gather(self, data, root=0):
+        """
+        Gathers data of all the ranks on a rank, by messages of the size of
+        the mailboxes. All the ranks should call this method at the same
+        time.
+
+        Args:
+            data (numpy.ndarray): the data to send, whose size is a multiple
+                of the size of the messages
+            root (int, optional): the rank receiving the data. Default: 0
+
+        Returns:
+            numpy.ndarray: on the root, the data of all the ranks, of shape
+            (ranks,) + data.shape, None on the other ranks
+        """
+        chunks = data.reshape((-1,) + self._mailboxes.shape[1:])
+        received = np.empty((self.size,) + chunks.shape, dtype=data.dtype) \
+            if self.rank == root else None
+        for index, chunk in enumerate(chunks):
+            self._mailboxes[self.rank] = chunk
+            self.barrier.wait()
+            if received is not None:
+                received[:, index] = self._mailboxes
+            self.barrier.wait()  # the mailboxes can be reused
+        return None if received is None else received.reshape((self.size,) + data.shape)
+
+    def close(self):
+        """
+        Detaches this rank from the shared memory block
+        """
+        del self._mailboxes
+        self._shm.close()
+
+
+def max_ranks(circuit):
+    """
+    Returns the largest number of ranks a circuit can be partitioned
+    across: the local qubits of each rank should be at least as many as
+    the qubits of the widest gate (controls included), so that the global
+    targets of a gate can always be swapped with local qubits
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+
+    Returns:
+        int: the number of ranks, a power of 2
+    """
+    widest = max((len(op.qbits) for op in circuit.ops), default=1)
+    return 1 << max(circuit.nbqbits - max(widest, 1), 0)
+
+
+def simulate_distributed(circuit, nb_ranks, matrix_cache=None, dtype=np.complex128):
+    """
+    Computes the state vector at the output of a circuit composed of gates
+    (see :func:`~qat.pylinalg.simulator.batch_signature`), partitioned
+    across :code:`nb_ranks` processes, and gathers it.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+        nb_ranks (int): the number of ranks, a power of 2
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`~qat.pylinalg.simulator.simulate`
+        dtype (numpy.dtype, optional): see
+            :func:`~qat.pylinalg.simulator.simulate`
+
+    Returns:
+        numpy.ndarray: the state vector, of shape (2, ..., 2)
+    """
+    nb_global = nb_ranks.bit_length() - 1
+    if nb_ranks != 1 << nb_global or nb_global > circuit.nbqbits:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                            modulename="qat.pylinalg",
+                                            message="The number of ranks should be a power of 2, "
+                                                    "at most 2**nbqbits")
+    if batch_signature(circuit) is None:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                            modulename="qat.pylinalg",
+                                            message="Only circuits composed of gates can be "
+                                                    "simulated in a distributed way")
+
+    nb_local = circuit.nbqbits - nb_global
+    steps, position = plan_swaps(circuit, nb_local, matrix_cache=matrix_cache, dtype=dtype)
+
+    dtype = np.dtype(dtype)
+    local_shape = (2,) * nb_local
+    half_shape = (2,) * (nb_local - 1) if nb_local else (1,)
+
+    # ranks share the resource tracker of this process, which owns the
+    # shared memory block of the mailboxes
+    if os.name == "posix":
+        resource_tracker.ensure_running()
+    mailboxes_shm = SharedMemory(create=True, size=nb_ranks * max(1 << nb_local, 2) // 2
+                                 * dtype.itemsize)
+    try:
+        context = multiprocessing.get_context()
+        barrier = context.Barrier(nb_ranks)
+        args = (barrier, mailboxes_shm.name, local_shape, half_shape, dtype.str, steps)
+        processes = [context.Process(target=run_rank, args=(rank,) + args)
+                     for rank in range(1, nb_ranks)]
+        for process in processes:
+            process.start()
+
+        # a rank may die without aborting the barrier (e.g. killed): the
+        # others are then released by a watchdog
+        watchdog = threading.Thread(target=watch_ranks, args=(processes, barrier), daemon=True)
+        watchdog.start()
+
+        # this process is the rank 0, gathering the state
+        parts = None
+        try:
+            parts = run_rank(0, *args)
+        except threading.BrokenBarrierError:
+            pass  # another rank failed
+        finally:
+            for process in processes:
+                process.join()
+            watchdog.join()
+        failed = [rank for rank, process in enumerate(processes, 1) if process.exitcode != 0]
+    finally:
+        mailboxes_shm.close()
+        mailboxes_shm.unlink()
+
+    if parts is None:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ABORT,
+                                            modulename="qat.pylinalg",
+                                            message="Ranks {} of the distributed simulation "
+                                                    "failed".format(failed))
+
+    # qubit q is stored along axis position[q]
+    return parts.reshape((2,) * circuit.nbqbits).transpose(position).copy()
+
+
+def watch_ranks(processes, barrier):
+    """
+    Waits for the processes of the ranks of a distributed simulation, and
+    aborts their barrier as soon as one of them fails, so that the other
+    ranks do not wait for it forever
+
+    Args:
+        processes (list): the processes of the ranks
+            (:class:`multiprocessing.Process`)
+        barrier (:class:`multiprocessing.Barrier`): the barrier shared by
+            the ranks
+    """
+    pending = {process.sentinel: process for process in processes}
+    while pending:
+        for sentinel in wait(list(pending)):
+            process = pending.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                barrier.abort()
+                return
+
+
+def run_rank(rank, barrier, mailboxes_name, local_shape, half_shape, dtype, steps):
+    """
+    Runs the steps of a distributed simulation on the part of the state
+    vector of a rank (see :func:`simulate_distributed`), and gathers the
+    parts of all the ranks on the rank 0
+
+    Args:
+        rank (int): the rank
+        barrier (:class:`multiprocessing.Barrier`): a barrier shared by all
+            the ranks
+        mailboxes_name (str): the name of the shared memory block used by
+            :class:`SharedMemoryComm`
+        local_shape (tuple): the shape of the part of the state vector
+        half_shape (tuple): the shape of the exchanged halves
+        dtype (str): the type of the amplitudes
+        steps (list): the steps of the simulation
+
+    Returns:
+        numpy.ndarray: on the rank 0, the parts of all the ranks, of shape
+        (ranks, 2, ..., 2), None on the other ranks
+    """
+    try:
+        comm = SharedMemoryComm(rank, mailboxes_name, barrier, half_shape, dtype)
+    except BaseException:
+        barrier.abort()
+        raise
+
+    try:
+        nb_global = comm.size.bit_length() - 1
+        local = np.zeros(local_shape, dtype=dtype)
+        if rank == 0:
+            local[(0,) * len(local_shape)] = 1
+        scratch = allocate_scratch(local)
+
+        for step in steps:
+            if step[0] == SWAP:
+                _, global_pos, local_pos = step
+                bit = (rank >> (nb_global - 1 - global_pos)) & 1
+                # the rank with bit 0 sends its amplitudes with local bit 1,
+                # and receives the ones of its partner with local bit 0
+                half = (slice(None),) * (local_pos - nb_global) + (1 - bit,)
+                local[half] = comm.sendrecv(local[half], rank ^ (1 << (nb_global - 1 - global_pos)))
+                continue
+
+            _, global_ctrls, local_qbits, nctrls, matrix, structure = step
+            if all((rank >> (nb_global - 1 - pos)) & 1 for pos in global_ctrls):
+                apply_gate(local, matrix, local_qbits, nctrls, scratch, structure)
+
+        parts = comm.gather(local, root=0)
+        comm.close()
+        return parts
+    except BaseException:
+        barrier.abort()
+        raise
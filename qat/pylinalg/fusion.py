@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Gate fusion pass.
+
+Each gate application is a full pass over the state vector. Merging runs
+of consecutive gates acting on a small set of qubits into a single dense
+matrix replaces several passes by one.
+"""
+
+import numpy as np
+
+from qat.comm.datamodel.ttypes import OpType
+from .kernels import analyze_matrix, window_operator, MAX_WINDOW
+
+
+class FusedGate:
+    """
+    Product of consecutive gates of a circuit
+
+    Args:
+        qbits (list): sorted list of qubits the gates act on
+        matrix (numpy.ndarray): product of the matrices of the gates,
+            expanded on :code:`qbits`
+    """
+
+    def __init__(self, qbits, matrix):
+        self.qbits = qbits
+        self.matrix = matrix
+        self.structure = analyze_matrix(matrix)
+
+
+def fuse_gates(circuit, width, gate_info):
+    """
+    Merges runs of consecutive gates of a circuit acting on at most
+    :code:`width` qubits.
+
+    Fusion stops at every operation which is not a plain gate
+    (measurements, resets, classical operations, breaks and classically
+    controlled gates) and at gates for which :code:`gate_info` returns
+    None. Fused gates are also kept within a window of
+    :attr:`~qat.pylinalg.kernels.MAX_WINDOW` consecutive qubits, so that
+    they are applied by the window kernel.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+        width (int): maximal number of qubits of a fused gate
+        gate_info (callable): function returning the number of controls
+            and the matrix of an operation (see
+            :func:`~qat.pylinalg.simulator.get_gate_info`), or None if the
+            operation can't be fused
+
+    Returns:
+        list: a list of (position, operation) tuples. Operations are either
+        operations of the circuit or :class:`FusedGate` objects, the
+        position is the one of the (first) operation in the circuit
+    """
+    steps = []
+    block = []
+    block_qbits = set()
+
+    for op_pos, op in enumerate(circuit):
+        info = None
+        if op.type == OpType.GATETYPE and len(op.qbits) <= width:
+            info = gate_info(op)
+
+        if info is None:
+            steps.extend(_flush(block, block_qbits))
+            steps.append((op_pos, op))
+            continue
+
+        qbits = block_qbits.union(op.qbits)
+        if len(qbits) > width or max(qbits) - min(qbits) >= MAX_WINDOW:
+            steps.extend(_flush(block, block_qbits))
+            qbits = set(op.qbits)
+
+        block.append((op_pos, op, info[0], info[1]))
+        block_qbits.clear()
+        block_qbits.update(qbits)
+
+    steps.extend(_flush(block, block_qbits))
+    return steps
+
+
+def _flush(block, block_qbits):
+    """
+    Returns the steps corresponding to a block of gates, and empties it.
+    A block composed of a single gate is left untouched.
+    """
+    if not block:
+        return []
+
+    if len(block) == 1:
+        steps = [block[0][:2]]
+    else:
+        qbits = sorted(block_qbits)
+        positions = {qb: pos for pos, qb in enumerate(qbits)}
+        matrix = np.identity(1 << len(qbits), dtype=block[0][3].dtype)
+
+        for _, op, nctrls, gate_matrix in block:
+            operator = window_operator(gate_matrix,
+                                       [positions[qb] for qb in op.qbits[nctrls:]],
+                                       [positions[qb] for qb in op.qbits[:nctrls]],
+                                       len(qbits))
+            matrix = operator @ matrix
+
+        steps = [(block[0][0], FusedGate(qbits, matrix))]
+
+    block.clear()
+    block_qbits.clear()
+    return steps
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+In-place gate application kernels.
+
+The state vector is a C-contiguous :code:`numpy.ndarray` of shape
+(2, ..., 2), qubit 0 being the most significant index. Kernels never
+move axes of the state vector: they build strided views of it, in which
+the qubits touched by a gate are isolated and the other qubits are merged
+into contiguous runs. Results are written into a preallocated scratch
+buffer and copied back, so that no memory is allocated per gate.
+
+Kernels also accept a stack of state vectors, of shape (B, 2, ..., 2),
+the gate being applied on all the states at once. The gate matrix is
+then either shared by all the states, or a stack of B matrices.
+
+Diagonal and monomial (permutation with phases) gates, e.g. Z, S, T,
+RZ, PH, X, CNOT, SWAP or CCNOT, never go through a matrix product: they
+are applied as phase multiplications or swaps of the slices of the state
+vector selected by the values of their targets (see
+:func:`analyze_matrix`). Dense gates use one of the following strategies:
+    - window kernel: the targets of the gate lie in a small window of
+      consecutive qubits. The gate is expanded to a dense operator on the
+      window (identity on spectator qubits, controls inside the window
+      are absorbed) and applied with a single :code:`numpy.matmul`. When
+      few qubits remain after the window, the window is extended up to
+      the last qubit, turning the update into one large GEMM.
+    - controls outside the window are never expanded: the corresponding
+      axes are sliced at 1, so that only :math:`2^{n - c}` amplitudes are
+      processed
+    - generic kernel: targets too far apart to fit in a window are
+      contracted with :code:`numpy.einsum`
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+DENSE = "dense"
+DIAGONAL = "diagonal"
+MONOMIAL = "monomial"
+
+MatrixStructure = namedtuple("MatrixStructure", ["kind", "perm", "phases"])
+MatrixStructure.__doc__ = """
+Sparsity structure of a gate matrix, as returned by :func:`analyze_matrix`
+
+Attributes:
+    kind (str): one of :code:`DENSE`, :code:`DIAGONAL` or :code:`MONOMIAL`
+    perm (numpy.ndarray): for monomial matrices, row of the non-zero
+        coefficient of each column (None otherwise)
+    phases (numpy.ndarray): for diagonal and monomial matrices, the
+        non-zero coefficient of each column (None otherwise)
+"""
+
+# Largest window (in qubits) over which a gate is expanded
+MAX_WINDOW = 6
+# Minimal number of trailing qubits after a window for a batched matmul
+# to be efficient. Below this, the window is extended to the last qubit
+MIN_TAIL = 4
+# Minimal number of amplitudes for a gate to be applied by several threads
+MIN_CHUNKED_SIZE = 1 << 16
+
+
+def allocate_scratch(state_vec):
+    """
+    Allocates the scratch buffer used by :func:`apply_gate`. It can be
+    reused for all the gates applied on the state vector.
+
+    Args:
+        state_vec (numpy.ndarray): the state vector
+
+    Returns:
+        numpy.ndarray: a flat buffer of the same size and dtype
+    """
+    return np.empty(state_vec.size, dtype=state_vec.dtype)
+
+
+class ChunkPool:
+    """
+    Pool of threads applying gates on independent chunks of the state
+    vector (see :func:`apply_gate`). Chunks are obtained by fixing the
+    values of the most significant qubits that are neither touched by the
+    gate nor inside its window: each thread then updates a strided view of
+    the state vector, numpy releasing the GIL on these large operations.
+    The split only depends on the gate and on the number of threads, so
+    results do not depend on the scheduling of the threads.
+
+    Args:
+        nb_threads (int): number of threads (the state vector is split into
+            the smallest power of 2 of chunks not below this number)
+    """
+
+    def __init__(self, nb_threads):
+        self.nb_threads = nb_threads
+        self.nb_split = max(nb_threads - 1, 0).bit_length()
+        self.executor = ThreadPoolExecutor(nb_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stops the threads of the pool
+        """
+        self.executor.shutdown()
+
+    def split_qubits(self, nbqbits, qbits, window=None):
+        """
+        Returns the qubits whose values define the chunks for a gate, or
+        an empty list if there are not enough free qubits
+        """
+        free = [qb for qb in range(nbqbits)
+                if qb not in qbits and (window is None or not window[0] <= qb < window[1])]
+        if len(free) < self.nb_split:
+            return []
+        return free[:self.nb_split]
+
+
+def analyze_matrix(matrix):
+    """
+    Detects whether a gate matrix is diagonal or monomial (exactly one
+    non-zero coefficient per row and per column). This is meant to be done
+    once per gate definition, the result being passed to
+    :func:`apply_gate`.
+
+    For a stack of matrices, the structure is the one shared by all the
+    matrices, phases having then one row per matrix.
+
+    Args:
+        matrix (numpy.ndarray): a square matrix, or a stack of square
+            matrices
+
+    Returns:
+        :class:`MatrixStructure`: the structure of the matrix
+    """
+    nonzero = (matrix != 0).reshape((-1,) + matrix.shape[-2:]).any(axis=0)
+    if np.count_nonzero(nonzero) != nonzero.shape[0] \
+            or not np.all(nonzero.any(axis=0)) or not np.all(nonzero.any(axis=1)):
+        return MatrixStructure(DENSE, None, None)
+
+    perm = np.argmax(nonzero, axis=0)
+    phases = matrix[..., perm, np.arange(matrix.shape[-1])]
+    if np.array_equal(perm, np.arange(matrix.shape[-1])):
+        return MatrixStructure(DIAGONAL, None, phases)
+    return MatrixStructure(MONOMIAL, perm, phases)
+
+
+def apply_gate(state_vec, matrix, qbits, nctrls=0, scratch=None, structure=None,
+               batched=False, pool=None):
+    """
+    Applies a (controlled) gate on a state vector, in place.
+
+    Args:
+        state_vec (numpy.ndarray): C-contiguous state vector of shape
+            (2, ..., 2), or stack of state vectors of shape (B, 2, ..., 2)
+            if :code:`batched` is set. It is updated in place
+        matrix (numpy.ndarray): matrix of the gate, without its controls,
+            of shape (2**k, 2**k). In batched mode, it can also be a stack
+            of matrices of shape (B, 2**k, 2**k), one per state
+        qbits (list): qubits of the gate. The first :code:`nctrls` qubits
+            are the controls, the :code:`k` last ones the targets
+        nctrls (int, optional): number of controls. Default: 0
+        scratch (numpy.ndarray, optional): buffer returned by
+            :func:`allocate_scratch`. Allocated if not provided
+        structure (:class:`MatrixStructure`, optional): structure of the
+            matrix, as returned by :func:`analyze_matrix`. Computed if not
+            provided
+        batched (bool, optional): whether the first axis of the state
+            vector indexes a stack of states. Default: False
+        pool (:class:`ChunkPool`, optional): if provided, large state
+            vectors are split into independent chunks, updated in parallel
+            by the threads of the pool
+
+    Returns:
+        numpy.ndarray: the state vector (same object as the input)
+    """
+    if structure is None:
+        structure = analyze_matrix(matrix)
+
+    nbqbits = state_vec.ndim - batched
+    ctrls = list(qbits[:nctrls])
+    targets = list(qbits[nctrls:])
+    window = _window(nbqbits, targets) if structure.kind == DENSE else None
+
+    if scratch is None and structure.kind != DIAGONAL:
+        scratch = allocate_scratch(state_vec)
+
+    if pool is not None and state_vec.size >= MIN_CHUNKED_SIZE:
+        split = pool.split_qubits(nbqbits, qbits, window)
+        if split:
+            chunk_size = state_vec.size >> len(split)
+            futures = []
+            for chunk in range(1 << len(split)):
+                fixed = {qb: chunk >> (len(split) - 1 - pos) & 1 for pos, qb in enumerate(split)}
+                chunk_scratch = scratch[chunk * chunk_size:(chunk + 1) * chunk_size] \
+                    if scratch is not None else None
+                futures.append(pool.executor.submit(_apply, state_vec, matrix, ctrls, targets,
+                                                    chunk_scratch, structure, window, batched, fixed))
+            for future in futures:
+                future.result()
+            return state_vec
+
+    return _apply(state_vec, matrix, ctrls, targets, scratch, structure, window, batched)
+
+
+def _window(nbqbits, targets):
+    """
+    Returns the window (start, stop) of consecutive qubits over which a
+    dense gate is expanded, or None if its targets are too far apart
+    """
+    start, stop = min(targets), max(targets) + 1
+    if stop - start > MAX_WINDOW:
+        return None
+
+    if nbqbits - stop < MIN_TAIL and nbqbits - start <= MAX_WINDOW:
+        stop = nbqbits
+    return start, stop
+
+
+def _apply(state_vec, matrix, ctrls, targets, scratch, structure, window, batched=False,
+           fixed=None):
+    """
+    Applies a gate on the part of the state vector where the qubits of
+    :code:`fixed` (a dictionary qubit -> value, not touched by the gate nor
+    inside its window) have the given values.
+    """
+    fixed = dict(fixed or {})
+
+    if structure.kind == DIAGONAL:
+        fixed.update({qb: 1 for qb in ctrls})
+        slices = _target_slices(state_vec, fixed, targets, batched)
+        for value, slc in enumerate(slices):
+            phase = structure.phases[..., value]
+            if np.any(phase != 1):
+                np.multiply(slc, _broadcast(phase, slc), out=slc)
+        return state_vec
+
+    if structure.kind == MONOMIAL:
+        fixed.update({qb: 1 for qb in ctrls})
+        return _apply_monomial(state_vec, structure, fixed, targets, scratch, batched)
+
+    if window is None:
+        fixed.update({qb: 1 for qb in ctrls})
+        return _apply_generic(state_vec, matrix, fixed, targets, scratch, batched)
+
+    # Controls inside the window are absorbed, the other ones are sliced
+    start, stop = window
+    inner_ctrls = [qb for qb in ctrls if start <= qb < stop]
+    fixed.update({qb: 1 for qb in ctrls if not start <= qb < stop})
+    outer = list(fixed)
+    operator = window_operator(matrix, [qb - start for qb in targets],
+                               [qb - start for qb in inner_ctrls], stop - start)
+
+    view, dims = _grouped_view(state_vec, outer, (start, stop), batched)
+    index = [slice(None)] * view.ndim
+    for qb in outer:
+        index[dims[qb]] = fixed[qb]
+    sub = view[tuple(index)]
+    wdim = dims[start] - sum(1 for qb in outer if dims[qb] < dims[start])
+
+    tmp = scratch[:sub.size].reshape(sub.shape)
+    if wdim == sub.ndim - 1:
+        # Window at the end: sub is a stack of row vectors
+        if batched:
+            sub, tmp = sub[..., np.newaxis, :], tmp[..., np.newaxis, :]
+        np.matmul(sub, _broadcast(np.swapaxes(operator, -1, -2), sub, 2),
+                  out=tmp)
+    else:
+        moved = np.moveaxis(sub, wdim, -2)
+        np.matmul(_broadcast(operator, moved, 2), moved,
+                  out=np.moveaxis(tmp, wdim, -2))
+    np.copyto(sub, tmp)
+    return state_vec
+
+
+def window_operator(matrix, targets, ctrls, width):
+    """
+    Expands a gate matrix to a dense operator acting on a window of
+    consecutive qubits.
+
+    Args:
+        matrix (numpy.ndarray): matrix of the gate, of shape (2**k, 2**k),
+            or stack of matrices of shape (B, 2**k, 2**k)
+        targets (list): positions of the targets inside the window, in the
+            order of the matrix indices
+        ctrls (list): positions of the controls inside the window
+        width (int): number of qubits of the window
+
+    Returns:
+        numpy.ndarray: an operator of shape (2**width, 2**width), or a
+        stack of operators of shape (B, 2**width, 2**width)
+    """
+    if not ctrls and targets == list(range(width)):
+        return matrix
+
+    nb_targets = len(targets)
+    basis = np.arange(1 << width)
+    target_mask = sum(1 << (width - 1 - pos) for pos in targets)
+    ctrl_mask = sum(1 << (width - 1 - pos) for pos in ctrls)
+
+    # Value of the targets for each basis state of the window
+    target_vals = np.zeros(1 << width, dtype=np.int64)
+    for pos in targets:
+        target_vals = (target_vals << 1) | ((basis >> (width - 1 - pos)) & 1)
+
+    operator = np.zeros(matrix.shape[:-2] + (1 << width, 1 << width), dtype=matrix.dtype)
+    active = (basis & ctrl_mask) == ctrl_mask
+    operator[..., basis[~active], basis[~active]] = 1
+
+    cols = basis[active]
+    cleared = cols & ~target_mask
+    for out_val in range(1 << nb_targets):
+        rows = cleared.copy()
+        for k, pos in enumerate(targets):
+            if out_val >> (nb_targets - 1 - k) & 1:
+                rows |= 1 << (width - 1 - pos)
+        operator[..., rows, cols] = matrix[..., out_val, target_vals[active]]
+
+    return operator
+
+
+def _grouped_view(state_vec, qbits, window=None, batched=False):
+    """
+    Returns a view of the state vector in which each qubit of
+    :code:`qbits` has its own axis, the (optional) window of consecutive
+    qubits is merged into one axis, and the other qubits are merged into
+    contiguous runs. In batched mode, the first axis is kept.
+
+    Returns:
+        (numpy.ndarray, dict): the view and a dictionary mapping each
+        qubit of :code:`qbits` (and the first qubit of the window) to its
+        axis in the view
+    """
+    nbqbits = state_vec.ndim - batched
+    blocks = [(qb, qb + 1) for qb in qbits]
+    if window is not None:
+        blocks.append(window)
+
+    shape = [state_vec.shape[0]] if batched else []
+    dims = {}
+    prev = 0
+    for low, high in sorted(blocks):
+        if low > prev:
+            shape.append(1 << (low - prev))
+        dims[low] = len(shape)
+        shape.append(1 << (high - low))
+        prev = high
+    if prev < nbqbits:
+        shape.append(1 << (nbqbits - prev))
+
+    return state_vec.reshape(shape), dims
+
+
+def _broadcast(values, array, core_ndim=0):
+    """
+    Reshapes per-state values (phases or operators) so that they broadcast
+    against a view of a stack of states. Values shared by all the states
+    are returned untouched.
+
+    Args:
+        values (numpy.ndarray): values, with a leading batch axis if they
+            are per-state
+        array (numpy.ndarray): view of the states
+        core_ndim (int): number of trailing axes of :code:`values` not
+            indexed by the batch (2 for operators, 0 for phases)
+    """
+    if values.ndim == core_ndim:
+        return values
+    padding = (1,) * (array.ndim - 1 - core_ndim)
+    return values.reshape(values.shape[:1] + padding + values.shape[1:])
+
+
+def _target_slices(state_vec, fixed, targets, batched=False):
+    """
+    Returns the views of the state vector where the qubits of :code:`fixed`
+    (e.g. controls, set to 1) have the given values, for each value of the
+    targets (in the order of the matrix indices).
+    """
+    view, dims = _grouped_view(state_vec, list(fixed) + targets, batched=batched)
+    index = [slice(None)] * view.ndim
+    for qb, value in fixed.items():
+        index[dims[qb]] = value
+
+    slices = []
+    for value in range(1 << len(targets)):
+        for pos, qb in enumerate(targets):
+            index[dims[qb]] = value >> (len(targets) - 1 - pos) & 1
+        # Ellipsis ensures a (0-d) view is returned, never a scalar
+        slices.append(view[tuple(index) + (Ellipsis,)])
+    return slices
+
+
+def _apply_monomial(state_vec, structure, fixed, targets, scratch, batched=False):
+    """
+    Applies a monomial gate by moving slices of the state vector along the
+    cycles of its permutation, multiplying them by their phase.
+    """
+    slices = _target_slices(state_vec, fixed, targets, batched)
+    perm = structure.perm
+    phases = [_broadcast(structure.phases[..., col], slices[0])
+              for col in range(len(perm))]
+    tmp = scratch[:slices[0].size].reshape(slices[0].shape)
+
+    visited = [False] * len(perm)
+    for first in range(len(perm)):
+        if visited[first]:
+            continue
+        visited[first] = True
+        if perm[first] == first:
+            if np.any(phases[first] != 1):
+                np.multiply(slices[first], phases[first], out=slices[first])
+            continue
+
+        # Cycle first -> perm[first] -> ... -> first
+        cycle = [first]
+        while perm[cycle[-1]] != first:
+            cycle.append(perm[cycle[-1]])
+            visited[cycle[-1]] = True
+
+        # Column cycle[m] is sent to cycle[m + 1]: walking the cycle
+        # backwards, the last slice being saved first
+        last = cycle[-1]
+        np.copyto(tmp, slices[last])
+        for pos in range(len(cycle) - 1, 0, -1):
+            src, dst = cycle[pos - 1], cycle[pos]
+            _scaled_copy(slices[dst], slices[src], phases[src])
+        _scaled_copy(slices[first], tmp, phases[last])
+
+    return state_vec
+
+
+def _scaled_copy(dst, src, phase):
+    """
+    Writes :code:`phase * src` into :code:`dst`
+    """
+    if np.all(phase == 1):
+        np.copyto(dst, src)
+    else:
+        np.multiply(src, phase, out=dst)
+
+
+def _apply_generic(state_vec, matrix, fixed, targets, scratch, batched=False):
+    """
+    Applies a gate whose targets are too far apart to fit in a window,
+    using :code:`numpy.einsum` on a strided view of the state vector.
+    """
+    view, dims = _grouped_view(state_vec, list(fixed) + targets, batched=batched)
+    fixed_dims = {dims[qb]: value for qb, value in fixed.items()}
+    sub = view[tuple(fixed_dims.get(ax, slice(None)) for ax in range(view.ndim))]
+
+    # Einsum subscripts: remaining axes of the view, then output targets
+    kept = [ax for ax in range(view.ndim) if ax not in fixed_dims]
+    letters = {ax: chr(ord('a') + pos) for pos, ax in enumerate(kept)}
+    out_letters = dict(letters)
+    gate_in, gate_out = "", ""
+    for pos, qb in enumerate(targets):
+        new_letter = chr(ord('A') + pos)
+        gate_in += letters[dims[qb]]
+        gate_out += new_letter
+        out_letters[dims[qb]] = new_letter
+
+    gate_batch = letters[0] if matrix.ndim == 3 else ""
+    subscripts = "{},{}->{}".format(gate_batch + gate_out + gate_in,
+                                    "".join(letters[ax] for ax in kept),
+                                    "".join(out_letters[ax] for ax in kept))
+    tensor = matrix.reshape(matrix.shape[:-2] + (2,) * (2 * len(targets)))
+
+    tmp = scratch[:sub.size].reshape(sub.shape)
+    np.einsum(subscripts, tensor, sub, out=tmp)
+    np.copyto(sub, tmp)
+    return state_vec
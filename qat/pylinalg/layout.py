@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Qubit layout pass.
+
+Dense gates whose targets are more than
+:attr:`~qat.pylinalg.kernels.MAX_WINDOW` qubits apart can't use the window
+kernel, and are applied with :code:`numpy.einsum` on a strided view of the
+state vector, several times slower than a transposition of the state
+vector. The axes of the state vector are thus permuted before such gates,
+so that their targets (and the ones of the following dense gates) become
+the last axes: the layout of the state vector, i.e. the axis of each
+(logical) qubit, is tracked along the circuit, and the logical layout is
+only restored before operations reading it (measurements, resets, state
+preparations) and at the end of the circuit.
+"""
+
+import numpy as np
+
+from .kernels import MAX_WINDOW
+
+
+def plan_layouts(nbqbits, steps, dense_targets):
+    """
+    Computes the layouts of the state vector along a list of steps.
+
+    Args:
+        nbqbits (int): the number of qubits
+        steps (list): the steps of the simulation, as (position, operation)
+            tuples (see :func:`~qat.pylinalg.fusion.fuse_gates`)
+        dense_targets (callable): function returning the targets of an
+            operation if it is a dense gate, an empty list if it is
+            applied without constraint on its qubits (other gates,
+            classical operations), or None if it requires the logical
+            layout
+
+    Returns:
+        dict: the layouts to switch to before some steps, indexed by step
+        (the index :code:`len(steps)` corresponding to the end of the
+        circuit). A layout is the list of the axes of the qubits.
+    """
+    identity = list(range(nbqbits))
+    layout = identity
+    layouts = {}
+    targets = [dense_targets(op) for _, op in steps]
+
+    for step, step_targets in enumerate(targets):
+        if step_targets is None:
+            if layout != identity:
+                layout = layouts[step] = identity
+            continue
+
+        axes = [layout[qb] for qb in step_targets]
+        if not axes or max(axes) - min(axes) < MAX_WINDOW or len(axes) > MAX_WINDOW:
+            continue
+
+        # targets of the next dense gates are gathered as long as they fit in a window
+        group = set(step_targets)
+        for next_targets in targets[step + 1:]:
+            if next_targets is None or len(group.union(next_targets)) > MAX_WINDOW:
+                break
+            group.update(next_targets)
+
+        layout = layouts[step] = _moved_to_end(layout, group)
+
+    if layout != identity:
+        layouts[len(steps)] = identity
+    return layouts
+
+
+def _moved_to_end(layout, qbits):
+    """
+    Returns a layout in which some qubits are moved to the last axes, the
+    relative order of the axes being otherwise kept
+    """
+    order = sorted(range(len(layout)), key=lambda qb: (qb in qbits, layout[qb]))
+    new_layout = [0] * len(layout)
+    for axis, qb in enumerate(order):
+        new_layout[qb] = axis
+    return new_layout
+
+
+def permute_state(state_vec, layout, new_layout, out):
+    """
+    Changes the layout of a state vector.
+
+    Args:
+        state_vec (numpy.ndarray): the state vector, of shape (2, ..., 2)
+        layout (list): the axis of each qubit in :code:`state_vec`
+        new_layout (list): the axis of each qubit in the result
+        out (numpy.ndarray): a buffer of the same size and dtype as the
+            state vector
+
+    Returns:
+        numpy.ndarray: the permuted state vector, stored in :code:`out`
+    """
+    axes = [0] * len(layout)
+    for qb, axis in enumerate(new_layout):
+        axes[axis] = layout[qb]
+    result = out.reshape(state_vec.shape)
+    np.copyto(result, state_vec.transpose(axes))
+    return result
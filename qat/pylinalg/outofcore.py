@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Out-of-core simulation: the state vector is stored in a file, mapped in
+memory with :code:`numpy.memmap`, and processed by blocks.
+
+The :math:`n` qubits are split into :math:`g` global qubits (the most
+significant ones), indexing :math:`2^g` blocks, and :math:`k = n - g` local
+qubits, indexing the :math:`2^k` amplitudes of a block. Blocks are
+contiguous in the file, and only one or two of them are held in memory at
+a time:
+    - consecutive gates acting on local qubits are applied block by block,
+      in a single pass over the file
+    - controls on global qubits only select the blocks to update
+    - before a gate targeting a global qubit, this qubit is swapped with a
+      local one (the one whose next use is the farthest), exchanging halves
+      of pairs of blocks. Qubits are not swapped back: the position of each
+      qubit is tracked until the end of the simulation
+"""
+
+import bisect
+import numpy as np
+
+import qat.comm.exceptions.ttypes as exceptions_types
+from .kernels import apply_gate, allocate_scratch
+from .simulator import batch_signature, get_gate_info, marginal_probabilities
+
+# Steps of a simulation (see plan_swaps)
+SWAP = 0
+GATE = 1
+
+
+def simulate_out_of_core(circuit, filename, block_qubits, matrix_cache=None, dtype=np.complex128):
+    """
+    Computes the state vector at the output of a circuit composed of gates
+    (see :func:`~qat.pylinalg.simulator.batch_signature`), storing it in a
+    file.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+        filename (str): path of the file storing the state vector (created
+            or overwritten)
+        block_qubits (int): number :math:`k` of local qubits, i.e. blocks
+            contain :math:`2^k` amplitudes
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`~qat.pylinalg.simulator.simulate`
+        dtype (numpy.dtype, optional): see
+            :func:`~qat.pylinalg.simulator.simulate`
+
+    Returns:
+        (numpy.memmap, list): the state vector, of shape
+        (:math:`2^g`, :math:`2^k`), and the position of each qubit of the
+        circuit in this state vector (position :math:`p < g` being bit
+        :math:`g - 1 - p` of the block index, position :math:`p \\geq g`
+        being axis :math:`p - g` of a block of shape (2, ..., 2))
+    """
+    if batch_signature(circuit) is None:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                            modulename="qat.pylinalg",
+                                            message="Only circuits composed of gates can be "
+                                                    "simulated out of core")
+
+    nb_local = min(block_qubits, circuit.nbqbits)
+    nb_global = circuit.nbqbits - nb_local
+    steps, position = plan_swaps(circuit, nb_local, matrix_cache=matrix_cache, dtype=dtype)
+
+    state = np.memmap(filename, dtype=dtype, mode="w+", shape=(1 << nb_global, 1 << nb_local))
+    state[0, 0] = 1
+
+    # Buffers shared by all the passes
+    block = np.empty((2,) * nb_local, dtype=dtype)
+    scratch = allocate_scratch(block)
+    pending = []  # local gates, applied at the next pass
+    for step in steps:
+        if step[0] == SWAP:
+            _flush(state, pending, nb_global, block, scratch)
+            pending = []
+            _swap(state, step[1], step[2], nb_global, block)
+        else:
+            pending.append(step[1:])
+
+    _flush(state, pending, nb_global, block, scratch)
+    state.flush()
+    return state, position
+
+
+def plan_swaps(circuit, nb_local, matrix_cache=None, dtype=np.complex128):
+    """
+    Splits the qubits of a circuit composed of gates into global and local
+    qubits, and lists the steps of its simulation, such that gates only
+    target local qubits:
+        - :code:`(SWAP, global_pos, local_pos)` exchanges the qubits at two
+          positions
+        - :code:`(GATE, global_ctrls, local_qbits, nctrls, matrix,
+          structure)` applies a gate on the local positions
+          :code:`local_qbits` (relative to the first local position, the
+          first :code:`nctrls` ones being controls) of the parts of the
+          state vector whose global positions :code:`global_ctrls` are
+          set to 1
+
+    A global target is swapped with the local qubit whose next use is the
+    farthest.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+        nb_local (int): the number of local qubits
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`~qat.pylinalg.simulator.simulate`
+        dtype (numpy.dtype, optional): see
+            :func:`~qat.pylinalg.simulator.simulate`
+
+    Returns:
+        (list, list): the steps, and the final position of each qubit
+    """
+    nbqbits = circuit.nbqbits
+    nb_global = nbqbits - nb_local
+
+    position = list(range(nbqbits))       # qubit -> position
+    qubit_at = list(range(nbqbits))       # position -> qubit
+
+    # Uses of each qubit, to choose the qubits swapped out of the local ones
+    uses = [[] for _ in range(nbqbits)]
+    for op_pos, op in enumerate(circuit.ops):
+        for qb in op.qbits:
+            uses[qb].append(op_pos)
+
+    def next_use(qb, op_pos):
+        index = bisect.bisect_left(uses[qb], op_pos)
+        return uses[qb][index] if index < len(uses[qb]) else len(circuit.ops)
+
+    gate_cache = {}
+    steps = []
+    for op_pos, op in enumerate(circuit.ops):
+        nctrls, matrix, structure = get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype)
+        targets = op.qbits[nctrls:]
+
+        # bringing the global targets in the local qubits
+        for target in targets:
+            if position[target] >= nb_global:
+                continue
+            candidates = [qubit_at[pos] for pos in range(nb_global, nbqbits)
+                          if qubit_at[pos] not in op.qbits]
+            if not candidates:
+                raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                                    modulename="qat.pylinalg",
+                                                    message="{} local qubits are too few for "
+                                                            "gates on {} qubits"
+                                                    .format(nb_local, len(op.qbits)))
+            local = max(candidates, key=lambda qb: next_use(qb, op_pos))
+
+            steps.append((SWAP, position[target], position[local]))
+            position[target], position[local] = position[local], position[target]
+            qubit_at[position[target]], qubit_at[position[local]] = target, local
+
+        # global controls select the parts of the state vector
+        global_ctrls = [position[qb] for qb in op.qbits[:nctrls] if position[qb] < nb_global]
+        local_qbits = [position[qb] - nb_global for qb in op.qbits if position[qb] >= nb_global]
+        steps.append((GATE, global_ctrls, local_qbits, nctrls - len(global_ctrls),
+                      matrix, structure))
+
+    return steps, position
+
+
+def _flush(state, gates, nb_global, block, scratch):
+    """
+    Applies local gates on all the blocks of the state vector, in one pass,
+    each block being copied in the buffer :code:`block`
+    """
+    if not gates:
+        return
+
+    flat_block = block.reshape(-1)
+    for index in range(state.shape[0]):
+        block_gates = [gate for gate in gates
+                       if all(index >> (nb_global - 1 - pos) & 1 for pos in gate[0])]
+        if not block_gates:
+            continue
+
+        np.copyto(flat_block, state[index])
+        for _, qbits, nctrls, matrix, structure in block_gates:
+            apply_gate(block, matrix, qbits, nctrls, scratch, structure)
+        np.copyto(state[index], flat_block)
+
+
+def _swap(state, global_pos, local_pos, nb_global, block):
+    """
+    Swaps a global qubit and a local qubit, by exchanging halves of the
+    pairs of blocks differing by the global qubit, through views of the
+    blocks (half of the buffer :code:`block` holding the exchanged half)
+    """
+    shape = block.shape
+    half = block[0]
+    axis = local_pos - nb_global
+    bit = 1 << (nb_global - 1 - global_pos)
+    one = tuple([slice(None)] * axis + [1])
+    zero = tuple([slice(None)] * axis + [0])
+
+    for index in range(state.shape[0]):
+        if index & bit:
+            continue
+        low = state[index].reshape(shape)
+        high = state[index | bit].reshape(shape)
+        np.copyto(half, low[one])
+        np.copyto(low[one], high[zero])
+        np.copyto(high[zero], half)
+
+
+def sample_counts_out_of_core(state, position, qubits, nb_samples):
+    """
+    Samples measurement results on some qubits of a state vector computed by
+    :func:`simulate_out_of_core`. The number of samples in each block is
+    first drawn from the probabilities of the blocks, then the samples of
+    each block are drawn from its own distribution, so that the distribution
+    of the whole state vector is never built.
+
+    Args:
+        state (numpy.memmap): the state vector
+        position (list): the position of each qubit
+        qubits (list): the measured qubits
+        nb_samples (int): the number of samples
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): the distinct results (as integers,
+        in increasing order) and their number of occurrences
+    """
+    nb_global = state.shape[0].bit_length() - 1
+    shape = (2,) * (state.shape[1].bit_length() - 1)
+    nb_meas = len(qubits)
+
+    block_probs = np.array([np.vdot(state[index], state[index]).real
+                            for index in range(state.shape[0])])
+    block_counts = np.random.multinomial(nb_samples, block_probs / block_probs.sum())
+
+    # measured qubits inside the blocks: (bit in the result, axis in a block)
+    local = [(nb_meas - 1 - k, position[qb] - nb_global) for k, qb in enumerate(qubits)
+             if position[qb] >= nb_global]
+
+    counts = {}
+    for index in np.flatnonzero(block_counts):
+        result = 0
+        for k, qb in enumerate(qubits):
+            if position[qb] < nb_global:
+                result |= (index >> (nb_global - 1 - position[qb]) & 1) << (nb_meas - 1 - k)
+
+        if not local:
+            counts[result] = counts.get(result, 0) + int(block_counts[index])
+            continue
+
+        probs = marginal_probabilities(np.array(state[index]).reshape(shape),
+                                       [axis for _, axis in local]).astype(np.float64)
+        local_counts = np.random.multinomial(block_counts[index], probs / probs.sum())
+        for local_int in np.flatnonzero(local_counts):
+            res_int = result
+            for k, (bit, _) in enumerate(local):
+                res_int |= (int(local_int) >> (len(local) - 1 - k) & 1) << bit
+            counts[res_int] = counts.get(res_int, 0) + int(local_counts[local_int])
+
+    res_ints = np.array(sorted(counts), dtype=np.int64)
+    return res_ints, np.array([counts[res_int] for res_int in res_ints], dtype=np.int64)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+"""
+
+import numpy as np
+
+
+class PauliString:
+    """
+    Pauli product stored as bit masks over the basis states: the product
+    acts on a basis state :math:`|j\\rangle` (qubit 0 being the most
+    significant bit of :math:`j`) as
+
+    .. math::
+
+        P|j\\rangle = \\phi (-1)^{|j \\wedge z|} |j \\oplus x\\rangle
+
+    Args:
+        x_mask (int): qubits flipped by the product (acted upon by X or Y)
+        z_mask (int): qubits giving a sign (acted upon by Y or Z)
+        nbqbits (int): number of qubits
+        phase (complex, optional): the phase :math:`\\phi`. Default: 1
+    """
+
+    def __init__(self, x_mask, z_mask, nbqbits, phase=1):
+        self.x_mask = x_mask
+        self.z_mask = z_mask
+        self.nbqbits = nbqbits
+        self.phase = phase
+
+    def __repr__(self):
+        return "PauliString(x_mask={}, z_mask={}, nbqbits={}, phase={})"\
+            .format(self.x_mask, self.z_mask, self.nbqbits, self.phase)
+
+    @classmethod
+    def from_ops(cls, ops, qbits, nbqbits):
+        """
+        Builds the Pauli string of a product of Pauli operators
+
+        Args:
+            ops (str): the Pauli operators ("X", "Y" or "Z")
+            qbits (list): the (distinct) qubits the operators act upon
+            nbqbits (int): number of qubits
+
+        Returns:
+            :class:`PauliString`
+        """
+        x_mask, z_mask = 0, 0
+        for op, qb in zip(ops, qbits):
+            bit = 1 << (nbqbits - qb - 1)
+            if op in "XY":
+                x_mask |= bit
+            if op in "YZ":
+                z_mask |= bit
+        # Y|b> = i (-1)^b |b ^ 1>
+        return cls(x_mask, z_mask, nbqbits, 1j**ops.count("Y"))
+
+    @classmethod
+    def from_term(cls, term, nbqbits):
+        """
+        Builds the Pauli string of a term of an observable (its coefficient
+        is not included)
+
+        Args:
+            term (:class:`~qat.core.Term`): the term
+            nbqbits (int): number of qubits
+
+        Returns:
+            :class:`PauliString`
+        """
+        return cls.from_ops(term.op, term.qbits, nbqbits)
+
+
+def mask_qubits(mask, nbqbits):
+    """
+    Returns the qubits of a mask, in increasing order
+    """
+    return tuple(qb for qb in range(nbqbits) if mask >> (nbqbits - qb - 1) & 1)
+
+
+def xor_products(state_vec, x_mask):
+    """
+    Computes the products :math:`\\overline{\\psi_{j \\oplus x}} \\psi_j` of
+    the amplitudes of a state vector. Flipping the bits of :math:`x` in the
+    indices amounts to reversing the corresponding axes of the state vector,
+    so no index array is built.
+
+    Args:
+        state_vec (numpy.ndarray): the state vector, of shape (2,...,2)
+        x_mask (int): the mask :math:`x`
+
+    Returns:
+        numpy.ndarray: the products, with the shape of the state vector
+        (real when :math:`x = 0`)
+    """
+    flips = mask_qubits(x_mask, state_vec.ndim)
+    if not flips:
+        return np.abs(state_vec)**2
+    return np.flip(state_vec, axis=flips).conj() * state_vec
+
+
+def parity_sums(weights, z_masks):
+    """
+    Computes, for several masks :math:`z`, the signed sums
+    :math:`\\sum_j w_j (-1)^{|j \\wedge z|}`.
+
+    Each sum is obtained by reducing the weights qubit after qubit, which
+    costs about one pass over the weights, instead of building a vector of
+    signs. When there are more masks than qubits, all the sums are computed
+    at once with a Walsh-Hadamard transform of the weights, which costs one
+    pass per qubit.
+
+    Args:
+        weights (numpy.ndarray): the weights, of shape (2,...,2). This
+            array may be overwritten
+        z_masks (list): the masks, as integers
+
+    Returns:
+        list: the signed sums
+    """
+    nbqbits = weights.ndim
+
+    if len(z_masks) > nbqbits:
+        # Walsh-Hadamard transform, in place: (a, b) -> (a + b, a - b)
+        for qb in range(nbqbits):
+            # Ellipsis ensures a (0-d) view is returned, never a scalar
+            lower = weights[(slice(None),) * qb + (0, Ellipsis)]
+            upper = weights[(slice(None),) * qb + (1, Ellipsis)]
+            lower += upper
+            upper *= -2
+            upper += lower
+        flat_weights = weights.reshape(-1)
+        return [flat_weights[z_mask] for z_mask in z_masks]
+
+    values = []
+    for z_mask in z_masks:
+        # tracing out the other qubits, then reducing the sign qubits
+        signs = mask_qubits(z_mask, nbqbits)
+        reduced = weights.sum(axis=tuple(qb for qb in range(nbqbits) if qb not in signs))
+        for _ in signs:
+            reduced = reduced[0] - reduced[1]
+        values.append(reduced.sum())
+    return values
+
+
+def pauli_expectation(state_vec, pauli):
+    """
+    Computes the expectation value :math:`\\langle\\psi|P|\\psi\\rangle` of a
+    Pauli string, as
+    :math:`\\phi \\sum_j \\overline{\\psi_{j \\oplus x}} (-1)^{|j \\wedge z|} \\psi_j`
+
+    Args:
+        state_vec (numpy.ndarray): the state vector, of shape (2,...,2)
+        pauli (:class:`PauliString`): the Pauli string
+
+    Returns:
+        complex: the expectation value
+    """
+    weights = xor_products(state_vec, pauli.x_mask)
+    return pauli.phase * parity_sums(weights, [pauli.z_mask])[0]
+
+
+def pauli_expectations(state_vec, paulis):
+    """
+    Computes the expectation values of several Pauli strings. Strings are
+    grouped by flip mask :math:`x`: the products
+    :math:`\\overline{\\psi_{j \\oplus x}} \\psi_j` are computed once per group
+    (see :func:`xor_products`), and the values of the group are signed sums
+    of these products (see :func:`parity_sums`).
+
+    Args:
+        state_vec (numpy.ndarray): the state vector, of shape (2,...,2)
+        paulis (list): the :class:`PauliString` objects
+
+    Returns:
+        list: the expectation values, in the order of the strings
+    """
+    groups = {}  # x_mask -> indices of the strings
+    for index, pauli in enumerate(paulis):
+        groups.setdefault(pauli.x_mask, []).append(index)
+
+    values = [None] * len(paulis)
+    for x_mask, indices in groups.items():
+        weights = xor_products(state_vec, x_mask)
+        sums = parity_sums(weights, [paulis[index].z_mask for index in indices])
+        for index, value in zip(indices, sums):
+            values[index] = paulis[index].phase * value
+    return values
@@ -19,17 +19,40 @@
     under the License.
 """
 
+import os
 import inspect
+import pickle
+import tempfile
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 
 from qat.comm.shared.ttypes import ProcessingType
 from qat.comm.hardware.ttypes import HardwareSpecs
 from qat.comm.exceptions.ttypes import ErrorType, QPUException
 from qat.comm.datamodel.ttypes import ComplexNumber, OpType
 from qat.core.qpu import QPUHandler
-from qat.core.wrappers.result import Sample, Result, aggregate_data
+from qat.core.wrappers.result import Sample, Result, BatchResult
+from qat.core.wrappers.batch import Batch
 from qat.core.wrappers import Circuit as WCircuit
-from .simulator import simulate, measure, compute_observable_average
+from .simulator import simulate, simulate_branches, simulate_batch, simulate_shared_prefixes, batch_signature, \
+    shared_prefix_order, measure, sample_counts, marginal_probabilities, compute_observable_average, \
+    compute_observable_averages
+from .outofcore import simulate_out_of_core, sample_counts_out_of_core
+from .distributed import simulate_distributed, max_ranks
+from .cache import LRUCache, gate_key, circuit_key
+
+# Dtype of the state vector for each precision
+PRECISIONS = {"double": np.complex128, "single": np.complex64}
+
+# Arrays of at most this number of bytes are sent back inline by the worker
+# processes, larger ones through shared memory (see execute_jobs)
+INLINE_BYTES = 1 << 16
+
+# Shared memory blocks of a worker process which are kept open until it exits
+# (on Windows, a block is destroyed when its last handle is closed)
+_OPEN_BLOCKS = []
 
 
 class PyLinalg(QPUHandler):
@@ -39,11 +62,535 @@ class PyLinalg(QPUHandler):
     Inherits :func:`serve` and :func:`submit` method from :class:`qat.qpus.QPUHandler`
     Only the :func:`submit_job` method is simulator-specific and defined here.
 
+    Args:
+        fusion_width (int, optional): if larger than 1, runs of consecutive
+            gates acting on at most :code:`fusion_width` qubits are merged
+            into a single gate before simulation. Default: 0 (no fusion)
+        matrix_cache_size (int, optional): if positive, converted gate
+            matrices are kept in a LRU cache of this size, shared by all
+            the jobs submitted to this QPU. Default: 0 (matrices are only
+            cached within a circuit)
+        batch_size (int, optional): if larger than 1, the jobs of a submitted
+            batch whose circuits only differ by the values of their gate
+            matrices (e.g. a parameter sweep) are simulated together, by
+            groups of at most :code:`batch_size` circuits, as a stack of
+            state vectors. Each group is simulated when its first job is
+            executed, and its jobs are executed right after, so that the
+            states of a single group are kept in memory at once. Default: 0
+            (circuits are simulated one by one)
+        precision (str, optional): "double" (default) to simulate with
+            complex128 numbers, or "single" to use complex64 numbers. Single
+            precision halves the memory footprint, at the cost of errors of
+            the order of 1e-7 on amplitudes, probabilities and observable
+            averages
+        compact_output (bool, optional): if True, jobs with
+            :code:`nbshots = 0` do not return one sample per basis state:
+            the non-zero results are instead stored as numpy arrays in the
+            :code:`distribution` attribute of the result, a dictionary with
+            keys "states" (integers), "probabilities" and, if all the qubits
+            are measured, "amplitudes". This attribute is not serialized, so
+            this mode is only relevant when the QPU is used locally.
+            Default: False
+        state_cache_bytes (int, optional): if positive, the final states of
+            the simulated circuits (without intermediate measurements) are
+            kept in a LRU cache using at most this number of bytes, so that
+            a circuit submitted again is not simulated again. Cached states
+            are read-only. Default: 0 (no cache)
+        prefix_sharing (bool, optional): if True, the gates shared by the
+            circuits of a submitted batch at their beginning (e.g. a state
+            preparation followed by different measurement bases) are only
+            simulated once. Each final state is kept in memory until its
+            job is executed, jobs sharing gates being executed one after the
+            other. Default: False
+        workers (int, optional): if larger than 1, the jobs of a submitted
+            batch are executed in a pool of processes of this size (the
+            other options being applied within each process, except for the
+            state cache). Default: 0 (jobs are executed in this process)
+        threads (int, optional): if larger than 1, gates of large circuits
+            are applied by this number of threads, each one updating an
+            independent chunk of the state vector. Results are deterministic
+            for a given number of threads. Default: 0 (single thread)
+        out_of_core_dir (str, optional): if set, state vectors are stored
+            in a temporary file of this directory instead of in memory, and
+            processed by blocks of :code:`2**block_qubits` amplitudes (see
+            :mod:`qat.pylinalg.outofcore`). Only sampling jobs with
+            :code:`nbshots > 0` on circuits composed of gates are supported
+            in this mode. Default: None (in-memory simulation)
+        block_qubits (int, optional): number of qubits of the blocks in
+            out-of-core mode. Default: 24 (blocks of 256MB in double
+            precision)
+        ranks (int, optional): if greater than 1, state vectors of circuits
+            composed of gates are partitioned across this number of
+            processes, a power of 2 (see :mod:`qat.pylinalg.distributed`).
+            Circuits too small to be partitioned across this number of
+            processes are partitioned across fewer ones. Default: 0 (no
+            partitioning)
     """
 
-    def __init__(self):
+    def __init__(self, fusion_width=0, matrix_cache_size=0, batch_size=0, precision="double",
+                 compact_output=False, state_cache_bytes=0, prefix_sharing=False, workers=0,
+                 threads=0, out_of_core_dir=None, block_qubits=24, ranks=0):
+        if fusion_width < 0:
+            raise ValueError("The fusion width should be a positive integer.")
+        self.fusion_width = fusion_width
+
+        if matrix_cache_size < 0:
+            raise ValueError("The matrix cache size should be a positive integer.")
+        self.matrix_cache = LRUCache(matrix_cache_size) if matrix_cache_size else None
+
+        if batch_size < 0:
+            raise ValueError("The batch size should be a positive integer.")
+        self.batch_size = batch_size
+
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision {}, should be one of {}."
+                             .format(precision, list(PRECISIONS)))
+        self.precision = precision
+        self.compact_output = compact_output
+
+        if state_cache_bytes < 0:
+            raise ValueError("The state cache size should be a positive integer.")
+        self.state_cache = LRUCache(state_cache_bytes, weigh=lambda state_vec: state_vec.nbytes) \
+            if state_cache_bytes else None
+
+        self.prefix_sharing = prefix_sharing
+
+        if workers < 0:
+            raise ValueError("The number of workers should be a positive integer.")
+        self.workers = workers
+
+        if threads < 0:
+            raise ValueError("The number of threads should be a positive integer.")
+        self.threads = threads
+
+        if block_qubits < 1:
+            raise ValueError("The number of qubits of the blocks should be a positive integer.")
+        self.out_of_core_dir = out_of_core_dir
+        self.block_qubits = block_qubits
+
+        if ranks < 0 or ranks & (ranks - 1):
+            raise ValueError("The number of ranks should be a power of 2.")
+        self.ranks = ranks
+
+        # Final states and observable values computed beforehand, indexed by
+        # job position in the batch
+        self._precomputed_states = {}
+        self._precomputed_values = {}
+        # Deferred precomputations, indexed by job position in the batch:
+        # (positions of the jobs, generator storing their states)
+        self._pending = {}
+        # Position in the batch of the job being executed
+        self._job_index = None
+
         super(PyLinalg, self).__init__() # calls QPUHandler __init__()
 
+    def _submit_batch(self, batch):
+        """
+        Executes a batch of jobs. Jobs sharing the same circuit are
+        executed from a single simulation (observables of these jobs being
+        evaluated together), and circuits sharing the same structure are
+        simulated together (if :code:`batch_size` is larger than 1), as well
+        as the beginnings shared by several circuits (if
+        :code:`prefix_sharing` is set), jobs being then executed one by one
+        by :meth:`submit_job`. Shared simulations are run when their jobs
+        are executed, these jobs being executed one after the other. If
+        :code:`workers` is larger than 1, jobs are instead executed in a
+        pool of processes.
+
+        Args:
+            batch (:class:`~qat.core.Batch`): a batch of jobs
+
+        Returns:
+            :class:`~qat.core.BatchResult`: the results
+        """
+        if self.workers > 1 and len(batch.jobs) > 1:
+            return self._submit_batch_parallel(batch)
+
+        if self.out_of_core_dir is not None:
+            return super(PyLinalg, self)._submit_batch(batch)
+
+        jobs = batch.jobs
+        try:
+            if len(jobs) > 1:
+                self._share_states(jobs)
+            if self.prefix_sharing:
+                self._share_prefixes(jobs)
+            if self.batch_size > 1:
+                self._simulate_groups(jobs)
+
+            results = [None] * len(jobs)
+            for index in self._execution_order(len(jobs)):
+                self._job_index = index
+                results[index] = self.submit_job(jobs[index])
+            return BatchResult(results=results, meta_data=batch.meta_data)
+        finally:
+            self._job_index = None
+            self._precomputed_states.clear()
+            self._precomputed_values.clear()
+            self._pending.clear()
+
+    def _defer(self, indices, computation):
+        """
+        Registers a generator storing the final states (or observable
+        values) of several jobs, given by their positions in the batch,
+        advanced when these jobs are executed (see :meth:`_run_pending`)
+        """
+        for index in indices:
+            self._pending[index] = (indices, computation)
+
+    def _run_pending(self):
+        """
+        Advances the deferred precomputation involving the job being
+        executed, if any, until the final state of this job is stored
+        """
+        _, computation = self._pending.pop(self._job_index, (None, None))
+        if computation is None:
+            return
+        for _ in computation:
+            if self._job_index in self._precomputed_states:
+                break
+
+    def _execution_order(self, nb_jobs):
+        """
+        Returns the order in which the jobs of a batch are executed: the
+        jobs of a deferred precomputation are executed one after the other,
+        from the position of the first of them
+        """
+        order, done = [], set()
+        for index in range(nb_jobs):
+            if index in done:
+                continue
+            pending = self._pending.get(index)
+            members = [index] if pending is None else pending[0]
+            order.extend(members)
+            done.update(members)
+        return order
+
+    def _share_states(self, jobs):
+        """
+        Registers the simulation, only once, of the circuits shared by
+        several jobs (see :func:`~qat.pylinalg.cache.circuit_key`)
+        """
+        groups = {}
+        for index, job in enumerate(jobs):
+            if self._can_precompute(job) and not has_intermediate_measurements(job.circuit):
+                groups.setdefault(circuit_key(job.circuit), []).append(index)
+
+        for group in groups.values():
+            if len(group) > 1:
+                self._defer(group, self._share_state(jobs, group))
+
+    def _share_state(self, jobs, group):
+        """
+        Simulates the circuit shared by a group of jobs, stores its final
+        state and the values of their observables (generator)
+        """
+        state_vec, _ = self._simulate(jobs[group[0]])
+        for index in group:
+            self._precomputed_states[index] = state_vec
+
+        obs_indices = [index for index in group if jobs[index].type == ProcessingType.OBSERVABLE]
+        values = compute_observable_averages(state_vec,
+                                             [jobs[index].observable for index in obs_indices])
+        for index, value in zip(obs_indices, values):
+            self._precomputed_values[index] = value
+        yield
+
+    def _share_prefixes(self, jobs):
+        """
+        Registers the simulation, only once, of the gates shared by the
+        circuits of several jobs at their beginning (see
+        :func:`~qat.pylinalg.simulator.simulate_shared_prefixes`). Circuits
+        whose state is cached or which are simulated on several processes
+        are left out
+        """
+        groups = {}
+        for index, job in enumerate(jobs):
+            if not self._can_precompute(job) or index in self._pending:
+                continue
+            circuit = job.circuit
+            if not circuit.ops or batch_signature(circuit) is None or self._ranks(circuit) > 1:
+                continue
+            if self.state_cache is not None and circuit_key(circuit) in self.state_cache:
+                continue
+
+            first_op = circuit.ops[0]
+            key = (circuit.nbqbits, gate_key(first_op.gate, circuit.gateDic), tuple(first_op.qbits))
+            groups.setdefault(key, []).append(index)
+
+        for group in groups.values():
+            if len(group) > 1:
+                # jobs are executed in the order their states are computed
+                order = shared_prefix_order([jobs[index].circuit for index in group])
+                group = [group[position] for position in order]
+                self._defer(group, self._simulate_prefixes(jobs, group))
+
+    def _simulate_prefixes(self, jobs, group):
+        """
+        Simulates the circuits of a group of jobs as a tree, storing (and
+        caching) each final state as soon as it is computed (generator)
+        """
+        state_vecs = simulate_shared_prefixes([jobs[index].circuit for index in group],
+                                              fusion_width=self.fusion_width,
+                                              matrix_cache=self.matrix_cache,
+                                              dtype=PRECISIONS[self.precision],
+                                              threads=self.threads)
+        for positions, state_vec in state_vecs:
+            for position in positions:
+                index = group[position]
+                self._precomputed_states[index] = state_vec
+                if self.state_cache is not None:
+                    state_vec.flags.writeable = False
+                    self.state_cache.put(circuit_key(jobs[index].circuit), state_vec)
+            yield
+
+    @staticmethod
+    def _can_precompute(job):
+        """
+        Checks if the final state of the circuit of a job can be computed
+        before the job is executed (converting the circuit if needed)
+        """
+        if job.circuit is None or job.type not in (ProcessingType.SAMPLE, ProcessingType.OBSERVABLE):
+            return False
+        if job.type == ProcessingType.OBSERVABLE and (job.nbshots or job.observable._ising is not None):
+            return False  # rejected by submit_job
+        if not isinstance(job.circuit, WCircuit):
+            job.circuit = WCircuit(job.circuit)
+        return True
+
+    def _simulate_groups(self, jobs):
+        """
+        Registers the simulation together of the circuits of jobs sharing
+        the same signature (see
+        :func:`~qat.pylinalg.simulator.batch_signature`), by chunks of at
+        most :code:`batch_size` circuits
+        """
+        groups = {}
+        for index, job in enumerate(jobs):
+            if not self._can_precompute(job):
+                continue
+
+            signature = batch_signature(job.circuit)
+            if signature is not None and index not in self._precomputed_states \
+                    and index not in self._pending:
+                groups.setdefault(signature, []).append(index)
+
+        for group in groups.values():
+            for start in range(0, len(group), self.batch_size):
+                chunk = group[start:start + self.batch_size]
+                if len(chunk) > 1:
+                    self._defer(chunk, self._simulate_chunk(jobs, chunk))
+
+    def _simulate_chunk(self, jobs, chunk):
+        """
+        Simulates together the circuits of a chunk of jobs, and stores their
+        final states (generator)
+        """
+        state_vecs = simulate_batch([jobs[index].circuit for index in chunk],
+                                    fusion_width=self.fusion_width,
+                                    matrix_cache=self.matrix_cache,
+                                    dtype=PRECISIONS[self.precision])
+        for index, state_vec in zip(chunk, state_vecs):
+            self._precomputed_states[index] = state_vec
+        yield
+
+    def _store_distribution(self, result, int_states, probs, amplitudes):
+        """
+        Stores the states of a distribution (and their probabilities and
+        amplitudes) in a result, as samples or as arrays (if
+        :code:`compact_output` is set)
+        """
+        if self.compact_output:
+            result.distribution = dict(states=int_states, probabilities=probs)
+            if amplitudes is not None:
+                result.distribution["amplitudes"] = amplitudes
+            return
+
+        for k, int_state in enumerate(int_states.tolist()):
+            amplitude = None  # in case not all qubits
+            if amplitudes is not None:
+                amplitude = ComplexNumber(re=float(amplitudes[k].real),
+                                          im=float(amplitudes[k].imag))
+
+            sample = Sample(state=int_state,
+                            amplitude=amplitude,
+                            probability=float(probs[k]))
+
+            # append
+            result.raw_data.append(sample)
+
+    def _submit_batch_parallel(self, batch):
+        """
+        Executes the jobs of a batch in a pool of :code:`workers` processes.
+        Jobs sharing the same circuit are executed by the same process, each
+        circuit being serialized once. Large distributions of jobs with
+        :code:`nbshots = 0` are sent back through shared memory.
+        """
+        # jobs are grouped by circuit: id(circuit) -> (circuit, indices of the jobs)
+        groups = {}
+        for index, job in enumerate(batch.jobs):
+            groups.setdefault(id(job.circuit), (job.circuit, []))[1].append(index)
+
+        options = dict(fusion_width=self.fusion_width,
+                       matrix_cache_size=self.matrix_cache.maxsize if self.matrix_cache else 0,
+                       batch_size=self.batch_size, precision=self.precision,
+                       compact_output=True, prefix_sharing=self.prefix_sharing,
+                       threads=self.threads, out_of_core_dir=self.out_of_core_dir,
+                       block_qubits=self.block_qubits, ranks=self.ranks)
+
+        tasks = []
+        for circuit, indices in groups.values():
+            job_bytes = []
+            for index in indices:
+                job = batch.jobs[index]
+                job.circuit = None  # the circuit is sent separately
+                try:
+                    job_bytes.append(pickle.dumps(job))
+                finally:
+                    job.circuit = circuit
+            tasks.append((options, pickle.dumps(circuit), job_bytes))
+
+        # workers share the resource tracker of this process, which owns
+        # the shared memory blocks they create
+        if os.name == "posix":
+            resource_tracker.ensure_running()
+
+        results = [None] * len(batch.jobs)
+        # results are imported while the workers, which may keep their
+        # shared memory blocks open, are alive
+        with ProcessPoolExecutor(self.workers, initializer=np.random.seed) as pool:
+            outputs = iter([(indices, pool.submit(execute_jobs, task))
+                            for (_, indices), task in zip(groups.values(), tasks)])
+            # (index, result, buffers) of the results to import
+            pending = []
+            try:
+                for indices, future in outputs:
+                    group_results, error = future.result()
+                    if error is not None:
+                        raise QPUException(*error)
+                    pending.extend((index, result, buffers)
+                                   for index, (result, buffers) in zip(indices, group_results))
+                    while pending:
+                        index, result, buffers = pending[-1]
+                        results[index] = self._import_result(result, buffers)
+                        pending.pop()
+            finally:
+                for _, _, buffers in pending:
+                    release_buffers(buffers)
+                for _, future in outputs:
+                    if future.exception() is None:
+                        group_results, _ = future.result()
+                        for _, buffers in group_results or []:
+                            release_buffers(buffers)
+
+        return BatchResult(results=results, meta_data=batch.meta_data)
+
+    def _import_result(self, result, buffers):
+        """
+        Completes a result computed by a worker process with the arrays
+        it sent inline or stored in shared memory
+        """
+        if not buffers:
+            return result
+
+        arrays = {}
+        for name, buffer in buffers.items():
+            if isinstance(buffer, np.ndarray):
+                arrays[name] = buffer
+                continue
+            shm_name, dtype, shape = buffer
+            shm = SharedMemory(name=shm_name)
+            try:
+                arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+            finally:
+                shm.close()
+                shm.unlink()
+
+        self._store_distribution(result, arrays["states"], arrays["probabilities"],
+                                 arrays.get("amplitudes"))
+        return result
+
+    def _submit_out_of_core(self, job, result, meas_qubits, has_int_meas):
+        """
+        Executes a sampling job, the state vector being stored in a
+        temporary file (see :mod:`qat.pylinalg.outofcore`)
+        """
+        if job.type != ProcessingType.SAMPLE or job.nbshots <= 0 or has_int_meas:
+            raise QPUException(ErrorType.INVALID_ARGS,
+                               "qat.pylinalg",
+                               "Out-of-core simulation only supports sampling jobs with nbshots > 0 "
+                               "and without intermediate measurements")
+
+        with tempfile.TemporaryDirectory(dir=self.out_of_core_dir) as tmp_dir:
+            state, position = simulate_out_of_core(job.circuit, os.path.join(tmp_dir, "state.bin"),
+                                                   self.block_qubits, matrix_cache=self.matrix_cache,
+                                                   dtype=PRECISIONS[self.precision])
+            res_ints, counts = sample_counts_out_of_core(state, position, meas_qubits, job.nbshots)
+            del state  # unmapping the file
+
+        if job.aggregate_data:
+            result.raw_data = aggregated_samples(res_ints, counts)
+            result.meta_data["nbshots"] = str(job.nbshots)
+        else:
+            for res_int in np.random.permutation(np.repeat(res_ints, counts)).tolist():
+                result.raw_data.append(Sample(state=res_int, intermediate_measurements=[]))
+        return result
+
+    def _simulate(self, job):
+        """
+        Returns the final state of the circuit of a job (and its
+        intermediate measurements), simulated with the options of this QPU
+        """
+        state_vec = self._precomputed_states.pop(self._job_index, None)
+        if state_vec is not None:
+            return state_vec, []
+
+        if self.state_cache is None or has_intermediate_measurements(job.circuit):
+            return self._compute_state(job.circuit)
+
+        key = circuit_key(job.circuit)
+        state_vec = self.state_cache.get(key)
+        if state_vec is None:
+            state_vec, _ = self._compute_state(job.circuit)
+            state_vec.flags.writeable = False
+            self.state_cache.put(key, state_vec)
+        return state_vec, []
+
+    def _compute_state(self, circuit):
+        """
+        Simulates a circuit, on several processes if :code:`ranks > 1`
+        and if the circuit is composed of gates. Circuits too small to be
+        partitioned across :code:`ranks` processes are partitioned across
+        fewer processes (see :func:`~qat.pylinalg.distributed.max_ranks`)
+        """
+        ranks = self._ranks(circuit)
+        if ranks > 1:
+            return simulate_distributed(circuit, ranks, matrix_cache=self.matrix_cache,
+                                        dtype=PRECISIONS[self.precision]), []
+
+        return simulate(circuit, fusion_width=self.fusion_width,
+                        matrix_cache=self.matrix_cache,
+                        dtype=PRECISIONS[self.precision], threads=self.threads)
+
+    def _ranks(self, circuit):
+        """
+        Returns the number of processes simulating a circuit (see
+        :meth:`_compute_state`)
+        """
+        if self.ranks > 1 and batch_signature(circuit) is not None:
+            return min(self.ranks, max_ranks(circuit))
+        return 1
+
+    def _simulate_branches(self, job):
+        """
+        Distributes the shots of a job across the trajectories of its
+        circuit (see :func:`~qat.pylinalg.simulator.simulate_branches`),
+        simulated with the options of this QPU
+        """
+        return simulate_branches(job.circuit, job.nbshots, fusion_width=self.fusion_width,
+                                 matrix_cache=self.matrix_cache,
+                                 dtype=PRECISIONS[self.precision], threads=self.threads)
+
     def submit_job(self, job):
         """
         Returns a Result structure corresponding to the execution
@@ -57,6 +604,7 @@ class PyLinalg(QPUHandler):
         """
         if not isinstance(job.circuit, WCircuit):
             job.circuit = WCircuit(job.circuit)
+        self._run_pending()
 
         has_int_meas = has_intermediate_measurements(job.circuit)
 
@@ -80,95 +628,84 @@ class PyLinalg(QPUHandler):
         result = Result()
         result.meta_data = {}
         result.raw_data = []
+        if self.out_of_core_dir is not None:
+            return self._submit_out_of_core(job, result, meas_qubits, has_int_meas)
+
         if job.type == ProcessingType.SAMPLE:  # Sampling
             if job.nbshots == 0:  # Returning the full state/distribution
 
-                np_state_vec, _ = simulate(job.circuit)  # perform simu
-                if not all_qubits:
-                    sum_axes = tuple(qb for qb in range(job.circuit.nbqbits) if qb not in meas_qubits)
-
-                    # state_vec is transformed into vector of probabilities
-                    np_state_vec = np.abs(np_state_vec**2)
-                    np_state_vec = np_state_vec.sum(axis=sum_axes)
-
-                # At this point axes might not be in the same order
-                # as in meas_qubits: restoring this order now:
-
-                svec_inds = sorted(meas_qubits)  # current np_state_vec indices
-
-                for target, qb in enumerate(meas_qubits):
-                    cur = svec_inds.index(qb)
-                    np_state_vec = np_state_vec.swapaxes(target, cur)
-                    svec_inds[target], svec_inds[cur] = svec_inds[cur], svec_inds[target]
-
-                # loop over states. val is amp if all_qubits else prob
-                for int_state, val in enumerate(np_state_vec.ravel()):
-                    amplitude = None  # in case not all qubits
-                    if all_qubits:
-                        amplitude = ComplexNumber(re=val.real, im=val.imag)
-                        prob = np.abs(val)**2
-                    else:
-                        prob = val
-
-                    if prob <= job.amp_threshold**2:
-                        continue
-
-                    sample = Sample(state=int_state,
-                                    amplitude=amplitude,
-                                    probability=prob)
-
-                    # append
-                    result.raw_data.append(sample)
+                np_state_vec, _ = self._simulate(job)  # perform simu
+                if all_qubits:
+                    # axes of the state are put in the order of meas_qubits
+                    amplitudes = np_state_vec.transpose(meas_qubits).ravel()
+                    probs = np.abs(amplitudes)**2
+                else:
+                    amplitudes = None
+                    probs = marginal_probabilities(np_state_vec, meas_qubits)
 
-            elif job.nbshots > 0:  # Performing shots
+                # states above the threshold
+                int_states = np.flatnonzero(probs > job.amp_threshold**2)
+                probs = probs[int_states]
+                if amplitudes is not None:
+                    amplitudes = amplitudes[int_states]
 
-                if has_int_meas:
-                    # if intermediate measurements, the entire simulation must
-                    # be redone for every shot. Because the intermediate measurements
-                    # might change the output distribution probability.
+                self._store_distribution(result, int_states, probs, amplitudes)
 
-                    intprob_list = []
-                    interm_meas_list = []
-                    for _ in range(job.nbshots):
-                        np_state_vec, interm_measurements = simulate(job.circuit)  # perform simu
-                        intprob = measure(np_state_vec, meas_qubits, nb_samples=1)
+            elif job.nbshots > 0 and has_int_meas:
+                # Intermediate measurements might change the output distribution.
+                # Shots are distributed across the possible trajectories of the
+                # circuit, and each trajectory is simulated only once.
 
-                        intprob_list.append(intprob[0])
-                        interm_meas_list.append(interm_measurements)
+                if job.aggregate_data:
+                    # (final state, interm. measurements) -> [final state, occurrences, interm. measurements]
+                    aggregated = {}
+                    for np_state_vec, interm_measurements, shots in self._simulate_branches(job):
+                        branch_key = tuple((measurement.gate_pos, tuple(measurement.cbits))
+                                           for measurement in interm_measurements)
+                        res_ints, counts = sample_counts(np_state_vec, meas_qubits, shots)
+                        for res_int, count in zip(res_ints, counts):
+                            aggregated.setdefault((int(res_int), branch_key),
+                                                  [int(res_int), 0, interm_measurements])[1] += int(count)
+
+                    result.raw_data = aggregated_samples([res_int for res_int, _, _ in aggregated.values()],
+                                                         [count for _, count, _ in aggregated.values()],
+                                                         [interm for _, _, interm in aggregated.values()])
+                    result.meta_data["nbshots"] = str(job.nbshots)
 
                 else:
-                    # no need to redo the simulation entirely. Just sampling.
+                    for np_state_vec, interm_measurements, shots in self._simulate_branches(job):
+                        for res_int, _ in measure(np_state_vec, meas_qubits, nb_samples=shots):
+                            result.raw_data.append(Sample(state=res_int,
+                                                          intermediate_measurements=interm_measurements))
 
-                    np_state_vec, _ = simulate(job.circuit)  # perform simu
-                    intprob_list = measure(np_state_vec,
-                                           meas_qubits,
-                                           nb_samples=job.nbshots)
+                    # shots are independent: shuffling them back
+                    order = np.random.permutation(len(result.raw_data))
+                    result.raw_data = [result.raw_data[k] for k in order]
 
-                    interm_meas_list = [[] for _ in range(job.nbshots)]
+            elif job.nbshots > 0 and job.aggregate_data:
+                # Sampling counts directly, without creating one sample per shot
 
-                # convert to good format and put in container.
-                for k, intprob in enumerate(intprob_list):
+                np_state_vec, _ = self._simulate(job)  # perform simu
+                res_ints, counts = sample_counts(np_state_vec, meas_qubits, job.nbshots)
 
-                    res_int, prob = intprob
+                result.raw_data = aggregated_samples(res_ints, counts)
+                result.meta_data["nbshots"] = str(job.nbshots)
 
-                    amplitude = None  # in case not all qubits
-                    if all_qubits:
-                        # accessing amplitude of result
-                        indices = [res_int >> k & 1
-                                   for k in range(len(meas_qubits))]
-                        indices.reverse()
+            elif job.nbshots > 0:  # Performing shots
+                # no need to redo the simulation for each shot. Just sampling.
 
-                        amp = np_state_vec[tuple(indices)]
-                        amplitude = ComplexNumber(re=amp.real, im=amp.imag)
+                np_state_vec, _ = self._simulate(job)  # perform simu
+                intprob_list = measure(np_state_vec,
+                                       meas_qubits,
+                                       nb_samples=job.nbshots)
 
+                # convert to good format and put in container.
+                for res_int, _ in intprob_list:
                     # final result object
-                    sample = Sample(state=res_int, intermediate_measurements=interm_meas_list[k])
+                    sample = Sample(state=res_int, intermediate_measurements=[])
                     # append
                     result.raw_data.append(sample)
 
-                if job.aggregate_data:
-                    result = aggregate_data(result)
-
             else:
                 raise QPUException(ErrorType.INVALID_ARGS,
                                    "qat.pylinalg",
@@ -189,7 +726,12 @@ class PyLinalg(QPUHandler):
                                    "qat.pylinalg",
                                    "Observable is specified as an Ising model. This is not supported by PyLinalg.")
 
-            np_state_vec, _ = simulate(job.circuit)  # perform simu
+            if self._job_index in self._precomputed_values:
+                self._precomputed_states.pop(self._job_index, None)
+                result.value = self._precomputed_values.pop(self._job_index)
+                return result
+
+            np_state_vec, _ = self._simulate(job)  # perform simu
             result.value = compute_observable_average(np_state_vec,
                                                       job.observable)
 
@@ -200,6 +742,112 @@ class PyLinalg(QPUHandler):
                            f"Unsupported job type {job.type}")
 
 
+def execute_jobs(task):
+    """
+    Executes jobs sharing the same circuit in a worker process of
+    :class:`PyLinalg`. Distributions (jobs with :code:`nbshots = 0`) larger
+    than :code:`INLINE_BYTES` are stored in shared memory, to be read by the
+    main process.
+
+    Args:
+        task (tuple): the options of the QPU, the pickled circuit and the
+            pickled jobs (without their circuit)
+
+    Returns:
+        tuple: a list of pairs (result, buffers) and None, or None and the
+        arguments of a QPUException. The buffers of a result map the names
+        of its arrays to these arrays, or to their shared memory blocks
+    """
+    try:
+        options, circuit_bytes, job_bytes = task
+        circuit = pickle.loads(circuit_bytes)
+        jobs = []
+        for data in job_bytes:
+            job = pickle.loads(data)
+            job.circuit = circuit
+            jobs.append(job)
+
+        results = PyLinalg(**options).submit(Batch(jobs=jobs)).results
+    except QPUException as exc:
+        return None, (exc.code, exc.modulename, exc.message, exc.file, exc.line)
+    except Exception as exc:  # pylint: disable=broad-except
+        return None, (ErrorType.ABORT, "qat.pylinalg", "{}: {}".format(type(exc).__name__, exc))
+
+    outputs, blocks = [], []
+    try:
+        for result in results:
+            buffers = {}
+            distribution = getattr(result, "distribution", {})
+            if distribution:
+                del result.distribution  # sent separately
+            for name, array in distribution.items():
+                if array.nbytes <= INLINE_BYTES:
+                    buffers[name] = array
+                    continue
+                shm = SharedMemory(create=True, size=array.nbytes)
+                blocks.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                buffers[name] = (shm.name, array.dtype.str, array.shape)
+            outputs.append((result, buffers))
+    except Exception as exc:  # pylint: disable=broad-except
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        return None, (ErrorType.ABORT, "qat.pylinalg", "{}: {}".format(type(exc).__name__, exc))
+
+    for shm in blocks:
+        if os.name == "posix":
+            shm.close()  # the block lives until the main process unlinks it
+        else:
+            _OPEN_BLOCKS.append(shm)
+    return outputs, None
+
+
+def release_buffers(buffers):
+    """
+    Unlinks the shared memory blocks created by a worker process for a
+    result which is not imported (see :func:`execute_jobs`)
+
+    Args:
+        buffers (dict): the buffers of the result
+    """
+    for buffer in buffers.values():
+        if isinstance(buffer, np.ndarray):
+            continue
+        try:
+            shm = SharedMemory(name=buffer[0])
+        except FileNotFoundError:  # already released
+            continue
+        shm.close()
+        shm.unlink()
+
+
+def aggregated_samples(res_ints, counts, interm_meas_list=None):
+    """
+    Builds aggregated samples (one per distinct result) from measurement
+    counts, like :func:`~qat.core.wrappers.result.aggregate_data` would do
+    from individual samples: the probability of each sample is its
+    frequency, and its error the standard error on this frequency.
+
+    Args:
+        res_ints (list): the distinct results
+        counts (list): number of occurrences of each result
+        interm_meas_list (list, optional): intermediate measurements of
+            each result
+
+    Returns:
+        list: a list of :class:`~qat.core.wrappers.result.Sample`
+    """
+    nbshots = int(np.sum(counts))
+    samples = []
+    for k, (res_int, count) in enumerate(zip(res_ints, counts)):
+        freq = count / nbshots
+        err = np.sqrt(freq * (1 - freq) / (nbshots - 1)) if nbshots > 1 else None
+        samples.append(Sample(state=int(res_int), probability=freq, err=err,
+                              intermediate_measurements=interm_meas_list[k] if interm_meas_list else None))
+    return samples
+
+
 def has_intermediate_measurements(circuit):
     """
     Simple utility function.
@@ -19,7 +19,6 @@
     under the License.
 """
 
-import itertools
 import numpy as np
 
 import qat.comm.shared.ttypes as shared_types
@@ -28,33 +27,125 @@ import qat.comm.exceptions.ttypes as exceptions_types
 import qat.core.formula_eval as feval
 
 from qat.core.util import extract_syntax
+from .kernels import apply_gate, allocate_scratch, analyze_matrix, ChunkPool, DENSE
+from .fusion import FusedGate, fuse_gates
+from .layout import plan_layouts, permute_state
+from .cache import gate_key
+from .pauli import PauliString, pauli_expectations
 
 
-def get_gate_matrix(gate_definition, gate_dic):
+def get_gate_controls(gate_definition, gate_dic):
     """
-    Returns the smallest possible submatrix and the number of controls associated to a gate definition.
+    Returns the number of controls of a gate definition, and the definition
+    of the gate it controls.
 
     Returns:
-        (int, np.array)
+        (int, GateDefinition)
     """
     nctrls = 0
     while gate_definition.is_ctrl or gate_definition.nbctrls:
         nctrls += gate_definition.nbctrls or 1
         gate_definition = gate_dic[gate_definition.subgate]
-    return nctrls, mat2nparray(gate_definition.matrix)
+    return nctrls, gate_definition
+
+
+def get_gate_matrix(gate_definition, gate_dic, dtype=np.complex128):
+    """
+    Returns the smallest possible submatrix and the number of controls associated to a gate definition.
+
+    Returns:
+        (int, np.array)
+    """
+    nctrls, gate_definition = get_gate_controls(gate_definition, gate_dic)
+    return nctrls, mat2nparray(gate_definition.matrix, dtype=dtype)
+
+
+def get_gate_info(circuit, gate_name, gate_cache, matrix_cache=None, dtype=np.complex128):
+    """
+    Returns the number of controls, the matrix and the structure (see
+    :func:`~qat.pylinalg.kernels.analyze_matrix`) of a gate. Matrices are
+    converted and analyzed once per gate definition, and stored in
+    :code:`gate_cache`.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit
+        gate_name (str): name of the gate in the gate dictionary
+        gate_cache (dict): cache of the already converted gates of the
+            circuit, indexed by gate name
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            cache shared between circuits, indexed by gate definition
+        dtype (numpy.dtype, optional): dtype of the matrix. Default:
+            :code:`numpy.complex128`
+
+    Returns:
+        (int, np.array, :class:`~qat.pylinalg.kernels.MatrixStructure`)
+    """
+    if gate_name in gate_cache:
+        return gate_cache[gate_name]
+
+    key = None
+    if matrix_cache is not None:
+        key = (np.dtype(dtype).str,) + gate_key(gate_name, circuit.gateDic)
+        info = matrix_cache.get(key)
+        if info is not None:
+            gate_cache[gate_name] = info
+            return info
+
+    gdef = circuit.gateDic[gate_name]
+    try:
+        nctrls, matrix = get_gate_matrix(gdef, circuit.gateDic, dtype)
+    except AttributeError as excp:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
+                            modulename="qat.pylinalg",
+                            file="qat/pylinalg/simulator.py",
+                            line=103,
+                            message="Gate {} has no matrix!"\
+                            .format(extract_syntax(gdef, circuit.gateDic)[0])) from excp
+    gate_cache[gate_name] = (nctrls, matrix, analyze_matrix(matrix))
+
+    if key is not None:
+        matrix_cache.put(key, gate_cache[gate_name])
+    return gate_cache[gate_name]
+
+
+def is_state_preparation(gate_definition, gate_dic):
+    """
+    Checks if a gate definition is a state preparation, i.e. a gate
+    with no matrix which overwrites the whole state vector.
+
+    Returns:
+        bool
+    """
+    if gate_definition.matrix:
+        return False
+    return extract_syntax(gate_definition, gate_dic)[0] == "STATE_PREPARATION"
 
 
-def simulate(circuit):
+def simulate(circuit, fusion_width=0, matrix_cache=None, dtype=np.complex128, threads=0):
     """
     Computes state vector at the output of provided circuit.
 
     State vector is stored as a :code:`numpy.ndarray`
     It is initialized at :math:`|0^n\\rangle`.
-    Then, loop over gates, updating the state vector using `np.tensordot`
+    Then, loop over gates, updating the state vector in place (see
+    :mod:`qat.pylinalg.kernels`). Its axes are permuted before dense gates
+    acting on distant qubits (see :mod:`qat.pylinalg.layout`)
 
     Args:
         circuit (:class:`~qat.core.Circuit`): Input circuit. The
             circuit to simulate.
+        fusion_width (int, optional): if larger than 1, runs of consecutive
+            gates acting on at most :code:`fusion_width` qubits are merged
+            before being applied (see :func:`qat.pylinalg.fusion.fuse_gates`).
+            Default: 0 (no fusion)
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            cache of converted gate matrices, shared between circuits
+        dtype (numpy.dtype, optional): dtype of the state vector and of the
+            gate matrices, :code:`numpy.complex128` (default) or
+            :code:`numpy.complex64`
+        threads (int, optional): if larger than 1, gates are applied by this
+            number of threads on independent chunks of the state vector
+            (see :class:`~qat.pylinalg.kernels.ChunkPool`). Default: 0
 
     Returns:
         tuple: a tuple composed of a state vector and intermediate measurements:
@@ -62,125 +153,486 @@ def simulate(circuit):
               state vector. It has one 2-valued index per qubits.
             - intermediate measurements: :code:`list` of :class:`qat.comm.shared.ttypes.IntermediateMeasurement`. List containing descriptors of the intermediate measurements that occurred within the circuit, so that the classical branching is known to the user.
     """
+    branches = simulate_branches(circuit, 1, fusion_width=fusion_width,
+                                 matrix_cache=matrix_cache, dtype=dtype, threads=threads)
+    state_vec, interm_measurements, _ = next(branches)
+    branches.close()
+    return state_vec, interm_measurements
+
+
+def simulate_branches(circuit, nbshots, fusion_width=0, matrix_cache=None, dtype=np.complex128,
+                      threads=0):
+    """
+    Simulates :code:`nbshots` runs of a circuit containing intermediate
+    measurements, by following the trajectories of the shots.
+
+    The circuit is simulated once up to its first intermediate measurement
+    (or reset). There, the remaining shots are distributed across the
+    possible results of the measurement (following a multinomial
+    distribution), and the simulation continues separately along each
+    result that received at least one shot. The number of simulations is
+    thus the number of distinct trajectories, instead of the number of
+    shots.
+
+    Branches are explored one after the other: this function is a generator,
+    so that at most one final state vector per pending measurement result is
+    kept in memory.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): the circuit to simulate
+        nbshots (int): the number of shots
+        fusion_width (int, optional): see :func:`simulate`
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`simulate`
+        dtype (numpy.dtype, optional): see :func:`simulate`
+        threads (int, optional): see :func:`simulate`
+
+    Yields:
+        tuple: for each trajectory, a tuple composed of the final state
+        vector, the list of intermediate measurements along the trajectory
+        and the number of shots that followed the trajectory
+    """
     # Initialization at |0...0>
     shape = tuple([2 for _ in range(circuit.nbqbits)])
-    state_vec = np.zeros(shape, dtype=np.complex128)
+    state_vec = np.zeros(shape, dtype=dtype)
     state_vec[tuple([0 for _ in range(circuit.nbqbits)])] = 1
 
-    # cbits initilization.
-    cbits = [0] * circuit.nbcbits
-
-    interm_measurements = []
-    # Loop over gates.
-    for op_pos, op in enumerate(circuit):
-
-        if op.type == datamodel_types.OpType.MEASURE:
-            # measure op.qbits on state_vec and store in op.cbits
-            intprob_list = measure(state_vec, op.qbits)
-            state_vec = project(state_vec, op.qbits, intprob_list[0])
-            res_int, prob = intprob_list[0]
-
-            for k in range(len(op.qbits)):
-                cbits[op.cbits[k]] = res_int >> (len(op.qbits) - k - 1) & 1
-
-            interm_measurements.append(shared_types.IntermediateMeasurement(
-                gate_pos=op_pos,
-                cbits=[(res_int >> (len(op.qbits) - k - 1) & 1) for k in range(len(op.qbits))],
-                probability=prob
-            ))
-            continue
-
-        if op.type == datamodel_types.OpType.RESET:
-            # measure, if result is 1 apply X.
-            state_vec, res, prob = reset(state_vec, op.qbits)  # contains actual implem.
-            for cb in op.cbits:
-                cbits[cb] = 0
-            interm_measurements.append(shared_types.IntermediateMeasurement(
-                gate_pos=op_pos,
-                cbits=[(res >> (len(op.qbits) - k - 1) & 1) for k in range(len(op.qbits))],
-                probability=prob
-            ))
-            continue
-
-        if op.type == datamodel_types.OpType.CLASSIC:
-            # compute result bit of formula
-            cbits[op.cbits[0]] = int(feval.evaluate(op.formula, cbits))
-            continue
-
-        if op.type == datamodel_types.OpType.BREAK:
-            # evaluate formula and break if verdict is 1.
-            verdict = feval.evaluate(op.formula, cbits)
-            if verdict:
-                raise_break(op, op_pos, cbits)
-            continue
-
-        if op.type == datamodel_types.OpType.CLASSICCTRL:
-            # continue only if control cbits are all at 1.
-            if not all([cbits[x] for x in op.cbits]):
-                continue
-
-        gdef = circuit.gateDic[op.gate]    # retrieving useful info.
-
-        # Checking if the matrix has a matrix
-
-        if not gdef.matrix:
-            gname = extract_syntax(gdef, circuit.gateDic)[0]
-            if gname == "STATE_PREPARATION":
-                matrix = gdef.syntax.parameters[0].matrix_p
-                np_matrix = mat2nparray(matrix)
-                if np_matrix.shape != (2**circuit.nbqbits, 1):
-                    raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
-                                       modulename="qat.pylinalg",
-                                       file="qat/pylinalg/simulator.py",
-                                       line=103,
-                                       message="Gate {} has wrong shape {}, should be {}!"\
-                                       .format(gname, np_matrix.shape, (2**circuit.nbqbits, 1)))
-                state_vec[:] = np_matrix[:, 0].reshape(shape)
-                norm = np.linalg.norm(state_vec)
-                if abs(norm - 1.0) > 1e-10:
-                    raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
-                                       modulename="qat.pylinalg",
-                                       file="qat/pylinalg/simulator.py",
-                                       line=103,
-                                       message="State preparation should be normalized, got norm = {} instead!"\
-                                       .format(norm))
-                continue
+    # Buffer shared by all gate applications
+    scratch = allocate_scratch(state_vec)
+    gate_cache = {}
+
+    def fusable_gate_info(op):
+        if is_state_preparation(circuit.gateDic[op.gate], circuit.gateDic):
+            return None
+        return get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype)
 
+    if fusion_width > 1:
+        steps = fuse_gates(circuit, fusion_width, fusable_gate_info)
+    else:
+        steps = list(enumerate(circuit))
+
+    def dense_targets(op):
+        if isinstance(op, FusedGate):
+            return op.qbits if op.structure.kind == DENSE else []
+        if op.type in (datamodel_types.OpType.MEASURE, datamodel_types.OpType.RESET):
+            return None
+        if op.type not in (datamodel_types.OpType.GATETYPE, datamodel_types.OpType.CLASSICCTRL):
+            return []
+        if is_state_preparation(circuit.gateDic[op.gate], circuit.gateDic):
+            return None
+        try:
+            nctrls, _, structure = get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype)
+        except exceptions_types.QPUException:
+            return None  # raised when the gate is applied
+        return op.qbits[nctrls:] if structure.kind == DENSE else []
+
+    # Axes of the qubits (see qat.pylinalg.layout), the logical layout being
+    # restored before measurements, so that branches start with it
+    layouts = plan_layouts(circuit.nbqbits, steps, dense_targets)
+    identity = list(range(circuit.nbqbits))
+
+    # Pending branches: (next step, state vector, cbits, interm. measurements, nb of shots)
+    branches = [(0, state_vec, [0] * circuit.nbcbits, [], nbshots)]
+
+    pool = ChunkPool(threads) if threads > 1 else None
+    try:
+        while branches:
+            step, state_vec, cbits, interm_measurements, shots = branches.pop()
+            layout = identity
+
+            # Loop over gates.
+            while step < len(steps):
+                if step in layouts:
+                    # the previous state vector becomes the scratch buffer
+                    state_vec, scratch = permute_state(state_vec, layout, layouts[step], scratch), \
+                        state_vec.reshape(-1)
+                    layout = layouts[step]
+
+                op_pos, op = steps[step]
+                step += 1
+
+                if isinstance(op, FusedGate):
+                    apply_gate(state_vec, op.matrix, [layout[qb] for qb in op.qbits], 0, scratch,
+                               op.structure, pool=pool)
+                    continue
+
+                if op.type in (datamodel_types.OpType.MEASURE, datamodel_types.OpType.RESET):
+                    # distributing the shots across the measurement results
+                    probs = marginal_probabilities(state_vec, op.qbits).astype(np.float64)
+                    probs /= probs.sum()
+                    counts = np.random.multinomial(shots, probs)
+                    res_ints = np.flatnonzero(counts)
+
+                    # other results are simulated later, on a copy of the state
+                    for res_int in res_ints[1:]:
+                        branch_cbits, branch_measurements = list(cbits), list(interm_measurements)
+                        branch_vec = collapse(state_vec.copy(), op, op_pos, int(res_int), float(probs[res_int]),
+                                              branch_cbits, branch_measurements)
+                        branches.append((step, branch_vec, branch_cbits, branch_measurements,
+                                         int(counts[res_int])))
+
+                    res_int = int(res_ints[0])
+                    shots = int(counts[res_int])
+                    state_vec = collapse(state_vec, op, op_pos, res_int, float(probs[res_int]),
+                                         cbits, interm_measurements)
+                    continue
+
+                if op.type == datamodel_types.OpType.CLASSIC:
+                    # compute result bit of formula
+                    cbits[op.cbits[0]] = int(feval.evaluate(op.formula, cbits))
+                    continue
+
+                if op.type == datamodel_types.OpType.BREAK:
+                    # evaluate formula and break if verdict is 1.
+                    verdict = feval.evaluate(op.formula, cbits)
+                    if verdict:
+                        raise_break(op, op_pos, cbits)
+                    continue
+
+                if op.type == datamodel_types.OpType.CLASSICCTRL:
+                    # continue only if control cbits are all at 1.
+                    if not all([cbits[x] for x in op.cbits]):
+                        continue
+
+                gdef = circuit.gateDic[op.gate]    # retrieving useful info.
+
+                # Checking if the matrix has a matrix
+
+                if not gdef.matrix:
+                    gname = extract_syntax(gdef, circuit.gateDic)[0]
+                    if gname == "STATE_PREPARATION":
+                        matrix = gdef.syntax.parameters[0].matrix_p
+                        np_matrix = mat2nparray(matrix)
+                        if np_matrix.shape != (2**circuit.nbqbits, 1):
+                            raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
+                                               modulename="qat.pylinalg",
+                                               file="qat/pylinalg/simulator.py",
+                                               line=103,
+                                               message="Gate {} has wrong shape {}, should be {}!"\
+                                               .format(gname, np_matrix.shape, (2**circuit.nbqbits, 1)))
+                        norm = np.linalg.norm(np_matrix)
+                        state_vec[:] = np_matrix[:, 0].reshape(shape)
+                        if abs(norm - 1.0) > 1e-10:
+                            raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
+                                               modulename="qat.pylinalg",
+                                               file="qat/pylinalg/simulator.py",
+                                               line=103,
+                                               message="State preparation should be normalized, got norm = {} instead!"\
+                                               .format(norm))
+                        continue
+
+                nctrls, matrix, structure = get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype)
+
+                # Updating the state vector in place
+                apply_gate(state_vec, matrix, [layout[qb] for qb in op.qbits], nctrls, scratch,
+                           structure, pool=pool)
+
+            if len(steps) in layouts:
+                state_vec, scratch = permute_state(state_vec, layout, identity, scratch), \
+                    state_vec.reshape(-1)
+            yield state_vec, interm_measurements, shots
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def collapse(state_vec, op, op_pos, res_int, prob, cbits, interm_measurements):
+    """
+    Applies the effect of a MEASURE or RESET operation, given its result:
+    the state vector is projected (and, for a reset, the measured qubits are
+    flipped back to 0), the classical bits are updated, and the
+    intermediate measurement is recorded.
+
+    Args:
+        state_vec (numpy.ndarray): the state vector, updated in place
+        op (:class:`~qat.comm.datamodel.ttypes.Op`): the MEASURE or RESET
+            operation
+        op_pos (int): position of the operation in the circuit
+        res_int (int): result of the measurement
+        prob (float): probability of this result
+        cbits (list): classical bits, updated in place
+        interm_measurements (list): intermediate measurements, updated in
+            place
+
+    Returns:
+        numpy.ndarray: the projected state vector
+    """
+    state_vec = project(state_vec, op.qbits, (res_int, prob))
+    bits = [(res_int >> (len(op.qbits) - k - 1) & 1) for k in range(len(op.qbits))]
+
+    if op.type == datamodel_types.OpType.RESET:
+        X = np.array([[0, 1], [1, 0]], dtype=state_vec.dtype)  # X gate
+        for qb, bit in zip(op.qbits, bits):
+            if bit:                                         # ? c[k] : X q[k]
+                apply_gate(state_vec, X, [qb])
+        for cb in op.cbits:
+            cbits[cb] = 0
+    else:
+        for cb, bit in zip(op.cbits, bits):
+            cbits[cb] = bit
+
+    interm_measurements.append(shared_types.IntermediateMeasurement(
+        gate_pos=op_pos,
+        cbits=bits,
+        probability=prob
+    ))
+    return state_vec
 
 
+def batch_signature(circuit):
+    """
+    Returns the structure of a circuit, i.e. everything but the values of
+    its gate matrices. Circuits sharing the same signature can be simulated
+    together by :func:`simulate_batch`.
 
-        try:
-            nctrls, matrix = get_gate_matrix(gdef, circuit.gateDic)
-        except AttributeError as excp:
-            raise exceptions_types.QPUException(code=exceptions_types.ErrorType.ILLEGAL_GATES,
-                                modulename="qat.pylinalg",
-                                file="qat/pylinalg/simulator.py",
-                                line=103,
-                                message="Gate {} has no matrix!"\
-                                .format(extract_syntax(gdef, circuit.gateDic)[0])) from excp
-        # Moving qubits axis in first positions
-        state_vec = np.moveaxis(state_vec, op.qbits, range(len(op.qbits)))
-        # Reshaping for block multiplication
-        state_vec = state_vec.reshape((1 << nctrls, matrix.shape[0], 1 << (circuit.nbqbits - len(op.qbits))))
-        # If controled, only applying the gate on the last block
-        if nctrls:
-            state_vec[-1] = np.dot(matrix, state_vec[-1])
+    Args:
+        circuit (:class:`~qat.core.Circuit`): a circuit
+
+    Returns:
+        tuple: the signature of the circuit, or None if it contains
+        operations other than gates (measures, resets, classical operations
+        or state preparations)
+    """
+    signature = [circuit.nbqbits]
+    for op in circuit.ops:
+        if op.type != datamodel_types.OpType.GATETYPE:
+            return None
+        gdef = circuit.gateDic[op.gate]
+        if is_state_preparation(gdef, circuit.gateDic):
+            return None
+        nctrls, _ = get_gate_controls(gdef, circuit.gateDic)
+        signature.append((tuple(op.qbits), nctrls))
+    return tuple(signature)
+
+
+def simulate_batch(circuits, fusion_width=0, matrix_cache=None, dtype=np.complex128):
+    """
+    Computes the state vectors at the output of several circuits sharing the
+    same signature (see :func:`batch_signature`), typically the same
+    parametrized circuit for different values of its parameters.
+
+    States are stored as a single :code:`numpy.ndarray` of shape
+    (B, 2, ..., 2), and each gate is applied on all the states at once.
+
+    Args:
+        circuits (list): a list of B circuits (:class:`~qat.core.Circuit`)
+        fusion_width (int, optional): see :func:`simulate`
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`simulate`
+        dtype (numpy.dtype, optional): see :func:`simulate`
+
+    Returns:
+        numpy.ndarray: the B state vectors, stacked
+    """
+    signatures = {batch_signature(circuit) for circuit in circuits}
+    if len(signatures) != 1 or None in signatures:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                            modulename="qat.pylinalg",
+                                            message="Only circuits composed of gates and sharing "
+                                                    "the same structure can be simulated together")
+
+    # Gates of each circuit, possibly fused
+    all_gates = []
+    for circuit in circuits:
+        gate_cache = {}
+        if fusion_width > 1:
+            steps = fuse_gates(circuit, fusion_width,
+                               lambda op: get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype))
         else:
-            state_vec = np.dot(matrix, state_vec)
-        # Going back to a split shape
-        state_vec = state_vec.reshape(tuple(2 for _ in range(circuit.nbqbits)))
-        # moving qubit back to their position
-        state_vec = np.moveaxis(state_vec, range(len(op.qbits)), op.qbits)
+            steps = enumerate(circuit)
 
-    return state_vec, interm_measurements
+        gates = []
+        for _, op in steps:
+            if isinstance(op, FusedGate):
+                gates.append((op.qbits, 0, op.matrix, op.structure))
+            else:
+                gates.append((op.qbits,) + get_gate_info(circuit, op.gate, gate_cache, matrix_cache, dtype))
+        all_gates.append(gates)
+
+    # Initialization at |0...0>
+    nbqbits = circuits[0].nbqbits
+    state_vecs = np.zeros((len(circuits),) + (2,) * nbqbits, dtype=dtype)
+    state_vecs[(slice(None),) + (0,) * nbqbits] = 1
+    scratch = allocate_scratch(state_vecs)
+
+    for gates in zip(*all_gates):
+        qbits, nctrls, matrix, structure = gates[0]
+
+        # Matrices shared by all the states are not stacked
+        if any(gate[2] is not matrix and not np.array_equal(gate[2], matrix)
+               for gate in gates[1:]):
+            matrix = np.stack([gate[2] for gate in gates])
+            structure = analyze_matrix(matrix)
+
+        apply_gate(state_vecs, matrix, qbits, nctrls, scratch, structure, batched=True)
+
+    return state_vecs
+
+
+def gate_sequence_keys(circuit):
+    """
+    Returns, for each operation of a circuit composed of gates, a key
+    identifying the operation across circuits (see
+    :func:`~qat.pylinalg.cache.gate_key`): two circuits apply the same
+    gates up to some position if their keys are equal up to this position.
+
+    Args:
+        circuit (:class:`~qat.core.Circuit`): a circuit
+
+    Returns:
+        list: a list of hashable keys
+    """
+    key_cache = {}
+    keys = []
+    for op in circuit.ops:
+        if op.gate not in key_cache:
+            key_cache[op.gate] = gate_key(op.gate, circuit.gateDic)
+        keys.append((key_cache[op.gate], tuple(op.qbits)))
+    return keys
+
+
+def prefix_tree(circuits):
+    """
+    Walks depth first through the tree of the gates shared by several
+    circuits at their beginning: each node gathers circuits applying the
+    same gates up to some depth, and has one branch per distinct next gate.
+    Branches are walked in the order of their first circuit.
+
+    Args:
+        circuits (list): a list of circuits (:class:`~qat.core.Circuit`)
+
+    Yields:
+        tuple: for each node, the indices of its circuits, the positions of
+        the first gate and after the last gate of the node in these
+        circuits, the indices of the circuits ending at the node and its
+        number of branches
+    """
+    all_keys = [gate_sequence_keys(circuit) for circuit in circuits]
+
+    # Pending nodes: (circuit indices, depth)
+    nodes = [(list(range(len(circuits))), 0)]
+    while nodes:
+        indices, start = nodes.pop()
+
+        depth = start
+        first = indices[0]
+        while all(len(all_keys[index]) > depth and all_keys[index][depth] == all_keys[first][depth]
+                  for index in indices):
+            depth += 1
+
+        # splitting the circuits according to their next gate
+        finished = []
+        groups = {}
+        for index in indices:
+            if len(all_keys[index]) == depth:
+                finished.append(index)
+            else:
+                groups.setdefault(all_keys[index][depth], []).append(index)
 
+        yield indices, start, depth, finished, len(groups)
+        nodes.extend((group, depth) for group in reversed(list(groups.values())))
 
-def measure(state_vec, qubits, nb_samples=1):
+
+def shared_prefix_order(circuits):
+    """
+    Returns the order in which :func:`simulate_shared_prefixes` computes
+    the final states of circuits
+
+    Args:
+        circuits (list): a list of circuits (:class:`~qat.core.Circuit`)
+
+    Returns:
+        list: the indices of the circuits
+    """
+    return [index for node in prefix_tree(circuits) for index in node[3]]
+
+
+def simulate_shared_prefixes(circuits, fusion_width=0, matrix_cache=None, dtype=np.complex128,
+                             threads=0):
+    """
+    Computes the state vectors at the output of several circuits composed
+    of gates (see :func:`batch_signature`) acting on the same number of
+    qubits, simulating only once the gates they have in common at their
+    beginning.
+
+    Circuits are simulated as a tree (see :func:`prefix_tree`): the gates
+    shared by all the circuits are applied once, then the circuits are
+    split according to their next gate, and each group is simulated in the
+    same way from a copy of the state. Branches are explored depth first,
+    so that only one state per pending branching point is kept in memory:
+    this function is a generator, yielding each final state as soon as it
+    is computed (see :func:`shared_prefix_order`).
+
+    Args:
+        circuits (list): a list of circuits (:class:`~qat.core.Circuit`)
+        fusion_width (int, optional): see :func:`simulate`, gates being
+            fused within the nodes of the tree
+        matrix_cache (:class:`~qat.pylinalg.cache.LRUCache`, optional):
+            see :func:`simulate`
+        dtype (numpy.dtype, optional): see :func:`simulate`
+        threads (int, optional): see :func:`simulate`
+
+    Yields:
+        tuple: the indices of the circuits ending at some node of the tree,
+        and their final state vector (which is not modified afterwards)
+    """
+    if any(batch_signature(circuit) is None for circuit in circuits) or \
+            len({circuit.nbqbits for circuit in circuits}) > 1:
+        raise exceptions_types.QPUException(code=exceptions_types.ErrorType.INVALID_ARGS,
+                                            modulename="qat.pylinalg",
+                                            message="Only circuits composed of gates and acting on "
+                                                    "the same qubits can share their simulation")
+
+    gate_caches = [{} for _ in circuits]
+
+    # Initialization at |0...0>
+    nbqbits = circuits[0].nbqbits
+    state_vec = np.zeros((2,) * nbqbits, dtype=dtype)
+    state_vec[(0,) * nbqbits] = 1
+    scratch = allocate_scratch(state_vec)
+
+    def apply_gates(index, start, stop, state_vec):
+        def gate_info(op):
+            return get_gate_info(circuits[index], op.gate, gate_caches[index], matrix_cache, dtype)
+
+        ops = circuits[index].ops[start:stop]
+        steps = fuse_gates(ops, fusion_width, gate_info) if fusion_width > 1 else enumerate(ops)
+        for _, op in steps:
+            if isinstance(op, FusedGate):
+                apply_gate(state_vec, op.matrix, op.qbits, 0, scratch, op.structure, pool=pool)
+            else:
+                nctrls, matrix, structure = gate_info(op)
+                apply_gate(state_vec, matrix, op.qbits, nctrls, scratch, structure, pool=pool)
+
+    # States of the pending nodes of the tree: (state vector, copy the state?)
+    states = [(state_vec, False)]
+
+    pool = ChunkPool(threads) if threads > 1 else None
+    try:
+        for indices, start, depth, finished, nb_branches in prefix_tree(circuits):
+            state_vec, copy = states.pop()
+            if copy:
+                state_vec = state_vec.copy()
+
+            # applying the gates shared by all the circuits of the node
+            apply_gates(indices[0], start, depth, state_vec)
+            if finished:
+                yield finished, state_vec.copy() if nb_branches else state_vec
+
+            # the last branch to be explored reuses the state in place
+            states.extend((state_vec, k > 0) for k in range(nb_branches))
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def measure(state_vec, qubits, nb_samples=1, histogram=False):
     """
     Samples measurement results on the specified qubits.
 
     No projection is carried out ! See "project" function.
     Thanks to the absence of projection, several samples can be asked.
+    All the samples are drawn at once.
 
     Args:
         state_vec (numpy.ndarray): the :code:`numpy.ndarray`
@@ -189,10 +641,41 @@ def measure(state_vec, qubits, nb_samples=1):
             of qubits to measure.
         nb_samples (int, optional): the number of samples to return. Set to 1
             by default.
+        histogram (bool, optional): if set, samples are aggregated, and one
+            tuple is returned per distinct result. Default: False
 
     Returns:
         list: **intprob_list**, a list (of length nb_samples) containing tuples of the form (integer, probability). The integer is the result of the measurement on the subset of qubits (when converted to binary representation, it needs to have a width of len(qubits)). The probability is the probability the measurement had to occur. It is useful for renormalizing afterwards.
         In short: it is a list of samples. One sample is a (int, prob) tuple.
+        If :code:`histogram` is set, the list contains (integer, probability, count) tuples instead, sorted by integer, count being the number of samples equal to the integer.
+    """
+    probs = marginal_probabilities(state_vec, qubits)
+    cumul = np.cumsum(probs)  # cumulative distribution function.
+
+    # sampling. Scaling by the total probability protects against
+    # rounding errors (in particular in single precision)
+    res_ints = np.searchsorted(cumul, np.random.random(nb_samples) * cumul[-1])
+
+    if histogram:
+        res_ints, counts = np.unique(res_ints, return_counts=True)
+        return list(zip(res_ints.tolist(), probs[res_ints].tolist(), counts.tolist()))
+
+    return list(zip(res_ints.tolist(), probs[res_ints].tolist()))  # (int, prob) tuples
+
+
+def marginal_probabilities(state_vec, qubits):
+    """
+    Computes the probability distribution of the measurement results on
+    a subset of qubits.
+
+    Args:
+        state_vec (numpy.ndarray): the full state vector
+        qubits (list): list of integers specifying the subset of qubits
+
+    Returns:
+        numpy.ndarray: a flat array of probabilities, indexed by the
+        measured integer (the first qubit of the list being the most
+        significant bit)
     """
     probs = np.abs(state_vec**2)  # full probability vector
     all_qbs = [k for k in range(len(state_vec.shape))]
@@ -207,17 +690,30 @@ def measure(state_vec, qubits, nb_samples=1):
         probs = probs.swapaxes(target, cur)
         cur_inds[target], cur_inds[cur] =  cur_inds[cur], cur_inds[target]
 
-    cumul = np.cumsum(probs)  # cumulative distribution function.
+    return probs.ravel()
+
+
+def sample_counts(state_vec, qubits, nb_samples):
+    """
+    Samples measurement results on the specified qubits, and directly
+    returns the number of occurrences of each result. Counts are drawn
+    from a multinomial distribution, so that the cost only depends on the
+    number of possible results, and not on the number of samples.
 
-    intprob_list = []  # return object
-    for _ in range(nb_samples):
-        res_int = np.searchsorted(cumul, np.random.random())  # sampling
-        # index computation. Needed to access probability value.
-        str_bin_repr = np.binary_repr(res_int, width=len(qubits))
-        index = tuple([int(s) for s in str_bin_repr])
-        intprob_list.append((res_int, probs[index]))  # (int, prob) tuple
+    Args:
+        state_vec (numpy.ndarray): the full state vector
+        qubits (list): list of integers specifying the subset of qubits
+            to measure
+        nb_samples (int): the number of samples
 
-    return intprob_list
+    Returns:
+        (numpy.ndarray, numpy.ndarray): the distinct results (as integers,
+        in increasing order) and their number of occurrences
+    """
+    probs = marginal_probabilities(state_vec, qubits).astype(np.float64)
+    counts = np.random.multinomial(nb_samples, probs / probs.sum())
+    res_ints = np.flatnonzero(counts)
+    return res_ints, counts[res_ints]
 
 
 def project(state_vec, qubits, intprob):
@@ -287,7 +783,7 @@ def reset(state_vec, qubits):
               len(qubits)).
             - a float: probability the measurement had to occur.
     """
-    X = np.array([[0, 1], [1, 0]], dtype=np.complex128)  # X gate
+    X = np.array([[0, 1], [1, 0]], dtype=state_vec.dtype)  # X gate
 
     intprob_list = measure(state_vec, qubits)                # measure
     state_vec = project(state_vec, qubits, intprob_list[0])  # project
@@ -296,8 +792,7 @@ def reset(state_vec, qubits):
 
     for k, res in enumerate(str_bin_repr):
         if int(res) == 1:                                   # ? c[k] : X q[k]
-            state_vec = np.tensordot(X, state_vec, axes=([1], [qubits[k]]))
-            state_vec = np.moveaxis(state_vec, 0, qubits[k])
+            apply_gate(state_vec, X, [qubits[k]])
 
     return state_vec, intprob_list[0][0], intprob_list[0][1]
 
@@ -324,10 +819,13 @@ def raise_break(op, op_pos, cbits):
 def compute_observable_average(state_vec, observable):
     """Directly computes an observable average from a state vector.
 
-    For each term of the observable, the state vector is copied, tensored
-    with the appropriate Pauli matrices, and scalar-producted back with the
-    original state vector. The result is multiplied by the coefficient of the
-    Pauli term and added to the global result.
+    Each term of the observable is converted to a
+    :class:`~qat.pylinalg.pauli.PauliString`, and the expectation values of
+    all the terms are evaluated together by
+    :func:`~qat.pylinalg.pauli.pauli_expectations` (terms flipping the same
+    qubits share a single pass over the state vector). The results are
+    multiplied by the coefficients of the Pauli terms and added to the
+    global result.
 
     Args:
         state_vec (:class:`numpy.ndarray`) : The state vector, as returned
@@ -343,31 +841,47 @@ def compute_observable_average(state_vec, observable):
         on the state vector.
     """
 
-    if observable.constant_coeff:
-        final_value = observable.constant_coeff
-    else:
-        final_value = 0.
+    return compute_observable_averages(state_vec, [observable])[0]
+
+
+def compute_observable_averages(state_vec, observables):
+    """Computes the averages of several observables on the same state vector.
+
+    The terms of all the observables are evaluated together (see
+    :func:`compute_observable_average`), so that observables containing
+    terms flipping the same qubits share their passes over the state vector.
+
+    Args:
+        state_vec (:class:`numpy.ndarray`) : The state vector, as returned
+        by the "simulate" function.
 
+        observables (list): list of :class:`qat.core.Observable`
+
+    Returns:
+        list : the averages of the observables
+    """
     nbqbits = len(list(state_vec.shape)) # number of qubits
 
-    for term in observable.terms:
-        local_sv = np.copy(state_vec) # local copy of the state vector
+    paulis = [PauliString.from_term(term, nbqbits)
+              for observable in observables for term in observable.terms]
+    values = iter(pauli_expectations(state_vec, paulis))
+
+    averages = []
+    for observable in observables:
+        if observable.constant_coeff:
+            final_value = observable.constant_coeff
+        else:
+            final_value = 0.
 
-        for k, qb in enumerate(term.qbits):
-        # performing tensor products with Pauli matrices of the term.
-            pauli_matrix = pauli_dict[term.op[k]]
+        for term in observable.terms:
+            final_value += term.coeff * next(values)
 
-            # tensor products: exactly like gate applications in simulate func.
-            local_sv = np.tensordot(pauli_matrix, local_sv, axes=([1],[qb]))
-            local_sv = np.moveaxis(local_sv, [0], [qb])
+        averages.append(final_value)
 
-        # adding to final value, with coeff.
-        final_value += term.coeff * np.tensordot(state_vec.conj(), local_sv,
-                                                 axes=nbqbits)
+    return averages
 
-    return final_value
 
-def mat2nparray(matrix):
+def mat2nparray(matrix, dtype=np.complex128):
     """Converts serialized matrix format into numpy array.
 
     When extracted from the quantum circuit, gate matrices are not
@@ -377,6 +891,8 @@ def mat2nparray(matrix):
     Args:
         matrix (:code:`qat.comm.datamodel.ttypes.Matrix`): The matrix, as extracted
             from circuit operation, to convert to :code:`numpy.ndarray`
+        dtype (numpy.dtype, optional): dtype of the array. Default:
+            :code:`numpy.complex128`
 
     Returns:
         numpy.ndarray: a :code:`numpy.ndarray` of shape (2*arity,2*arity) containing
@@ -388,12 +904,9 @@ def mat2nparray(matrix):
         represented as matrices, we kept this step.
 
     """
-    A = np.zeros((matrix.nRows, matrix.nCols), dtype=np.complex128)
-    for cnt, (i, j) in enumerate(itertools.product(range(matrix.nRows),
-                                                   range(matrix.nCols))):
-        A[i, j] = matrix.data[cnt].re + 1j*matrix.data[cnt].im
-
-    return A
+    return np.fromiter((complex(elt.re, elt.im) for elt in matrix.data),
+                       dtype=dtype,
+                       count=matrix.nRows * matrix.nCols).reshape((matrix.nRows, matrix.nCols))
 
 pauli_dict = {}
 pauli_dict["X"] = np.array([[0.,1.],[1.,0.]])
@@ -21,6 +21,7 @@
 
 from qat.core.spins import integer_to_spins
 from .service import SimulatedAnnealing
+from .tempering import ParallelTempering
 
 
-__all__ = ["SimulatedAnnealing", "integer_to_spins"]
+__all__ = ["SimulatedAnnealing", "ParallelTempering", "integer_to_spins"]
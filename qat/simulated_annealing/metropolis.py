@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Metropolis engine of the simulated annealing.
+
+A sweep proposes to flip every spin once. Its random numbers are drawn at
+once and turned into Boltzmann thresholds: flipping a spin, changing the
+energy by :math:`\\Delta E`, is accepted with probability
+:math:`\\min(1, e^{-\\Delta E / T})`, i.e. iff
+:math:`\\Delta E < -T \\log r` for a uniform :math:`r`.
+
+Spins which are not coupled to each other can be updated at the same time:
+spins are partitioned into classes of uncoupled spins (by a greedy coloring
+of the coupling graph), each class being updated by a few numpy operations.
+A flip only updates the local fields of the neighbours of the spin, the
+coupling matrix being stored in a sparse (CSR) format: memory and the cost
+of a flip scale with the degrees of the spins. When classes are too small (e.g. dense
+couplings), spins are updated one after the other.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+# Minimal average size of the classes of uncoupled spins for them to be
+# updated at once
+MIN_CLASS_SIZE = 16
+
+# Number of random numbers drawn at once
+RANDOM_CHUNK = 1 << 16
+
+
+CSRMatrix = namedtuple("CSRMatrix", ["data", "indices", "indptr", "shape"])
+CSRMatrix.__doc__ = """
+Sparse matrix in compressed sparse row (CSR) format, with the attributes
+of :code:`scipy.sparse.csr_matrix`: the column indices and values of the
+nonzero entries of row :code:`i` are :code:`indices[indptr[i]:indptr[i + 1]]`
+and :code:`data[indptr[i]:indptr[i + 1]]`
+
+Attributes:
+    data (1D numpy array): the nonzero values, row by row
+    indices (1D numpy array): the (sorted) column indices of the values
+    indptr (1D numpy array): the bounds of the rows in :code:`data`
+    shape (tuple): the shape of the matrix
+"""
+
+
+def to_csr(J_coupling):
+    """
+    Converts a coupling matrix to the CSR format
+
+    Args:
+        J_coupling: a dense 2D numpy array, a :class:`CSRMatrix`, or any
+            CSR matrix with the same attributes (e.g.
+            :code:`scipy.sparse.csr_matrix`)
+
+    Returns:
+        :class:`CSRMatrix`: the matrix, without explicit zeros
+    """
+    if hasattr(J_coupling, "indptr"):
+        indptr = np.asarray(J_coupling.indptr)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        return csr_from_entries(rows, np.asarray(J_coupling.indices),
+                                np.asarray(J_coupling.data), J_coupling.shape[0])
+
+    J_coupling = np.asarray(J_coupling, dtype=np.float64)
+    rows, cols = np.nonzero(J_coupling)
+    return CSRMatrix(J_coupling[rows, cols], cols,
+                     np.searchsorted(rows, np.arange(len(J_coupling) + 1)), J_coupling.shape)
+
+
+def csr_from_entries(rows, cols, values, size):
+    """
+    Builds a square CSR matrix from its entries, the values of duplicate
+    entries being summed
+
+    Args:
+        rows (1D numpy array): the rows of the entries
+        cols (1D numpy array): the columns of the entries
+        values (1D numpy array): the values of the entries
+        size (int): the number of rows and columns
+
+    Returns:
+        :class:`CSRMatrix`: the matrix, without explicit zeros
+    """
+    keys = np.asarray(rows, dtype=np.int64) * size + np.asarray(cols, dtype=np.int64)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    data = np.bincount(inverse.ravel(), np.asarray(values, dtype=np.float64),
+                       minlength=len(keys))
+
+    nonzero = data != 0
+    keys, data = keys[nonzero], data[nonzero]
+    return CSRMatrix(data, keys % size, np.searchsorted(keys // size, np.arange(size + 1)),
+                     (size, size))
+
+
+class MetropolisEngine:
+    """
+    Metropolis sweeps for an Ising problem
+
+    Args:
+        J_coupling (2D numpy array or :class:`CSRMatrix`): the symmetric
+            coupling matrix, dense or sparse (see :func:`to_csr`)
+        h_mag (1D numpy array): the magnetic field
+    """
+
+    def __init__(self, J_coupling, h_mag):
+        self.n_spins = len(h_mag)
+        self.h_mag = np.asarray(h_mag, dtype=np.float64)
+
+        self.data, self.indices, self.indptr, _ = to_csr(J_coupling)
+
+        self.classes = color_classes(self.indptr, self.indices)
+        self.sequential = len(self.classes) * MIN_CLASS_SIZE > self.n_spins
+        if self.sequential:
+            # rows of dense couplings are updated as contiguous arrays
+            self._rows = None
+            if len(self.data) * MIN_CLASS_SIZE > self.n_spins ** 2:
+                self._rows = np.zeros((self.n_spins, self.n_spins))
+                self._rows[np.repeat(np.arange(self.n_spins), np.diff(self.indptr)),
+                           self.indices] = self.data
+            return
+
+        # Spins are reordered class by class, so that classes are slices
+        self._order = np.concatenate(self.classes) if self.classes else np.arange(0)
+        position = np.empty(self.n_spins, dtype=np.int64)
+        position[self._order] = np.arange(self.n_spins)
+
+        # Couplings of each class: bounds of the class, and for each coupling
+        # the position of its spin in the class, of its neighbour, and its
+        # value times -2 (the change of the local field of the neighbour)
+        self._class_couplings = []
+        start = 0
+        for spins in self.classes:
+            degrees = self.indptr[spins + 1] - self.indptr[spins]
+            entries = _row_entries(self.indptr, spins, degrees)
+            self._class_couplings.append((start, start + len(spins),
+                                          np.repeat(np.arange(len(spins)), degrees),
+                                          position[self.indices[entries]],
+                                          -2.0 * self.data[entries]))
+            start += len(spins)
+
+    def local_fields(self, spin_conf):
+        """
+        Returns the local fields :math:`h_i + \\sum_j J_{ij} s_j` of a spin
+        configuration, or of a stack of configurations (one per row)
+        """
+        rows = np.repeat(np.arange(self.n_spins), np.diff(self.indptr))
+        fields = np.zeros(spin_conf.shape)
+        np.add.at(fields, (Ellipsis, rows), spin_conf[..., self.indices] * self.data)
+        return self.h_mag + fields
+
+    def anneal(self, spin_conf, temp_list):
+        """
+        Runs one sweep per temperature, updating a spin configuration in
+        place
+
+        Args:
+            spin_conf (1D numpy array): the initial spin configuration
+            temp_list (list): the temperatures
+
+        Returns:
+            1D numpy array: the final spin configuration
+        """
+        local_h = self.local_fields(spin_conf)
+        if self.sequential:
+            for thresholds in _thresholds(temp_list, self.n_spins):
+                for sweep_thresholds in thresholds:
+                    self._sequential_sweep(spin_conf, local_h, sweep_thresholds)
+            return spin_conf
+
+        # flips are accepted iff s_i h_i < threshold / 2
+        order = self._order
+        spins, local_h = spin_conf[order].astype(np.float64), local_h[order]
+        for thresholds in _thresholds(temp_list, self.n_spins):
+            for sweep_thresholds in 0.5 * thresholds[:, order]:
+                self._class_sweep(spins, local_h, sweep_thresholds)
+        spin_conf[order] = spins
+        return spin_conf
+
+    def anneal_replicas(self, spin_confs, temp_list):
+        """
+        Runs one sweep per temperature on independent replicas at once,
+        each operation of a sweep acting on all the replicas
+
+        Args:
+            spin_confs (2D numpy array): the initial spin configurations,
+                one replica per row
+            temp_list (list): the temperatures
+
+        Returns:
+            2D numpy array: the final spin configurations (same object as
+            the input)
+        """
+        order = self._order if not self.sequential else np.arange(self.n_spins)
+        # C-contiguous, so that local fields can be updated through a flat view
+        spins = np.ascontiguousarray(spin_confs[:, order], dtype=np.float64)
+        local_h = np.ascontiguousarray(self.local_fields(spin_confs)[:, order])
+
+        # flips are accepted iff s_i h_i < threshold / 2
+        for thresholds in _thresholds(temp_list, spin_confs.size):
+            thresholds = thresholds.reshape((-1,) + spin_confs.shape)
+            for sweep_thresholds in 0.5 * thresholds[..., order]:
+                if self.sequential:
+                    self._sequential_replica_sweep(spins, local_h, sweep_thresholds)
+                else:
+                    self._class_replica_sweep(spins, local_h, sweep_thresholds)
+
+        spin_confs[:, order] = spins
+        return spin_confs
+
+    def sweep_replicas(self, spin_confs, temperatures):
+        """
+        Runs sweeps on independent replicas at once, each replica at its
+        own temperature, until the generator is closed. The temperatures
+        are read before each sweep, and can thus be exchanged between
+        replicas (e.g. by parallel tempering).
+
+        Args:
+            spin_confs (2D numpy array): the initial spin configurations,
+                one replica per row, holding the current configurations
+                whenever the generator yields
+            temperatures (1D numpy array): the temperature of each replica
+
+        Yields:
+            1D numpy array: the energies :math:`-\\frac{1}{2} s^T J s - h^T s`
+            of the replicas after each sweep
+        """
+        order = self._order if not self.sequential else np.arange(self.n_spins)
+        # C-contiguous, so that local fields can be updated through a flat view
+        spins = np.ascontiguousarray(spin_confs[:, order], dtype=np.float64)
+        local_h = np.ascontiguousarray(self.local_fields(spin_confs)[:, order])
+        h_mag = self.h_mag[order]
+
+        chunk = max(1, RANDOM_CHUNK // max(spin_confs.size, 1))
+        while True:
+            # random numbers are i.i.d., they are directly drawn for the reordered spins
+            with np.errstate(divide="ignore"):
+                log_randoms = np.log(np.random.rand(chunk, *spin_confs.shape))
+            for sweep_log_randoms in log_randoms:
+                half_thresholds = -0.5 * temperatures[:, np.newaxis] * sweep_log_randoms
+                if self.sequential:
+                    self._sequential_replica_sweep(spins, local_h, half_thresholds)
+                else:
+                    self._class_replica_sweep(spins, local_h, half_thresholds)
+
+                spin_confs[:, order] = spins
+                yield -0.5 * np.einsum("ij,ij->i", spins, local_h + h_mag)
+
+    def _sequential_replica_sweep(self, spins, local_h, half_thresholds):
+        """
+        Updates the spins of all the replicas one after the other
+        """
+        indptr, indices, data, rows = self.indptr, self.indices, self.data, self._rows
+        for spin in range(self.n_spins):
+            signs = spins[:, spin]
+            flips = signs * local_h[:, spin] < half_thresholds[:, spin]
+            if not np.count_nonzero(flips):
+                continue
+
+            changes = -2.0 * signs * flips
+            if rows is not None:
+                local_h += np.multiply.outer(changes, rows[spin])
+            else:
+                start, stop = indptr[spin], indptr[spin + 1]
+                local_h[:, indices[start:stop]] += np.multiply.outer(changes, data[start:stop])
+            signs[flips] *= -1
+
+    def _class_replica_sweep(self, spins, local_h, half_thresholds):
+        """
+        Updates the (reordered) spins of all the replicas class after class
+        """
+        offsets = np.arange(0, local_h.size, self.n_spins)[:, np.newaxis]
+        for start, stop, owners, neighbours, changes in self._class_couplings:
+            signs = spins[:, start:stop]
+            flips = signs * local_h[:, start:stop] < half_thresholds[:, start:stop]
+            if not np.count_nonzero(flips):
+                continue
+
+            np.add.at(local_h.reshape(-1), (offsets + neighbours).ravel(),
+                      ((signs * flips)[:, owners] * changes).ravel())
+            signs[flips] *= -1
+
+    def _sequential_sweep(self, spin_conf, local_h, thresholds):
+        """
+        Updates the spins one after the other
+        """
+        indptr, indices, data, rows = self.indptr, self.indices, self.data, self._rows
+        for spin, threshold in enumerate(thresholds.tolist()):
+            sign = int(spin_conf[spin])
+            if 2.0 * sign * local_h[spin] < threshold:
+                if rows is not None:
+                    local_h -= (2 * sign) * rows[spin]
+                else:
+                    start, stop = indptr[spin], indptr[spin + 1]
+                    local_h[indices[start:stop]] -= (2 * sign) * data[start:stop]
+                spin_conf[spin] = -sign
+
+    def _class_sweep(self, spins, local_h, half_thresholds):
+        """
+        Updates the (reordered) spins class after class
+        """
+        for start, stop, owners, neighbours, changes in self._class_couplings:
+            signs = spins[start:stop]
+            flips = signs * local_h[start:stop] < half_thresholds[start:stop]
+            if not np.count_nonzero(flips):
+                continue
+
+            np.add.at(local_h, neighbours, (signs * flips)[owners] * changes)
+            signs[flips] *= -1
+
+
+def _thresholds(temp_list, n_spins):
+    """
+    Draws the Boltzmann thresholds of the sweeps, by chunks of
+    :attr:`RANDOM_CHUNK` random numbers: a spin is flipped iff the energy
+    change is lower than its threshold. The random numbers are the ones
+    drawn by successive calls to :code:`numpy.random.rand(n_spins)`.
+
+    Yields:
+        2D numpy array: the thresholds of a chunk of sweeps, one row per
+        sweep
+    """
+    temps = np.asarray(temp_list, dtype=np.float64)
+    chunk = max(1, RANDOM_CHUNK // max(n_spins, 1))
+    for start in range(0, len(temps), chunk):
+        randoms = np.random.rand(len(temps[start:start + chunk]), n_spins)
+        with np.errstate(divide="ignore"):
+            yield -temps[start:start + chunk, np.newaxis] * np.log(randoms)
+
+
+def color_classes(indptr, indices):
+    """
+    Partitions the spins into classes of spins which are not coupled to
+    each other, by a greedy coloring of the coupling graph.
+
+    Args:
+        indptr (1D numpy array): CSR row pointers of the coupling matrix
+        indices (1D numpy array): CSR column indices of the coupling matrix
+
+    Returns:
+        list: the classes, as arrays of spins
+    """
+    n_spins = len(indptr) - 1
+    colors = np.full(n_spins, -1, dtype=np.int64)
+    indptr, indices = indptr.tolist(), indices.tolist()
+    color_list = colors.tolist()
+    for spin in range(n_spins):
+        used = {color_list[neighbour] for neighbour in indices[indptr[spin]:indptr[spin + 1]]}
+        color = 0
+        while color in used:
+            color += 1
+        color_list[spin] = color
+
+    colors[:] = color_list
+    order = np.argsort(colors, kind="stable")
+    bounds = np.searchsorted(colors[order], np.arange(colors.max(initial=-1) + 2))
+    return [order[bounds[color]:bounds[color + 1]] for color in range(len(bounds) - 1)]
+
+
+def _row_entries(indptr, rows, degrees):
+    """
+    Returns the positions, in the CSR arrays, of the entries of some rows
+    """
+    starts = np.repeat(indptr[rows] - np.cumsum(degrees) + degrees, degrees)
+    return starts + np.arange(degrees.sum())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Compilation of temperature schedules: evaluating an
+:class:`~qat.core.variables.ArithExpression` walks its tree for every time
+step, while the compiled schedule evaluates each node once, on the array of
+all the time steps.
+"""
+
+import numpy as np
+
+from qat.core.variables import ArithExpression, Variable
+
+
+def _heaviside(value, start, stop):
+    """
+    1 on [start, stop), 0 elsewhere (as :func:`qat.core.variables.heaviside`)
+    """
+    return np.where((value >= start) & (value < stop), 1, 0)
+
+
+# numpy counterparts of the symbols of qat.core.variables
+NUMPY_FUNCTIONS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "**": np.power,
+    "UMINUS": np.negative,
+    "cos": np.cos,
+    "sin": np.sin,
+    "exp": np.exp,
+    "sqrt": np.sqrt,
+    "ln": np.log,
+    "abs": np.abs,
+    "real": np.real,
+    "imag": np.imag,
+    "angle": np.angle,
+    "conjugate": np.conjugate,
+    "max": np.maximum,
+    "atan2": np.arctan2,
+    "heaviside": _heaviside,
+}
+
+
+def compile_expression(expression, variable="t"):
+    """
+    Compiles an arithmetic expression of a single variable into a function
+    evaluating it on an array of values at once.
+
+    Expressions containing a symbol without numpy counterpart are evaluated
+    value by value.
+
+    Args:
+        expression (:class:`~qat.core.variables.ArithExpression`): the
+            expression
+        variable (str, optional): the name of the variable. Default: "t"
+
+    Returns:
+        callable: a function of a 1D numpy array returning the values of
+        the expression, as a numpy array of the same shape
+    """
+    def compile_node(node):
+        if isinstance(node, Variable):
+            if node.name != variable:
+                raise KeyError(node.name)
+            return lambda values: values
+        if not isinstance(node, ArithExpression):
+            return lambda values: node
+
+        function = NUMPY_FUNCTIONS[node.symbol.token]
+        children = [compile_node(child) for child in node.children]
+        return lambda values: function(*(child(values) for child in children))
+
+    try:
+        compiled = compile_node(expression)
+    except KeyError:
+        return lambda values: np.array([expression(**{variable: value})
+                                        for value in np.asarray(values).tolist()])
+
+    return lambda values: np.broadcast_to(compiled(np.asarray(values)), np.shape(values))
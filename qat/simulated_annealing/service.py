@@ -20,6 +20,8 @@
 """
 
 import inspect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 from qat.comm.shared.ttypes import ProcessingType
@@ -29,6 +31,12 @@ from qat.core.spins import spins_to_integer
 from qat.core.variables import ArithExpression
 from qat.core.wrappers.result import Sample, Result, aggregate_data
 from qat.lang.AQASM.bits import QRegister
+from .metropolis import MetropolisEngine, to_csr, csr_from_entries
+from .schedule import compile_expression
+
+# Number of temperature arrays cached per QPU, one per (tmax, n_steps), the
+# least recently used being evicted first
+TEMPERATURE_CACHE_SIZE = 16
 
 
 class SimulatedAnnealing(QPUHandler):
@@ -40,9 +48,17 @@ class SimulatedAnnealing(QPUHandler):
             a variable :code:`t` instantiated with the class :class:`~qat.core.Variable`.
         n_steps (int): number of annealing time steps in Temp(t) evolution.
         seed (int, optional): Randomness seed.
+        vectorized (bool, optional): if True, the :code:`nbshots` replicas of
+            a job are annealed at once, each operation of a Metropolis sweep
+            acting on all the replicas. The seed is then used once per job
+            instead of once per shot. Default: False
+        workers (int, optional): if larger than 1, the replicas of a job are
+            split across this number of processes, each one annealing its
+            replicas at once with its own random stream (spawned from the
+            seed). Default: 0 (no process)
     """
 
-    def __init__(self, temp_t, n_steps, seed=None):
+    def __init__(self, temp_t, n_steps, seed=None, vectorized=False, workers=0):
 
         # Check that the temp_t is given, of the right type and containing
         # only one Variable, which is 't'.
@@ -62,6 +78,8 @@ class SimulatedAnnealing(QPUHandler):
 
         # If no errors were detected, assign temp_t
         self.temp_t = temp_t
+        self._temperature = compile_expression(temp_t)
+        self.temperature_cache = OrderedDict()
 
         # Check if a positive n_steps was given
         if n_steps is None:
@@ -77,6 +95,11 @@ class SimulatedAnnealing(QPUHandler):
                 raise ValueError("Please use a positive integer seed.")
         self.seed = seed
 
+        if workers < 0:
+            raise ValueError("The number of workers should be a positive integer.")
+        self.vectorized = vectorized
+        self.workers = workers
+
         super(SimulatedAnnealing, self).__init__() # calls QPUHandler __init__()
 
     def submit_job(self, job):
@@ -90,58 +113,30 @@ class SimulatedAnnealing(QPUHandler):
             result (:class:`~qat.core.Result`): a result with the solution spin configuration(s)
         """
 
-        # Check if an observable is present and one can extract the Ising tuple from it.
-        if job.type == ProcessingType.OBSERVABLE:
-            raise QPUException(ErrorType.INVALID_ARGS,
-                                                'qat.simulated_annealing',
-                                                "invalid job type, only accepting SAMPLE")
-
-        if job.schedule is None:
-            raise QPUException(ErrorType.INVALID_ARGS,
-                               modulename='qat.simulated_annealing',
-                               message="invalid job, only accepting Schedules")
-
-#         if job.schedule.gamma_t is not None:
-#             raise QPUException(ErrorType.INVALID_ARGS,
-#                                'qat.simulated_annealing',
-#                                "An SA QPU was called, but the job contains gamma_t, "
-#                                "which can only be used with an SQA solver, available "
-#                                "in the full QLM.")
-
-        drive = job.schedule.drive
-        if job.schedule.drive is None:
-            raise QPUException(ErrorType.INVALID_ARGS,
-                               'qat.simulated_annealing',
-                               "no drive detected, which should contain an Ising observable.")
-
-        if len(drive) != 1 or drive[0][0] != 1:
-            raise QPUException(ErrorType.INVALID_ARGS,
-                               'qat.simulated_annealing',
-                               "the drive should contain only one Observable with "
-                               "an Ising tuple and coefficient 1.")
-
         # Extract the Ising parameters and tmax
-        J_coupling, h_mag, offset = extract_j_and_h_from_obs(drive[0][1])
-        tmax = job.schedule.tmax
-
-        # Specify the list of annealing times
-        time_list = np.linspace(0, tmax, int(self.n_steps))
-
-        # Produce the temperatures at the annealing times
-        if "Expression" in str(type(self.temp_t)):
-            temp_list = [self.temp_t(t=t) for t in time_list]
-        else:
-            temp_list = [self.temp_t for t in time_list]
+        J_coupling, h_mag, offset = extract_j_and_h_from_obs(get_ising_observable(job),
+                                                             sparse=True)
+        temp_list = self.temperatures(job.schedule.tmax)
 
         # Will appeand QRegister to the result for proper dealing with the states
         qreg = QRegister(0, length=job.schedule.nbqbits)
 
         # Now give all the annealing parameters to the sa solver and get an answer
-        sample_list = []
-        for shot in range(job.nbshots):
-
-            solution_configuration = self.sa(J_coupling, h_mag, temp_list)
+        if self.workers > 1 and job.nbshots > 1:
+            solution_configurations = self._anneal_parallel(J_coupling, h_mag, temp_list,
+                                                            job.nbshots)
+        elif self.vectorized:
+            if self.seed is not None:
+                np.random.seed(self.seed)
+            solution_configurations = anneal_replicas((J_coupling, h_mag, temp_list,
+                                                       job.nbshots, None))
+        else:
+            engine = MetropolisEngine(J_coupling, h_mag)
+            solution_configurations = (self._anneal(engine, temp_list)
+                                       for shot in range(job.nbshots))
 
+        sample_list = []
+        for solution_configuration in solution_configurations:
             state_int = spins_to_integer(solution_configuration)
             sample_list.append(Sample(state=state_int))
 
@@ -159,8 +154,9 @@ class SimulatedAnnealing(QPUHandler):
         The algorithm implementing simulated annealing.
         
         Args:
-            J (2D numpy array): an array with the coupling between each two spins - it represents
-              the :math:`J` matrix from the Hamiltonian of the problem
+            J (2D numpy array or :class:`~qat.simulated_annealing.metropolis.CSRMatrix`): an
+              array with the coupling between each two spins - it represents the :math:`J`
+              matrix from the Hamiltonian of the problem, dense or sparse
             h (1D numpy array): an array with the magnetic field acting on each of the spins,
               coming from the Hamiltonian of the problem
             temp_t (:class:`~qat.core.variables.ArithExpression`): temperature-time dependence. It needs to be specified using
@@ -170,26 +166,135 @@ class SimulatedAnnealing(QPUHandler):
             1D numpy array: an array representing the solution spin configuration after the simulated annealing
         """
 
+        n_spins = len(h_mag)
+        assert J_coupling.shape[0] == n_spins
+
+        return self._anneal(MetropolisEngine(J_coupling, h_mag), temp_list)
+
+    def temperatures(self, tmax):
+        """
+        Returns the temperatures of the annealing steps, evaluated at once
+        by the compiled temperature function and cached per
+        (:code:`tmax`, :code:`n_steps`)
+
+        Args:
+            tmax (float): the annealing time
+
+        Returns:
+            1D numpy array: the (read-only) temperatures
+        """
+        key = (tmax, int(self.n_steps))
+        temp_list = self.temperature_cache.get(key)
+        if temp_list is not None:
+            self.temperature_cache.move_to_end(key)
+            return temp_list
+
+        temp_list = np.array(self._temperature(np.linspace(0, tmax, key[1])))
+        temp_list.setflags(write=False)
+        self.temperature_cache[key] = temp_list
+        if len(self.temperature_cache) > TEMPERATURE_CACHE_SIZE:
+            self.temperature_cache.popitem(last=False)
+        return temp_list
+
+    def _anneal_parallel(self, J_coupling, h_mag, temp_list, nbshots):
+        """
+        Anneals replicas in a pool of :code:`workers` processes, each
+        process having its own random stream
+
+        Returns:
+            2D numpy array: the final spin configurations, one per row
+        """
+        seeds = np.random.SeedSequence(self.seed).spawn(self.workers)
+        sizes = [len(chunk) for chunk in np.array_split(np.arange(nbshots), self.workers)]
+        tasks = [(J_coupling, h_mag, temp_list, size, seed)
+                 for size, seed in zip(sizes, seeds) if size]
+
+        with ProcessPoolExecutor(len(tasks)) as pool:
+            return np.concatenate(list(pool.map(anneal_replicas, tasks)))
+
+    def _anneal(self, engine, temp_list):
+        """
+        Runs simulated annealing from a random spin configuration, with the
+        Metropolis sweeps of an engine (see
+        :class:`~qat.simulated_annealing.metropolis.MetropolisEngine`)
+        """
         if self.seed is not None:
             np.random.seed(self.seed)
 
-        n_spins = len(h_mag)
-        assert len(J_coupling) == n_spins
+        spin_conf = np.random.choice([1, -1], engine.n_spins)
+        return engine.anneal(spin_conf, temp_list)
+
+
+def anneal_replicas(task):
+    """
+    Anneals replicas at once from random spin configurations (see
+    :meth:`~qat.simulated_annealing.metropolis.MetropolisEngine.anneal_replicas`),
+    e.g. in a worker process of :class:`SimulatedAnnealing`
 
-        spin_conf = np.random.choice([1, -1], n_spins)
-        local_h = h_mag + J_coupling @ spin_conf
-        for temp in temp_list:
-            for spin in range(n_spins):
-                delta_E = 2.0 * spin_conf[spin] * local_h[spin]
-                flip_prob = 1.0 if (delta_E < 0) else np.exp(-delta_E / temp)
-                if (np.random.rand() < flip_prob):
-                    local_h -= 2 * spin_conf[spin] * J_coupling[spin, :]
-                    spin_conf[spin] *= -1
+    Args:
+        task (tuple): the coupling matrix, the magnetic field, the
+            temperatures, the number of replicas, and the
+            :class:`numpy.random.SeedSequence` of the random stream (or None
+            to keep the current one)
+
+    Returns:
+        2D numpy array: the final spin configurations, one per row
+    """
+    J_coupling, h_mag, temp_list, nb_replicas, seed = task
+    if seed is not None:
+        np.random.seed(seed.generate_state(1)[0])
 
-        return spin_conf 
+    engine = MetropolisEngine(J_coupling, h_mag)
+    spin_confs = np.random.choice([1, -1], (nb_replicas, engine.n_spins))
+    return engine.anneal_replicas(spin_confs, temp_list)
 
 
-def extract_j_and_h_from_obs(obs):
+def get_ising_observable(job):
+    """
+    Checks that a job can be solved by an annealer, i.e. is a sampling job
+    whose schedule drive contains a single Ising observable with
+    coefficient 1
+
+    Args:
+        job (:class:`~qat.core.Job`): the job
+
+    Returns:
+        :class:`~qat.core.Observable`: the Ising observable
+    """
+    # Check if an observable is present and one can extract the Ising tuple from it.
+    if job.type == ProcessingType.OBSERVABLE:
+        raise QPUException(ErrorType.INVALID_ARGS,
+                           'qat.simulated_annealing',
+                           "invalid job type, only accepting SAMPLE")
+
+    if job.schedule is None:
+        raise QPUException(ErrorType.INVALID_ARGS,
+                           modulename='qat.simulated_annealing',
+                           message="invalid job, only accepting Schedules")
+
+#     if job.schedule.gamma_t is not None:
+#         raise QPUException(ErrorType.INVALID_ARGS,
+#                            'qat.simulated_annealing',
+#                            "An SA QPU was called, but the job contains gamma_t, "
+#                            "which can only be used with an SQA solver, available "
+#                            "in the full QLM.")
+
+    drive = job.schedule.drive
+    if job.schedule.drive is None:
+        raise QPUException(ErrorType.INVALID_ARGS,
+                           'qat.simulated_annealing',
+                           "no drive detected, which should contain an Ising observable.")
+
+    if len(drive) != 1 or drive[0][0] != 1:
+        raise QPUException(ErrorType.INVALID_ARGS,
+                           'qat.simulated_annealing',
+                           "the drive should contain only one Observable with "
+                           "an Ising tuple and coefficient 1.")
+
+    return drive[0][1]
+
+
+def extract_j_and_h_from_obs(obs, sparse=False):
     r"""
     A function to extract the :math:`J` coupling matrix, magnetic field
     :math:`h` and Ising energy offset :math:`E_I` from the Hamiltonian of an Ising 
@@ -203,11 +308,14 @@ def extract_j_and_h_from_obs(obs):
 
     Args:
         obs (:class:`~qat.core.Observable`): an observable for an Ising problem
+        sparse (bool, optional): if True, :math:`J` is returned as a
+            :class:`~qat.simulated_annealing.metropolis.CSRMatrix`, whose
+            size scales with the number of couplings. Default: False
 
     Returns:
         3-element tuple containing
 
-        - **J** (*2D numpy array*) - an array with the coupling between each two spins - it
+        - **J** (*2D numpy array or CSRMatrix*) - an array with the coupling between each two spins - it
           represents the :math:`J` matrix from the Hamiltonian of the problem
         - **h** (*1D numpy array*) - an array with the magnetic field acting on each of the
           spins, coming from the Hamiltonian of the problem
@@ -216,11 +324,12 @@ def extract_j_and_h_from_obs(obs):
     """
     # The matrices of the observable defined in Ising representation should be retrieved directly from _ising
     if obs._ising is not None:
-        return obs._ising.get_j_h_and_offset()
+        J_coupling, h_mag, offset = obs._ising.get_j_h_and_offset()
+        return (to_csr(J_coupling) if sparse else J_coupling), h_mag, offset
 
     nqbits = obs.nbqbits
     h_mag = np.zeros(nqbits)
-    J_coupling = np.zeros((nqbits, nqbits))
+    couplings = dict()
 
     for term in obs.terms:
         if len(term.qbits) == 1:
@@ -228,7 +337,7 @@ def extract_j_and_h_from_obs(obs):
             h_mag[term.qbits[0]] = -term.coeff
         elif len(term.qbits) == 2:
             assert(term.op == "ZZ")
-            J_coupling[term.qbits[0], term.qbits[1]] = -term.coeff
+            couplings[term.qbits[0], term.qbits[1]] = -term.coeff
         else:
             current_line_no = inspect.stack()[0][2]
             raise QPUException(ErrorType.INVALID_ARGS,
@@ -237,4 +346,15 @@ def extract_j_and_h_from_obs(obs):
                                        "accepting terms of type 'Z' or 'ZZ', "
                                        "got %s instead" % term)
 
+    if sparse:
+        # J + J^T, from the entries (i, j) and (j, i) of each coupling
+        rows, cols = np.array(list(couplings), dtype=np.int64).reshape(-1, 2).T
+        values = np.array(list(couplings.values()), dtype=np.float64)
+        J_coupling = csr_from_entries(np.concatenate([rows, cols]), np.concatenate([cols, rows]),
+                                      np.concatenate([values, values]), nqbits)
+        return J_coupling, h_mag, -obs.constant_coeff
+
+    J_coupling = np.zeros((nqbits, nqbits))
+    for (i, j), value in couplings.items():
+        J_coupling[i, j] = value
     return 1.0 * (J_coupling + J_coupling.T), h_mag, -obs.constant_coeff
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Parallel tempering (replica exchange): replicas of the Ising problem are
+sampled by Metropolis sweeps at the temperatures of a ladder, and replicas
+at neighbouring temperatures periodically exchange their temperatures, so
+that configurations trapped in a local minimum at low temperature can
+escape it at high temperature.
+"""
+
+import json
+import numpy as np
+
+from qat.core.qpu import QPUHandler
+from qat.core.spins import spins_to_integer
+from qat.core.wrappers.result import Sample, Result, aggregate_data
+from qat.lang.AQASM.bits import QRegister
+from .metropolis import MetropolisEngine
+from .service import get_ising_observable, extract_j_and_h_from_obs
+
+
+class ParallelTempering(QPUHandler):
+    """
+    A parallel tempering solver interfaced as a Quantum Processing Unit
+    (QPU): each shot of a job runs one replica per temperature of a ladder,
+    all the replicas of all the shots being swept at once (see
+    :meth:`~qat.simulated_annealing.metropolis.MetropolisEngine.sweep_replicas`),
+    and returns the lowest energy configuration found by its replicas.
+
+    Every :code:`swap_interval` sweeps, the replicas at neighbouring
+    temperatures :math:`T_k < T_{k+1}` (even or odd pairs, alternately)
+    exchange their temperatures with probability
+    :math:`\\min(1, e^{(1/T_k - 1/T_{k+1})(E_k - E_{k+1})})`.
+
+    The metadata of the results contain, as JSON lists indexed by the
+    :code:`"temperatures"` of the ladder, the :code:`"flip_acceptance"` rate
+    of the Metropolis moves, and the :code:`"swap_acceptance"` rate of the
+    exchanges with the next temperature.
+
+    Args:
+        temperatures (list): the temperature ladder, of positive
+            temperatures
+        n_sweeps (int): number of sweeps of each replica
+        swap_interval (int, optional): number of sweeps between two
+            exchange steps. Default: 1
+        seed (int, optional): Randomness seed, used once per job
+    """
+
+    def __init__(self, temperatures, n_sweeps, swap_interval=1, seed=None):
+        temperatures = np.sort(np.asarray(temperatures, dtype=np.float64))
+        if temperatures.ndim != 1 or not len(temperatures) or temperatures[0] <= 0:
+            raise ValueError("The temperatures should be a list of positive numbers.")
+        self.temperatures = temperatures
+
+        if n_sweeps is None or n_sweeps < 0:
+            raise ValueError("The number of sweeps should be specified and as a positive integer.")
+        self.n_sweeps = n_sweeps
+
+        if swap_interval < 1:
+            raise ValueError("The swap interval should be a positive integer.")
+        self.swap_interval = swap_interval
+
+        if seed is not None and seed < 0:
+            raise ValueError("Please use a positive integer seed.")
+        self.seed = seed
+
+        super(ParallelTempering, self).__init__()
+
+    def submit_job(self, job):
+        """
+        Execute parallel tempering for a given job.
+
+        Args:
+            job (:class:`~qat.core.Job`): the job to execute
+
+        Returns:
+            result (:class:`~qat.core.Result`): a result with the solution spin configuration(s)
+        """
+        J_coupling, h_mag, _ = extract_j_and_h_from_obs(get_ising_observable(job), sparse=True)
+        engine = MetropolisEngine(J_coupling, h_mag)
+
+        if self.seed is not None:
+            np.random.seed(self.seed)
+
+        nb_temps, nb_runs = len(self.temperatures), job.nbshots
+        runs = np.arange(nb_runs)[:, np.newaxis]
+        # replica k of run r is the row r * nb_temps + k, at the temperature slots[r, k]
+        slots = np.tile(np.arange(nb_temps), (nb_runs, 1))
+        replicas = slots.copy()
+        temperatures = self.temperatures[slots].ravel()
+
+        spin_confs = np.random.choice([1, -1], (nb_runs * nb_temps, engine.n_spins))
+        best_confs = spin_confs[::nb_temps].copy()
+        best_energies = np.full(nb_runs, np.inf)
+
+        flips = np.zeros((nb_runs, nb_temps), dtype=np.int64)
+        swaps = np.zeros(max(nb_temps - 1, 0), dtype=np.int64)
+        previous_confs = spin_confs.copy()
+
+        sweeps = engine.sweep_replicas(spin_confs, temperatures)
+        for sweep, energies in zip(range(self.n_sweeps), sweeps):
+            flips[runs, slots] += np.count_nonzero(spin_confs != previous_confs, axis=1) \
+                .reshape(nb_runs, nb_temps)
+            previous_confs[...] = spin_confs
+
+            energies = energies.reshape(nb_runs, nb_temps)
+            lowest = energies.argmin(axis=1)
+            improved = np.flatnonzero(energies[runs[:, 0], lowest] < best_energies)
+            best_energies[improved] = energies[improved, lowest[improved]]
+            best_confs[improved] = spin_confs[improved * nb_temps + lowest[improved]]
+
+            if (sweep + 1) % self.swap_interval == 0:
+                self._exchange(energies, slots, replicas, swaps, sweep // self.swap_interval)
+                temperatures[...] = self.temperatures[slots].ravel()
+        sweeps.close()
+
+        sample_list = [Sample(state=spins_to_integer(conf)) for conf in best_confs]
+        nb_swap_steps = self.n_sweeps // self.swap_interval
+        nb_attempts = np.array([len(range(k % 2, nb_swap_steps, 2)) for k in range(nb_temps - 1)])
+        flip_acceptance = flips.sum(axis=0) / max(nb_runs * self.n_sweeps * engine.n_spins, 1)
+        swap_acceptance = swaps / np.maximum(nb_attempts * nb_runs, 1)
+        meta_data = dict(
+            temperatures=json.dumps(self.temperatures.tolist()),
+            flip_acceptance=json.dumps(flip_acceptance.tolist()),
+            swap_acceptance=json.dumps(swap_acceptance.tolist()),
+        )
+
+        result = Result(raw_data=sample_list,
+                        qregs=[QRegister(0, length=job.schedule.nbqbits)],
+                        meta_data=meta_data)
+        if job.aggregate_data:
+            result = aggregate_data(result)
+        return result
+
+    def _exchange(self, energies, slots, replicas, swaps, step):
+        """
+        Exchanges the temperatures of replicas at neighbouring temperatures,
+        the even pairs of temperatures at even steps and the odd pairs at
+        odd steps
+
+        Args:
+            energies (2D numpy array): the energies of the replicas, one
+                row per run
+            slots (2D numpy array): the temperature index of each replica,
+                updated in place
+            replicas (2D numpy array): the replica at each temperature
+                index, updated in place
+            swaps (1D numpy array): the number of accepted exchanges of
+                each pair of temperatures, updated in place
+            step (int): the index of the exchange step
+        """
+        runs = np.arange(len(energies))[:, np.newaxis]
+        lower = np.arange(step % 2, len(self.temperatures) - 1, 2)
+        if not len(lower):
+            return
+
+        betas = 1. / self.temperatures
+        slot_energies = energies[runs, replicas]
+        delta = (betas[lower] - betas[lower + 1]) \
+            * (slot_energies[:, lower] - slot_energies[:, lower + 1])
+        accepted = np.random.rand(*delta.shape) < np.exp(np.minimum(delta, 0.))
+        swaps[lower] += np.count_nonzero(accepted, axis=0)
+
+        run_idx, pair_idx = np.nonzero(accepted)
+        low, high = lower[pair_idx], lower[pair_idx] + 1
+        replicas[run_idx, low], replicas[run_idx, high] = \
+            replicas[run_idx, high], replicas[run_idx, low]
+        slots[run_idx, replicas[run_idx, low]] = low
+        slots[run_idx, replicas[run_idx, high]] = high
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Fixtures shared by the unit tests
+"""
+
+import pytest
+from qat.lang.AQASM import Program, H, RX, RY, CNOT, CCNOT, SWAP
+
+
+def generate_circuit(nbqbits):
+    """
+    Generates an entangling circuit acting on all the qubits
+    """
+    prog = Program()
+    qbits = prog.qalloc(nbqbits)
+    for qb in range(nbqbits):
+        prog.apply(H, qbits[qb])
+        prog.apply(RY(0.2 * qb + 0.1), qbits[qb])
+    for qb in range(nbqbits - 1):
+        prog.apply(CNOT, qbits[qb], qbits[qb + 1])
+        prog.apply(RX(0.3 * qb).ctrl(), qbits[nbqbits - 1 - qb], qbits[qb])
+    prog.apply(CCNOT, qbits[0], qbits[nbqbits - 1], qbits[1])
+    prog.apply(SWAP, qbits[0], qbits[nbqbits - 2])
+    return prog.to_circ()
+
+
+@pytest.fixture
+def entangling_circuit():
+    """
+    Returns a function generating an entangling circuit acting on all the
+    qubits, of a given number of qubits
+    """
+    return generate_circuit
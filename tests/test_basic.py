@@ -21,6 +21,7 @@ import os
 import unittest
 import numpy as np
 import glob
+from thrift.TSerialization import serialize
 
 import qat.comm.exceptions.ttypes as exception_types
 from qat.core.task import Task
@@ -127,6 +128,38 @@ class TestSimpleCircExec(unittest.TestCase):
         self.assertTrue(result.raw_data[0].state.int in [0,1])
         self.assertTrue(result.raw_data[1].state.int in [0,1])
 
+    def test_compact_output(self):
+
+        # Create a small program
+        prog = Program()
+        qubits = prog.qalloc(3)
+        prog.apply(H, qubits[0])
+        prog.apply(CNOT, qubits[:2])
+        prog.apply(T, qubits[1])
+        prog.apply(X, qubits[2])
+
+        circ = prog.to_circ()
+
+        for qbits in [None, [2, 0, 1], [1, 2]]:
+            job = circ.to_job(qubits=qbits, amp_threshold=0.1)
+            expected = PyLinalg().submit_job(job)
+            result = PyLinalg(compact_output=True).submit_job(job)
+
+            self.assertEqual(len(result.raw_data), 0)
+            self.assertEqual(list(result.distribution["states"]),
+                             [sample.state.int for sample in expected])
+            np.testing.assert_allclose(result.distribution["probabilities"],
+                                       [sample.probability for sample in expected])
+            if qbits is not None and len(qbits) < 3:
+                self.assertNotIn("amplitudes", result.distribution)
+            else:
+                np.testing.assert_allclose(result.distribution["amplitudes"],
+                                           [sample.amplitude for sample in expected])
+
+            # The meta data only contain strings, so the result can be serialized
+            self.assertTrue(all(isinstance(value, str) for value in result.meta_data.values()))
+            serialize(result)
+
     def test_normal_launch_mode_with_nbshots(self):
 
         # Create a small program
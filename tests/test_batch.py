@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the simulation of batches of circuits
+"""
+
+import os
+import pytest
+import numpy as np
+from qat.comm.exceptions.ttypes import QPUException
+from qat.core import Batch, Observable, Term
+from qat.lang.AQASM import Program, H, RX, RY, RZ, CNOT, X
+from qat.pylinalg import PyLinalg, service, simulator
+from qat.pylinalg.kernels import apply_gate
+from qat.pylinalg.simulator import simulate, simulate_batch, simulate_shared_prefixes, batch_signature
+
+
+def generate_ansatz(angles, bases=""):
+    """
+    Generates a hardware-efficient ansatz for the given angles, followed
+    by rotations towards the given measurement bases
+    """
+    prog = Program()
+    qbits = prog.qalloc(4)
+    for layer in range(2):
+        for qb in range(4):
+            prog.apply(RY(angles[2 * qb + layer]), qbits[qb])
+            prog.apply(RZ(angles[2 * qb + layer] / 2), qbits[qb])
+        for qb in range(3):
+            prog.apply(CNOT, qbits[qb], qbits[qb + 1])
+        prog.apply(RX(angles[0]).ctrl(), qbits[3], qbits[0])
+    for qb, basis in enumerate(bases):
+        if basis == "X":
+            prog.apply(H, qbits[qb])
+        elif basis == "Y":
+            prog.apply(RX(np.pi / 2), qbits[qb])
+    return prog.to_circ()
+
+
+@pytest.mark.parametrize("fusion_width", [0, 3])
+def test_simulate_batch(fusion_width):
+    """
+    Checks that a stack of states is equal to states simulated one by one
+    """
+    rng = np.random.default_rng(0)
+    circuits = [generate_ansatz(rng.uniform(0, 6, size=8)) for _ in range(5)]
+
+    assert len({batch_signature(circ) for circ in circuits}) == 1
+
+    state_vecs = simulate_batch(circuits, fusion_width=fusion_width)
+    assert state_vecs.shape == (5,) + (2,) * 4
+
+    for circ, state_vec in zip(circuits, state_vecs):
+        expected, _ = simulate(circ)
+        assert np.allclose(state_vec, expected)
+
+
+def test_simulate_batch_invalid():
+    """
+    Checks that circuits with different structures are rejected
+    """
+    prog = Program()
+    qbits = prog.qalloc(4)
+    prog.apply(H, qbits[0])
+    prog.apply(CNOT, qbits[0], qbits[2])
+    other = prog.to_circ()
+
+    with pytest.raises(QPUException):
+        simulate_batch([generate_ansatz(np.zeros(8)), other])
+
+    # Measures can't be batched
+    prog.measure(qbits[0])
+    assert batch_signature(prog.to_circ()) is None
+
+
+def test_batch_mode():
+    """
+    Checks that PyLinalg in batch mode returns the same results
+    """
+    rng = np.random.default_rng(1)
+    obs = Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1]), Term(0.5, "X", [3])])
+
+    jobs = []
+    for _ in range(7):
+        circ = generate_ansatz(rng.uniform(0, 6, size=8))
+        jobs.append(circ.to_job())
+        jobs.append(circ.to_job("OBS", observable=obs))
+
+    # A job with another structure
+    prog = Program()
+    qbits = prog.qalloc(2)
+    prog.apply(X, qbits[1])
+    jobs.append(prog.to_circ().to_job())
+
+    expected = PyLinalg().submit(Batch(jobs=jobs))
+    results = PyLinalg(batch_size=4).submit(Batch(jobs=jobs))
+
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results, expected):
+        if expected_result.value is not None:
+            assert result.value == pytest.approx(expected_result.value)
+            continue
+
+        assert len(result) == len(expected_result)
+        for sample, expected_sample in zip(result, expected_result):
+            assert sample.state.int == expected_sample.state.int
+            assert sample.amplitude == pytest.approx(expected_sample.amplitude)
+
+
+def test_shared_circuit(monkeypatch):
+    """
+    Checks that jobs sharing the same circuit are executed from a single
+    simulation
+    """
+    circ = generate_ansatz(np.linspace(0, 3, 8))
+    other = generate_ansatz(np.linspace(1, 4, 8))
+    observables = [Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1]), Term(0.5, "X", [3])]),
+                   Observable(4, pauli_terms=[Term(2., "Y", [2])], constant_coeff=1.),
+                   Observable(4, pauli_terms=[Term(-1., "ZZ", [0, 1])])]
+    jobs = [circ.to_job("OBS", observable=obs) for obs in observables]
+    jobs += [circ.to_job(), generate_ansatz(np.linspace(0, 3, 8)).to_job("OBS", observable=observables[0]),
+             other.to_job("OBS", observable=observables[1])]
+
+    expected = PyLinalg().submit(Batch(jobs=jobs))
+
+    simulations = []
+    monkeypatch.setattr(service, "simulate",
+                        lambda circuit, **kwargs: simulations.append(circuit) or simulate(circuit, **kwargs))
+    results = PyLinalg().submit(Batch(jobs=jobs))
+
+    # One simulation for the first 5 jobs, one for the last one
+    assert len(simulations) == 2
+    for result, expected_result in zip(results, expected):
+        if expected_result.value is not None:
+            assert result.value == pytest.approx(expected_result.value)
+        else:
+            for sample, expected_sample in zip(result, expected_result):
+                assert sample.state.int == expected_sample.state.int
+                assert sample.amplitude == pytest.approx(expected_sample.amplitude)
+
+
+def test_simulate_shared_prefixes(monkeypatch):
+    """
+    Checks that shared beginnings of circuits are simulated once
+    """
+    angles = np.linspace(0, 3, 8)
+    bases = ["ZZZZ", "XZZZ", "XYZZ", "YZZZ", "XYXY", "XZZZ"]
+    circuits = [generate_ansatz(angles, basis) for basis in bases]
+    circuits.append(generate_ansatz(angles))
+
+    applied = []
+    monkeypatch.setattr(simulator, "apply_gate",
+                        lambda *args, **kwargs: applied.append(args[2]) or apply_gate(*args, **kwargs))
+    state_vecs = [None] * len(circuits)
+    for indices, state_vec in simulate_shared_prefixes(circuits):
+        for index in indices:
+            state_vecs[index] = state_vec
+
+    # The ansatz once, then 1 + 1 + 1 + 2 rotations
+    assert len(applied) == len(circuits[-1].ops) + 5
+    for circ, state_vec in zip(circuits, state_vecs):
+        expected, _ = simulate(circ)
+        assert np.allclose(state_vec, expected)
+
+    # States are yielded as soon as they are computed, with the simulation options
+    states = simulate_shared_prefixes(circuits, fusion_width=3, threads=2)
+    indices, state_vec = next(states)
+    assert indices == [0, 6]
+    assert np.allclose(state_vec, simulate(circuits[0])[0])
+    for indices, state_vec in states:
+        assert np.allclose(state_vec, simulate(circuits[indices[0]], fusion_width=3)[0])
+
+
+def test_prefix_sharing():
+    """
+    Checks that PyLinalg with prefix sharing returns the same results
+    """
+    obs = Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1])])
+    jobs = [generate_ansatz(np.linspace(0, 3, 8), basis).to_job()
+            for basis in ["ZZZZ", "XZZZ", "XYZZ", "YZZZ"]]
+    jobs.append(generate_ansatz(np.linspace(0, 3, 8), "XYXY").to_job("OBS", observable=obs))
+
+    expected = PyLinalg().submit(Batch(jobs=jobs))
+    for options in [{}, {"fusion_width": 3, "threads": 2}, {"state_cache_bytes": 1 << 20}]:
+        qpu = PyLinalg(prefix_sharing=True, **options)
+        results = qpu.submit(Batch(jobs=jobs))
+        for result, expected_result in zip(results, expected):
+            if expected_result.value is not None:
+                assert result.value == pytest.approx(expected_result.value)
+            else:
+                for sample, expected_sample in zip(result, expected_result):
+                    assert sample.state.int == expected_sample.state.int
+                    assert sample.amplitude == pytest.approx(expected_sample.amplitude)
+
+    # Final states are computed as their jobs are executed, and cached
+    assert len(qpu.state_cache) == len(jobs)
+    stored = []
+
+    def recording_submit_job(job):
+        stored.append(len(qpu._precomputed_states))
+        return submit_job(job)
+
+    qpu = PyLinalg(prefix_sharing=True)
+    submit_job = qpu.submit_job
+    qpu.submit_job = recording_submit_job
+    qpu.submit(Batch(jobs=jobs))
+    assert stored == [0] * len(jobs)
+
+    # Jobs are executed in the order their states are computed
+    assert simulator.shared_prefix_order([job.circuit for job in jobs]) == [0, 1, 2, 4, 3]
+
+
+def test_workers():
+    """
+    Checks that PyLinalg executing batches in a process pool returns the
+    same results
+    """
+    rng = np.random.default_rng(2)
+    obs = Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1]), Term(0.5, "X", [3])])
+
+    jobs = []
+    for _ in range(4):
+        circ = generate_ansatz(rng.uniform(0, 6, size=8))
+        jobs.append(circ.to_job())
+        jobs.append(circ.to_job(qubits=[2, 0]))
+        jobs.append(circ.to_job("OBS", observable=obs))
+    jobs.append(circ.to_job(nbshots=100))
+
+    expected = PyLinalg().submit(Batch(jobs=jobs, meta_data={"name": "test"}))
+    results = PyLinalg(workers=2).submit(Batch(jobs=jobs, meta_data={"name": "test"}))
+
+    assert results.meta_data == {"name": "test"}
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results[:-1], expected[:-1]):
+        if expected_result.value is not None:
+            assert result.value == pytest.approx(expected_result.value)
+            continue
+
+        assert len(result) == len(expected_result)
+        for sample, expected_sample in zip(result, expected_result):
+            assert sample.state.int == expected_sample.state.int
+            assert sample.probability == pytest.approx(expected_sample.probability)
+            if expected_sample.amplitude is not None:
+                assert sample.amplitude == pytest.approx(expected_sample.amplitude)
+
+    assert sum(sample.probability for sample in results[-1]) == pytest.approx(1.)
+
+    # Compact output is kept
+    results = PyLinalg(workers=2, compact_output=True).submit(Batch(jobs=jobs[:2]))
+    assert np.allclose(results[0].distribution["amplitudes"],
+                       [sample.amplitude for sample in expected[0]])
+
+    # Errors are raised in the main process
+    jobs.append(circ.to_job("OBS", observable=obs, nbshots=10))
+    with pytest.raises(QPUException):
+        PyLinalg(workers=2).submit(Batch(jobs=jobs))
+
+
+def test_workers_shared_memory(monkeypatch):
+    """
+    Checks that the distributions sent back through shared memory are
+    read, and that their blocks are released, including on errors
+    """
+    # worker processes are forked: all the arrays go through shared memory
+    monkeypatch.setattr(service, "INLINE_BYTES", 0)
+    rng = np.random.default_rng(3)
+    obs = Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1])])
+    jobs = []
+    for _ in range(3):
+        circ = generate_ansatz(rng.uniform(0, 6, size=8))
+        jobs.append(circ.to_job())
+        jobs.append(circ.to_job("OBS", observable=obs))
+    expected = PyLinalg().submit(Batch(jobs=jobs))
+
+    blocks = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else None
+    results = PyLinalg(workers=2, compact_output=True).submit(Batch(jobs=jobs))
+    for result, expected_result in zip(results[::2], expected[::2]):
+        assert np.allclose(result.distribution["amplitudes"],
+                           [sample.amplitude for sample in expected_result])
+
+    # A job rejected by the QPU, and an unexpected error in the workers
+    with pytest.raises(QPUException):
+        PyLinalg(workers=2).submit(Batch(jobs=[circ.to_job("OBS", observable=obs, nbshots=10)]
+                                        + jobs))
+
+    def failing_observable(*_):
+        raise RuntimeError("failure")
+
+    monkeypatch.setattr(service, "compute_observable_averages", failing_observable)
+    with pytest.raises(QPUException, match="RuntimeError"):
+        PyLinalg(workers=2).submit(Batch(jobs=jobs))
+
+    if blocks is not None:
+        assert set(os.listdir("/dev/shm")) <= blocks
+
+
+def test_states_released():
+    """
+    Checks that the states shared by jobs are computed group by group, and
+    released once these jobs are executed, results keeping the order of
+    the jobs
+    """
+    rng = np.random.default_rng(4)
+    circuits = [generate_ansatz(rng.uniform(0, 6, size=8)) for _ in range(4)]
+    # Interleaved jobs sharing circuits, then circuits with the same structure
+    jobs = [circ.to_job() for circ in circuits[:2] * 2] + [circ.to_job() for circ in circuits[2:]]
+    expected = PyLinalg().submit(Batch(jobs=jobs))
+
+    qpu = PyLinalg(batch_size=2)
+    stored = []
+    submit_job = qpu.submit_job
+
+    def recording_submit_job(job):
+        stored.append(len({id(state_vec) for state_vec in qpu._precomputed_states.values()}))
+        return submit_job(job)
+
+    qpu.submit_job = recording_submit_job
+    results = qpu.submit(Batch(jobs=jobs))
+
+    assert stored == [0, 1, 0, 1, 0, 1]
+    for result, expected_result in zip(results, expected):
+        for sample, expected_sample in zip(result, expected_result):
+            assert sample.state.int == expected_sample.state.int
+            assert sample.amplitude == pytest.approx(expected_sample.amplitude)
+
+
+@pytest.mark.parametrize("options", [{}, {"batch_size": 2}, {"prefix_sharing": True}])
+def test_repeated_jobs(options):
+    """
+    Checks that a batch containing several times the same job returns one
+    result per job
+    """
+    obs = Observable(4, pauli_terms=[Term(1., "ZZ", [0, 1]), Term(0.5, "X", [3])])
+    circ = generate_ansatz(np.linspace(0, 3, 8))
+    sample_job, obs_job = circ.to_job(), circ.to_job("OBS", observable=obs)
+    jobs = [sample_job, obs_job, sample_job, obs_job, sample_job]
+
+    expected_samples = PyLinalg().submit(sample_job)
+    expected_value = PyLinalg().submit(obs_job).value
+    results = PyLinalg(**options).submit(Batch(jobs=jobs))
+
+    assert len(results) == len(jobs)
+    for result in results[1::2]:
+        assert result.value == pytest.approx(expected_value)
+    for result in results[::2]:
+        assert len(result) == len(expected_samples)
+        for sample, expected_sample in zip(result, expected_samples):
+            assert sample.state.int == expected_sample.state.int
+            assert sample.amplitude == pytest.approx(expected_sample.amplitude)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the caches of PyLinalg
+"""
+
+import pytest
+import numpy as np
+from qat.comm.datamodel.ttypes import Matrix, ComplexNumber
+from qat.core import Observable, Term
+from qat.lang.AQASM import Program, H, RZ, CNOT
+from qat.pylinalg import PyLinalg
+from qat.pylinalg.cache import LRUCache, gate_key
+from qat.pylinalg.simulator import mat2nparray
+
+
+def generate_circuit(angle):
+    """
+    Generates a circuit containing a parametrized controlled gate
+    """
+    prog = Program()
+    qbits = prog.qalloc(3)
+    prog.apply(H, qbits[0])
+    prog.apply(CNOT, qbits[:2])
+    prog.apply(RZ(angle).ctrl(), qbits[1:])
+    prog.apply(H, qbits[2])
+    return prog.to_circ()
+
+
+def test_mat2nparray():
+    """
+    Checks the conversion of serialized matrices
+    """
+    expected = np.arange(6).reshape((2, 3)) + 1j * np.arange(6, 12).reshape((2, 3))
+    matrix = Matrix(nRows=2, nCols=3,
+                    data=[ComplexNumber(re=val.real, im=val.imag) for val in expected.ravel()])
+    result = mat2nparray(matrix)
+
+    assert result.dtype == np.complex128
+    assert np.array_equal(result, expected)
+
+
+def test_lru_cache():
+    """
+    Checks the eviction policy and the counters of the LRU cache
+    """
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts "b"
+
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_gate_key():
+    """
+    Checks that keys identify gate definitions, not gate names
+    """
+    circ_1, circ_2, circ_3 = generate_circuit(0.1), generate_circuit(0.1), generate_circuit(0.2)
+    name = circ_1.ops[2].gate
+    assert name == circ_3.ops[2].gate
+    assert gate_key(name, circ_1.gateDic) == gate_key(name, circ_2.gateDic)
+    assert gate_key(name, circ_1.gateDic) != gate_key(name, circ_3.gateDic)
+
+
+def test_matrix_cache():
+    """
+    Checks that gate matrices are shared between jobs
+    """
+    qpu = PyLinalg(matrix_cache_size=16)
+    reference = PyLinalg()
+
+    for angle in [0.1, 0.2, 0.1]:
+        circ = generate_circuit(angle)
+        result = qpu.submit(circ.to_job())
+        expected = reference.submit(circ.to_job())
+        for sample, expected_sample in zip(result, expected):
+            assert sample.state.int == expected_sample.state.int
+            assert sample.probability == pytest.approx(expected_sample.probability)
+
+    # H, CNOT and C-RZ(0.1) are found in cache on their second use
+    assert qpu.matrix_cache.hits == 5
+    assert qpu.matrix_cache.misses == 4
+
+
+def test_lru_cache_weights():
+    """
+    Checks the eviction policy of a cache bounded in total weight
+    """
+    cache = LRUCache(10, weigh=len)
+    cache.put("a", "xxxx")
+    cache.put("b", "xxxx")
+    cache.put("c", "xxxx")  # evicts "a"
+    assert "a" not in cache
+    assert cache.size == 8
+
+    cache.put("d", "x" * 11)  # too heavy
+    assert "d" not in cache
+    assert len(cache) == 2
+
+
+def test_state_cache():
+    """
+    Checks that final states are reused for resubmitted circuits
+    """
+    qpu = PyLinalg(state_cache_bytes=2 * 16 * 8)
+    circ = generate_circuit(0.1)
+    obs = Observable(3, pauli_terms=[Term(1., "ZZ", [0, 2])])
+
+    expected = PyLinalg().submit(circ.to_job("OBS", observable=obs))
+    qpu.submit(circ.to_job(nbshots=10))
+    qpu.submit(circ.to_job())
+    result = qpu.submit(generate_circuit(0.1).to_job("OBS", observable=obs))
+
+    assert result.value == pytest.approx(expected.value)
+    assert (qpu.state_cache.hits, qpu.state_cache.misses) == (2, 1)
+
+    # The budget holds two states of 3 qubits
+    qpu.submit(generate_circuit(0.2).to_job())
+    qpu.submit(generate_circuit(0.3).to_job())
+    assert len(qpu.state_cache) == 2
+    qpu.submit(circ.to_job())
+    assert qpu.state_cache.misses == 4
+
+    with pytest.raises(ValueError):
+        PyLinalg(state_cache_bytes=-1)
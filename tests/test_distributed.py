@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the distributed simulation mode of PyLinalg
+"""
+
+import os
+import pytest
+import numpy as np
+from qat.comm.exceptions.ttypes import QPUException
+from qat.core import Observable, Term
+from qat.lang.AQASM import Program, H, CNOT
+from qat.pylinalg import PyLinalg, distributed
+from qat.pylinalg.distributed import simulate_distributed, max_ranks
+from qat.pylinalg.simulator import simulate
+
+
+@pytest.mark.parametrize("nb_ranks", [1, 2, 8])
+def test_simulate_distributed(nb_ranks, entangling_circuit):
+    """
+    Checks that the gathered state is equal to the state simulated by a
+    single process
+    """
+    circ = entangling_circuit(6)
+    expected, _ = simulate(circ)
+    assert np.allclose(simulate_distributed(circ, nb_ranks), expected)
+
+    with pytest.raises(QPUException):
+        simulate_distributed(circ, 3)
+
+
+@pytest.mark.parametrize("crash", [False, True])
+def test_failing_rank(crash, monkeypatch, entangling_circuit):
+    """
+    Checks that the other ranks are released when a rank fails, even
+    without aborting their barrier
+    """
+    sendrecv = distributed.SharedMemoryComm.sendrecv
+
+    def failing_sendrecv(comm, data, partner):
+        if comm.rank == 1:
+            if crash:
+                os._exit(1)
+            raise RuntimeError("failure")
+        return sendrecv(comm, data, partner)
+
+    # ranks are forked: the failure is inherited by the rank 1
+    monkeypatch.setattr(distributed.SharedMemoryComm, "sendrecv", failing_sendrecv)
+    with pytest.raises(QPUException, match="failed"):
+        simulate_distributed(entangling_circuit(6), 4)
+
+
+def test_pylinalg_distributed(entangling_circuit):
+    """
+    Checks the results of PyLinalg partitioning states across ranks
+    """
+    circ = entangling_circuit(6)
+    obs = Observable(6, pauli_terms=[Term(1., "ZZ", [0, 5]), Term(0.5, "XY", [1, 2])])
+    qpu, reference = PyLinalg(ranks=4), PyLinalg()
+
+    result = qpu.submit(circ.to_job(qubits=[1, 4]))
+    expected = reference.submit(circ.to_job(qubits=[1, 4]))
+    for sample, expected_sample in zip(result, expected):
+        assert sample.state.int == expected_sample.state.int
+        assert sample.probability == pytest.approx(expected_sample.probability)
+
+    result = qpu.submit(circ.to_job("OBS", observable=obs))
+    assert result.value == pytest.approx(reference.submit(circ.to_job("OBS", observable=obs)).value)
+
+    with pytest.raises(ValueError):
+        PyLinalg(ranks=6)
+
+
+def test_small_circuits():
+    """
+    Checks that circuits too small for the number of ranks are
+    partitioned across fewer ranks
+    """
+    qpu, reference = PyLinalg(ranks=4), PyLinalg()
+    for nbqbits in [1, 2, 3]:
+        prog = Program()
+        qbits = prog.qalloc(nbqbits)
+        prog.apply(H, qbits[0])
+        for qb in range(nbqbits - 1):
+            prog.apply(CNOT, qbits[qb], qbits[qb + 1])
+        circ = prog.to_circ()
+
+        assert max_ranks(circ) == (1 if nbqbits < 3 else 2)
+        result = qpu.submit(circ.to_job())
+        expected = reference.submit(circ.to_job())
+        assert [(sample.state.int, sample.probability) for sample in result] == \
+            pytest.approx([(sample.state.int, sample.probability) for sample in expected])
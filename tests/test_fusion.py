@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the gate fusion pass of PyLinalg
+"""
+
+import pytest
+import numpy as np
+from qat.comm.datamodel.ttypes import OpType
+from qat.lang.AQASM import Program, H, X, RX, RZ, CNOT, SWAP, CCNOT, T
+from qat.pylinalg import PyLinalg
+from qat.pylinalg.simulator import simulate, get_gate_info
+from qat.pylinalg.fusion import FusedGate, fuse_gates
+
+
+def generate_random_circuit(nbqbits, depth, seed):
+    """
+    Generates a random circuit
+    """
+    rng = np.random.default_rng(seed)
+    prog = Program()
+    qbits = prog.qalloc(nbqbits)
+
+    for _ in range(depth):
+        targets = [qbits[int(qb)] for qb in rng.permutation(nbqbits)[:3]]
+        gate = rng.integers(7)
+        if gate == 0:
+            prog.apply(H, targets[0])
+        elif gate == 1:
+            prog.apply(RX(rng.uniform(0, 6)), targets[0])
+        elif gate == 2:
+            prog.apply(RZ(rng.uniform(0, 6)), targets[0])
+        elif gate == 3:
+            prog.apply(T, targets[0])
+        elif gate == 4:
+            prog.apply(CNOT, targets[:2])
+        elif gate == 5:
+            prog.apply(SWAP, targets[:2])
+        else:
+            prog.apply(CCNOT, targets)
+
+    return prog.to_circ()
+
+
+@pytest.mark.parametrize("width", [2, 3, 4, 5])
+def test_fused_simulation(width):
+    """
+    Checks that fusion does not change the final state
+    """
+    for seed in range(5):
+        circ = generate_random_circuit(7, 60, seed)
+        expected, _ = simulate(circ)
+        result, _ = simulate(circ, fusion_width=width)
+        assert np.allclose(result, expected)
+
+
+def test_fusion_stops_at_measure():
+    """
+    Checks that gates are not fused across an intermediate measurement
+    """
+    prog = Program()
+    qbits = prog.qalloc(2)
+    cbits = prog.calloc(1)
+    prog.apply(H, qbits[0])
+    prog.apply(CNOT, qbits)
+    prog.measure(qbits[0], cbits[0])
+    prog.apply(H, qbits[1])
+    prog.apply(X, qbits[1])
+    prog.cc_apply(cbits[0], X, qbits[0])
+    circ = prog.to_circ()
+
+    gate_cache = {}
+    steps = fuse_gates(circ, 2, lambda op: get_gate_info(circ, op.gate, gate_cache))
+
+    assert [pos for pos, _ in steps] == [0, 2, 3, 5]
+    assert isinstance(steps[0][1], FusedGate)
+    assert steps[1][1].type == OpType.MEASURE
+    assert isinstance(steps[2][1], FusedGate)
+    assert steps[3][1].type == OpType.CLASSICCTRL
+
+
+def test_fusion_width_option():
+    """
+    Checks the fusion_width option of PyLinalg
+    """
+    circ = generate_random_circuit(5, 30, 42)
+    expected = PyLinalg().submit(circ.to_job())
+    result = PyLinalg(fusion_width=3).submit(circ.to_job())
+
+    assert len(result) == len(expected)
+    for sample, expected_sample in zip(result, expected):
+        assert sample.state.int == expected_sample.state.int
+        assert sample.probability == pytest.approx(expected_sample.probability)
+
+    with pytest.raises(ValueError):
+        PyLinalg(fusion_width=-1)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the in-place gate application kernels
+"""
+
+import pytest
+import numpy as np
+from qat.lang.AQASM import Program, Z, S, T, RZ, PH, X, CNOT, SWAP, CCNOT, H
+from qat.pylinalg import PyLinalg
+from qat.pylinalg.simulator import get_gate_matrix, simulate
+from qat.pylinalg.kernels import apply_gate, allocate_scratch, analyze_matrix, ChunkPool, DENSE, DIAGONAL, MONOMIAL
+
+
+def random_state(nbqbits, rng):
+    """
+    Returns a random normalized state vector
+    """
+    state_vec = rng.normal(size=2**nbqbits) + 1j * rng.normal(size=2**nbqbits)
+    state_vec /= np.linalg.norm(state_vec)
+    return state_vec.reshape((2,) * nbqbits)
+
+
+def random_unitary(nbqbits, rng):
+    """
+    Returns a random unitary matrix
+    """
+    dim = 2**nbqbits
+    matrix = rng.normal(size=(dim, dim)) + 1j * rng.normal(size=(dim, dim))
+    return np.linalg.qr(matrix)[0]
+
+
+def random_monomial(nbqbits, rng, diagonal=False):
+    """
+    Returns a random monomial matrix (diagonal if specified)
+    """
+    dim = 2**nbqbits
+    perm = np.arange(dim) if diagonal else rng.permutation(dim)
+    matrix = np.zeros((dim, dim), dtype=np.complex128)
+    matrix[perm, np.arange(dim)] = np.exp(1j * rng.uniform(0, 2 * np.pi, size=dim))
+    # Some phases are left to 1
+    matrix[perm[0], 0] = 1
+    return matrix
+
+
+def reference_apply(state_vec, matrix, qbits, nctrls):
+    """
+    Applies a gate by moving the qubits axes in first positions
+    """
+    nbqbits = state_vec.ndim
+    state_vec = np.moveaxis(state_vec, qbits, range(len(qbits)))
+    state_vec = state_vec.reshape((1 << nctrls, matrix.shape[0], 1 << (nbqbits - len(qbits))))
+    state_vec = state_vec.copy()
+    state_vec[-1] = np.dot(matrix, state_vec[-1])
+    state_vec = state_vec.reshape((2,) * nbqbits)
+    return np.moveaxis(state_vec, range(len(qbits)), qbits)
+
+
+@pytest.mark.parametrize("nbqbits", [1, 3, 6, 12])
+@pytest.mark.parametrize("arity", [1, 2, 3])
+@pytest.mark.parametrize("nctrls", [0, 1, 2])
+@pytest.mark.parametrize("kind", [DENSE, DIAGONAL, MONOMIAL])
+def test_apply_gate(nbqbits, arity, nctrls, kind):
+    """
+    Checks that in-place kernels are equivalent to the moveaxis/dot approach,
+    for random qubits (contiguous, scattered, in any order)
+    """
+    if arity + nctrls > nbqbits:
+        pytest.skip("Not enough qubits")
+
+    rng = np.random.default_rng(nbqbits * 100 + arity * 10 + nctrls)
+
+    for _ in range(10):
+        qbits = [int(qb) for qb in rng.permutation(nbqbits)[:arity + nctrls]]
+        if kind == DENSE:
+            matrix = random_unitary(arity, rng)
+        else:
+            matrix = random_monomial(arity, rng, diagonal=kind == DIAGONAL)
+        state_vec = random_state(nbqbits, rng)
+        expected = reference_apply(state_vec, matrix, qbits, nctrls)
+
+        scratch = allocate_scratch(state_vec)
+        result = apply_gate(state_vec, matrix, qbits, nctrls, scratch)
+
+        assert result is state_vec
+        assert np.allclose(state_vec, expected)
+
+
+@pytest.mark.parametrize("gate, kind", [(H, DENSE), (Z, DIAGONAL), (S, DIAGONAL),
+                                        (T, DIAGONAL), (RZ(0.3), DIAGONAL),
+                                        (PH(1.2), DIAGONAL), (X, MONOMIAL),
+                                        (CNOT, MONOMIAL), (SWAP, MONOMIAL),
+                                        (CCNOT, MONOMIAL)])
+def test_analyze_matrix(gate, kind):
+    """
+    Checks the detection of diagonal and monomial gates
+    """
+    prog = Program()
+    qbits = prog.qalloc(gate.arity)
+    prog.apply(gate, qbits)
+    circ = prog.to_circ()
+    _, matrix = get_gate_matrix(circ.gateDic[circ.ops[0].gate], circ.gateDic)
+
+    structure = analyze_matrix(matrix)
+    assert structure.kind == kind
+
+    if kind != DENSE:
+        rebuilt = np.zeros_like(matrix)
+        perm = np.arange(matrix.shape[0]) if structure.perm is None else structure.perm
+        rebuilt[perm, np.arange(matrix.shape[0])] = structure.phases
+        assert np.array_equal(rebuilt, matrix)
+
+
+@pytest.mark.parametrize("arity", [1, 2, 3])
+@pytest.mark.parametrize("nctrls", [0, 1])
+@pytest.mark.parametrize("kind", [DENSE, DIAGONAL, MONOMIAL])
+def test_apply_gate_batched(arity, nctrls, kind):
+    """
+    Checks that a stack of states gives the same results as states taken
+    one by one, with shared and per-state matrices
+    """
+    nbqbits, batch = 8, 4
+    rng = np.random.default_rng(arity * 10 + nctrls)
+
+    for _ in range(10):
+        qbits = [int(qb) for qb in rng.permutation(nbqbits)[:arity + nctrls]]
+        if kind == DENSE:
+            matrices = [random_unitary(arity, rng) for _ in range(batch)]
+        else:
+            # Monomial matrices of a stack share the same permutation
+            dim = 2**arity
+            perm = np.arange(dim) if kind == DIAGONAL else np.roll(np.arange(dim), 1)
+            matrices = []
+            for _ in range(batch):
+                matrix = np.zeros((dim, dim), dtype=np.complex128)
+                matrix[perm, np.arange(dim)] = np.exp(1j * rng.uniform(0, 2 * np.pi, size=dim))
+                matrices.append(matrix)
+        states = np.stack([random_state(nbqbits, rng) for _ in range(batch)])
+        expected = [reference_apply(state, matrix, qbits, nctrls)
+                    for state, matrix in zip(states, matrices)]
+
+        # Per-state matrices
+        stacked = np.stack(matrices)
+        assert analyze_matrix(stacked).kind == kind
+        result = apply_gate(states.copy(), stacked, qbits, nctrls, batched=True)
+        assert np.allclose(result, np.stack(expected))
+
+        # Shared matrix
+        expected = [reference_apply(state, matrices[0], qbits, nctrls) for state in states]
+        result = apply_gate(states.copy(), matrices[0], qbits, nctrls, batched=True)
+        assert np.allclose(result, np.stack(expected))
+
+
+@pytest.mark.parametrize("qbits", [[0], [16, 3], [8, 9, 10], [0, 15, 16], [2, 1, 12]])
+@pytest.mark.parametrize("kind", [DENSE, DIAGONAL, MONOMIAL])
+def test_apply_gate_threaded(qbits, kind):
+    """
+    Checks gate applications split into chunks updated by several threads
+    """
+    rng = np.random.default_rng(7)
+    state_vec = random_state(17, rng)
+    arity = 2 if len(qbits) == 3 else len(qbits)
+    nctrls = len(qbits) - arity
+    if kind == DENSE:
+        matrix = random_unitary(arity, rng)
+    else:
+        matrix = random_monomial(arity, rng, diagonal=(kind == DIAGONAL))
+
+    expected = reference_apply(state_vec, matrix, qbits, nctrls)
+    with ChunkPool(3) as pool:
+        assert len(pool.split_qubits(17, qbits)) == 2
+        results = [apply_gate(state_vec.copy(), matrix, qbits, nctrls, pool=pool) for _ in range(2)]
+
+    assert np.allclose(results[0], expected)
+    assert np.array_equal(results[0], results[1])
+
+
+def test_simulate_threaded():
+    """
+    Checks that a threaded simulation gives the same final state
+    """
+    prog = Program()
+    qbits = prog.qalloc(16)
+    for qb in range(16):
+        prog.apply(H, qbits[qb])
+        prog.apply(RZ(0.1 * qb), qbits[qb])
+    for qb in range(15):
+        prog.apply(CNOT, qbits[qb], qbits[15 - qb])
+    prog.apply(CCNOT, qbits[0], qbits[8], qbits[15])
+    circ = prog.to_circ()
+
+    expected, _ = simulate(circ)
+    result, _ = simulate(circ, threads=4)
+    assert np.allclose(result, expected)
+
+    with pytest.raises(ValueError):
+        PyLinalg(threads=-1)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the qubit layout pass
+"""
+
+import pytest
+import numpy as np
+from qat.comm.datamodel.ttypes import OpType
+from qat.lang.AQASM import Program, H, X, RY, CNOT, AbstractGate
+from qat.pylinalg import simulator
+from qat.pylinalg.kernels import DENSE
+from qat.pylinalg.layout import plan_layouts, permute_state
+from qat.pylinalg.simulator import simulate, get_gate_info
+
+
+def rotations(theta):
+    """
+    Matrix of a dense two-qubit gate
+    """
+    rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    return np.kron(rot, rot)
+
+
+ROT2 = AbstractGate("ROT2", [float], arity=2, matrix_generator=rotations)
+
+
+def generate_circuit(nbqbits, measure=False):
+    """
+    Generates a circuit containing dense gates on distant qubits
+    """
+    prog = Program()
+    qbits = prog.qalloc(nbqbits)
+    cbits = prog.calloc(1)
+    for qb in range(nbqbits):
+        prog.apply(RY(0.1 * qb + 0.2), qbits[qb])
+    prog.apply(ROT2(0.3), qbits[0], qbits[nbqbits - 1])
+    prog.apply(ROT2(0.5), qbits[1], qbits[nbqbits - 2])
+    prog.apply(CNOT, qbits[0], qbits[4])
+    if measure:
+        prog.apply(X, qbits[2])
+        prog.measure(qbits[2], cbits[0])
+    prog.apply(ROT2(0.7), qbits[nbqbits - 1], qbits[2])
+    prog.apply(H, qbits[3])
+    return prog.to_circ()
+
+
+def test_plan_layouts():
+    """
+    Checks that transpositions are batched and that the logical layout is
+    restored before measurements and at the end
+    """
+    circ = generate_circuit(10, measure=True)
+    steps = list(enumerate(circ))
+
+    def dense_targets(op):
+        if op.type == OpType.MEASURE:
+            return None
+        nctrls, _, structure = get_gate_info(circ, op.gate, {})
+        return op.qbits[nctrls:] if structure.kind == DENSE else []
+
+    layouts = plan_layouts(10, steps, dense_targets)
+    # 10 rotations, ROT2, ROT2, CNOT, X, MEASURE, ROT2, H
+    assert sorted(layouts) == [10, 14, 15, 17]
+
+    # Both ROT2 gates are applied after a single transposition
+    assert sorted(layouts[10][qb] for qb in [0, 1, 8, 9]) == [6, 7, 8, 9]
+    assert layouts[14] == list(range(10))
+    # ROT2 and H, which is dense
+    assert sorted(layouts[15][qb] for qb in [2, 3, 9]) == [7, 8, 9]
+    assert layouts[17] == list(range(10))
+
+
+def test_permute_state():
+    """
+    Checks the transposition of a state vector between two layouts
+    """
+    state_vec = np.random.random((2,) * 4) + 0j
+    out = np.empty(16, dtype=np.complex128)
+    layout = [3, 0, 1, 2]
+    result = permute_state(state_vec, list(range(4)), layout, out)
+
+    assert np.shares_memory(result, out)
+    assert np.array_equal(result, np.moveaxis(state_vec, 0, 3))
+    assert np.array_equal(permute_state(result, layout, list(range(4)), np.empty(16, complex)),
+                          state_vec)
+
+
+@pytest.mark.parametrize("measure", [False, True])
+@pytest.mark.parametrize("fusion_width", [0, 3])
+def test_layout_simulation(monkeypatch, measure, fusion_width):
+    """
+    Checks that the final state does not depend on the layouts
+    """
+    circ = generate_circuit(10, measure)
+    np.random.seed(0)
+    result, interm_measurements = simulate(circ, fusion_width=fusion_width)
+
+    monkeypatch.setattr(simulator, "plan_layouts", lambda *args: {})
+    np.random.seed(0)
+    expected, expected_measurements = simulate(circ, fusion_width=fusion_width)
+
+    assert result.flags.c_contiguous
+    assert np.allclose(result, expected)
+    assert [meas.cbits for meas in interm_measurements] == \
+        [meas.cbits for meas in expected_measurements]
@@ -26,9 +26,11 @@ Description: Unit test for the PyLinalg simulator
 
 import pytest
 import math
+import numpy as np
 from qat.lang.AQASM import Program, RX, RZ, CNOT, H, Z, X
 from qat.qpus import PyLinalg
 from qat.core.wrappers.result import aggregate_data
+from qat.pylinalg.simulator import simulate, simulate_branches, measure, sample_counts
 
 
 def generate_teleportation(split_measures: bool):
@@ -154,3 +156,131 @@ def test_reset():
     assert len(sample.intermediate_measurements) == 1
     print(sample.intermediate_measurements)
     assert sample.intermediate_measurements[0].cbits == [True, False]
+
+
+def test_measure_samples():
+    """
+    Checks vectorized sampling, with and without histogram
+    """
+    prog = Program()
+    qbits = prog.qalloc(3)
+    prog.apply(RX(1.23), qbits[0])
+    prog.apply(H, qbits[1])
+    prog.apply(CNOT, qbits[1], qbits[2])
+    state_vec, _ = simulate(prog.to_circ())
+
+    # Probabilities of the results on qubits [2, 0]
+    probs = (np.abs(state_vec) ** 2).sum(axis=1).T.ravel()
+
+    np.random.seed(42)
+    samples = measure(state_vec, [2, 0], nb_samples=20000)
+    assert len(samples) == 20000
+    for res_int, prob in samples[:100]:
+        assert prob == pytest.approx(probs[res_int])
+
+    # Same random numbers: same samples, aggregated
+    np.random.seed(42)
+    histogram = measure(state_vec, [2, 0], nb_samples=20000, histogram=True)
+    assert sum(count for _, _, count in histogram) == 20000
+    for res_int, prob, count in histogram:
+        assert prob == pytest.approx(probs[res_int])
+        assert count == sum(1 for sample, _ in samples if sample == res_int)
+        assert count / 20000 == pytest.approx(prob, abs=2e-2)
+
+
+def test_aggregated_sampling():
+    """
+    Checks that counts are sampled directly when results are aggregated
+    """
+    prog = Program()
+    qbits = prog.qalloc(3)
+    prog.apply(RX(1.23), qbits[0])
+    prog.apply(H, qbits[1])
+    prog.apply(CNOT, qbits[1], qbits[2])
+    circ = prog.to_circ()
+    state_vec, _ = simulate(circ)
+
+    probs = (np.abs(state_vec) ** 2).sum(axis=1).T.ravel()
+    res_ints, counts = sample_counts(state_vec, [2, 0], 20000)
+    assert counts.sum() == 20000
+    assert set(res_ints) == {res_int for res_int, prob in enumerate(probs) if prob > 1e-10}
+
+    # Aggregated results of PyLinalg
+    result = PyLinalg().submit(circ.to_job(nbshots=20000, qubits=[2, 0]))
+    assert result.meta_data["nbshots"] == "20000"
+    assert sum(sample.probability for sample in result) == pytest.approx(1.)
+    for sample in result:
+        assert sample.probability == pytest.approx(probs[sample.state.int], abs=2e-2)
+        assert sample.err == pytest.approx(
+            math.sqrt(sample.probability * (1 - sample.probability) / 19999))
+
+    # A single shot has no error bar
+    result = PyLinalg().submit(circ.to_job(nbshots=1))
+    assert len(result) == 1
+    assert result[0].probability == 1.
+    assert result[0].err is None
+
+
+def test_branching():
+    """
+    Checks that shots are distributed across the trajectories of a circuit
+    containing intermediate measurements
+    """
+    prog = Program()
+    qbits = prog.qalloc(3)
+    cbits = prog.calloc(2)
+    prog.apply(H, qbits[0])
+    prog.apply(RX(1.23), qbits[1])
+    prog.measure(qbits[:2], cbits)
+    prog.cc_apply(cbits[0], X, qbits[2])
+    prog.reset(qbits[0])
+    circ = prog.to_circ()
+
+    branches = list(simulate_branches(circ, 10000))
+    assert len(branches) == 4
+    assert sum(shots for _, _, shots in branches) == 10000
+
+    p_one = math.sin(1.23 / 2) ** 2
+    for state_vec, interm_measurements, shots in branches:
+        measured = interm_measurements[0]
+        assert measured.gate_pos == 2
+        assert measured.probability == pytest.approx(0.5 * (p_one if measured.cbits[1] else 1 - p_one))
+        assert shots / 10000 == pytest.approx(measured.probability, abs=2e-2)
+
+        # Qubit 0 is reset, qubit 2 is equal to qubit 0 before the reset
+        expected = np.zeros((2, 2, 2))
+        expected[0, measured.cbits[1], measured.cbits[0]] = 1
+        assert np.allclose(np.abs(state_vec), expected)
+
+    # Samples of PyLinalg
+    for aggregate in [True, False]:
+        result = PyLinalg().submit(circ.to_job(nbshots=1000, aggregate_data=aggregate))
+        if not aggregate:
+            assert len(result) == 1000
+            result = aggregate_data(result)
+        assert sum(sample.probability for sample in result) == pytest.approx(1.)
+        for sample in result:
+            assert sample.state.int < 4
+            assert sample.state.int >> 1 == sample.intermediate_measurements[0].cbits[1]
+            assert sample.state.int & 1 == sample.intermediate_measurements[0].cbits[0]
+
+
+def test_aggregated_branches():
+    """
+    Checks that aggregated samples keep the trajectories ending in the same
+    final state apart
+    """
+    prog = Program()
+    qbits = prog.qalloc(2)
+    cbits = prog.calloc(1)
+    prog.apply(H, qbits[0])
+    prog.measure(qbits[0], cbits[0])
+    prog.apply(H, qbits[1])
+    circ = prog.to_circ()
+
+    result = PyLinalg().submit(circ.to_job(nbshots=4000, qubits=[1]))
+    outcomes = sorted((sample.state.int, sample.intermediate_measurements[0].cbits[0])
+                      for sample in result)
+    assert outcomes == [(0, False), (0, True), (1, False), (1, True)]
+    for sample in result:
+        assert sample.probability == pytest.approx(0.25, abs=5e-2)
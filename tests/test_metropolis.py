@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the Metropolis engine of the simulated annealing
+"""
+
+import itertools
+import pytest
+import numpy as np
+from qat.simulated_annealing import metropolis
+from qat.simulated_annealing.metropolis import MetropolisEngine, color_classes, to_csr, \
+    csr_from_entries
+
+
+def random_ising(n_spins, nb_couplings, seed):
+    """
+    Generates a random sparse Ising problem
+    """
+    rng = np.random.default_rng(seed)
+    J_coupling = np.zeros((n_spins, n_spins))
+    for _ in range(nb_couplings):
+        i, j = rng.choice(n_spins, size=2, replace=False)
+        J_coupling[i, j] = J_coupling[j, i] = rng.normal()
+    return J_coupling, rng.normal(size=n_spins)
+
+
+def reference_sweeps(J_coupling, h_mag, spin_conf, temp_list):
+    """
+    Metropolis sweeps, one spin and one random number at a time
+    """
+    local_h = h_mag + J_coupling @ spin_conf
+    for temp in temp_list:
+        for spin in range(len(h_mag)):
+            delta_E = 2.0 * spin_conf[spin] * local_h[spin]
+            flip_prob = 1.0 if delta_E < 0 else np.exp(-delta_E / temp)
+            if np.random.rand() < flip_prob:
+                local_h -= 2 * spin_conf[spin] * J_coupling[spin, :]
+                spin_conf[spin] *= -1
+    return spin_conf
+
+
+def test_color_classes():
+    """
+    Checks that classes partition the spins into uncoupled spins
+    """
+    J_coupling, _ = random_ising(200, 600, 0)
+    engine = MetropolisEngine(J_coupling, np.zeros(200))
+
+    assert sorted(np.concatenate(engine.classes).tolist()) == list(range(200))
+    for spins in engine.classes:
+        assert not J_coupling[np.ix_(spins, spins)].any()
+    assert not engine.sequential
+
+    indptr, indices = np.array([0, 0, 0]), np.array([], dtype=np.int64)
+    assert [spins.tolist() for spins in color_classes(indptr, indices)] == [[0, 1]]
+
+
+def test_sequential_sweeps():
+    """
+    Checks that dense problems follow the same trajectory as one random
+    number drawn per spin
+    """
+    J_coupling, h_mag = random_ising(20, 150, 1)
+    temp_list = np.linspace(3, 0.1, 30)
+    engine = MetropolisEngine(J_coupling, h_mag)
+    assert engine.sequential
+
+    np.random.seed(5)
+    expected = reference_sweeps(J_coupling, h_mag, np.random.choice([1, -1], 20), temp_list)
+    np.random.seed(5)
+    result = engine.anneal(np.random.choice([1, -1], 20), temp_list)
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("min_class_size", [1, 1000])
+def test_boltzmann_distribution(monkeypatch, min_class_size):
+    """
+    Checks that sweeps at a fixed temperature sample the Boltzmann
+    distribution, with classes updated at once or spins one after the other
+    """
+    monkeypatch.setattr(metropolis, "MIN_CLASS_SIZE", min_class_size)
+    J_coupling, h_mag = random_ising(5, 4, 2)
+    engine = MetropolisEngine(J_coupling, h_mag)
+    assert engine.sequential == (min_class_size == 1000)
+
+    temp = 2.
+    configurations = np.array(list(itertools.product([1, -1], repeat=5)))
+    energies = -0.5 * np.einsum("ki,ij,kj->k", configurations, J_coupling, configurations) \
+        - configurations @ h_mag
+    weights = np.exp(-energies / temp)
+    expected = weights @ energies / weights.sum()
+
+    np.random.seed(0)
+    samples = [engine.anneal(np.random.choice([1, -1], 5), [temp] * 20) for _ in range(3000)]
+    samples = np.array(samples)
+    result = np.mean(-0.5 * np.einsum("ki,ij,kj->k", samples, J_coupling, samples)
+                     - samples @ h_mag)
+    assert result == pytest.approx(expected, abs=0.1)
+
+
+@pytest.mark.parametrize("nb_couplings", [10, 150])
+def test_anneal_replicas(nb_couplings):
+    """
+    Checks that a single replica follows the same trajectory as a single
+    configuration, and that replicas are independent
+    """
+    J_coupling, h_mag = random_ising(40, nb_couplings, 3)
+    engine = MetropolisEngine(J_coupling, h_mag)
+    assert engine.sequential == (nb_couplings == 150)
+    temp_list = np.linspace(3, 0.1, 30)
+
+    np.random.seed(7)
+    expected = engine.anneal(np.random.choice([1, -1], 40), temp_list)
+    np.random.seed(7)
+    result = engine.anneal_replicas(np.random.choice([1, -1], (1, 40)), temp_list)
+    assert np.array_equal(result[0], expected)
+
+    result = engine.anneal_replicas(np.ones((50, 40), dtype=np.int64), temp_list)
+    assert result.shape == (50, 40)
+    assert len({tuple(conf) for conf in result.tolist()}) > 1
+
+
+@pytest.mark.parametrize("min_class_size", [1, 1000])
+def test_replicas_boltzmann_distribution(monkeypatch, min_class_size):
+    """
+    Checks that replicas at a fixed temperature sample the Boltzmann
+    distribution
+    """
+    monkeypatch.setattr(metropolis, "MIN_CLASS_SIZE", min_class_size)
+    J_coupling, h_mag = random_ising(5, 4, 2)
+    engine = MetropolisEngine(J_coupling, h_mag)
+
+    temp = 2.
+    configurations = np.array(list(itertools.product([1, -1], repeat=5)))
+    energies = -0.5 * np.einsum("ki,ij,kj->k", configurations, J_coupling, configurations) \
+        - configurations @ h_mag
+    weights = np.exp(-energies / temp)
+    expected = weights @ energies / weights.sum()
+
+    np.random.seed(0)
+    samples = engine.anneal_replicas(np.random.choice([1, -1], (3000, 5)), [temp] * 20)
+    result = np.mean(-0.5 * np.einsum("ki,ij,kj->k", samples, J_coupling, samples)
+                     - samples @ h_mag)
+    assert result == pytest.approx(expected, abs=0.1)
+
+
+@pytest.mark.parametrize("nb_couplings", [10, 150])
+def test_csr_couplings(nb_couplings):
+    """
+    Checks that sparse couplings follow the same trajectory as dense ones
+    """
+    J_coupling, h_mag = random_ising(40, nb_couplings, 5)
+    csr = to_csr(J_coupling)
+    rows = np.repeat(np.arange(40), np.diff(csr.indptr))
+    dense = np.zeros((40, 40))
+    dense[rows, csr.indices] = csr.data
+    assert np.array_equal(dense, J_coupling)
+    for converted, array in zip(to_csr(csr), csr):
+        assert np.array_equal(converted, array)
+
+    temp_list = np.linspace(3, 0.1, 30)
+    results = []
+    for couplings in [J_coupling, csr]:
+        np.random.seed(11)
+        results.append(MetropolisEngine(couplings, h_mag).anneal(np.ones(40, dtype=np.int64),
+                                                                  temp_list))
+    assert np.array_equal(*results)
+
+
+def test_large_sparse_problem():
+    """
+    Checks the annealing of a ferromagnetic ring of 10^5 spins, whose
+    couplings are never stored densely
+    """
+    n_spins = 100000
+    spins = np.arange(n_spins)
+    J_coupling = csr_from_entries(np.concatenate([spins, (spins + 1) % n_spins]),
+                                  np.concatenate([(spins + 1) % n_spins, spins]),
+                                  np.ones(2 * n_spins), n_spins)
+    assert J_coupling.shape == (n_spins, n_spins)
+    assert len(J_coupling.data) == 2 * n_spins
+
+    engine = MetropolisEngine(J_coupling, np.zeros(n_spins))
+    assert len(engine.classes) == 2
+
+    np.random.seed(0)
+    result = engine.anneal(np.random.choice([1, -1], n_spins), np.linspace(2, 0.01, 50))
+    # Most of the ring is aligned with its neighbours
+    assert np.mean(result == np.roll(result, 1)) > 0.9
+
+
+@pytest.mark.parametrize("min_class_size", [1, 1000])
+def test_sweep_replicas(monkeypatch, min_class_size):
+    """
+    Checks that replicas at their own temperatures sample their Boltzmann
+    distributions, and that the yielded energies are the ones of the
+    configurations
+    """
+    monkeypatch.setattr(metropolis, "MIN_CLASS_SIZE", min_class_size)
+    J_coupling, h_mag = random_ising(5, 4, 2)
+    engine = MetropolisEngine(J_coupling, h_mag)
+
+    configurations = np.array(list(itertools.product([1, -1], repeat=5)))
+    energies = -0.5 * np.einsum("ki,ij,kj->k", configurations, J_coupling, configurations) \
+        - configurations @ h_mag
+
+    np.random.seed(0)
+    spin_confs = np.random.choice([1, -1], (4000, 5))
+    temperatures = np.repeat([0.5, 2.], 2000)
+    sweeps = engine.sweep_replicas(spin_confs, temperatures)
+    for _, result in zip(range(200), sweeps):
+        assert np.allclose(result, -0.5 * np.einsum("ki,ij,kj->k", spin_confs, J_coupling,
+                                                    spin_confs) - spin_confs @ h_mag)
+
+    for temp, replica_energies in zip([0.5, 2.], result.reshape(2, -1)):
+        weights = np.exp(-(energies - energies.min()) / temp)
+        assert replica_energies.mean() == pytest.approx(weights @ energies / weights.sum(),
+                                                        abs=0.1)
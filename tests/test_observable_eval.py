@@ -25,7 +25,7 @@ Tests for logic gates and classically controlled gates
 
 import numpy as np
 
-from qat.lang.AQASM import Program, X, Z, PH, H
+from qat.lang.AQASM import Program, X, Z, PH, H, RX, RZ
 
 from qat.core import Observable, Term
 from qat.comm.exceptions.ttypes import QPUException
@@ -35,6 +35,7 @@ from qat.comm.exceptions.ttypes import QPUException
 ###################################
 import unittest
 from qat.pylinalg import PyLinalg
+from qat.pylinalg.simulator import compute_observable_average
 from qat.lang.AQASM import Program, CNOT, S, H, T, X
 
 class TestSimpleObservables(unittest.TestCase):
@@ -155,6 +156,21 @@ class TestSimpleObservables(unittest.TestCase):
         result = qpu.submit(job)
         self.assertAlmostEqual(result.value, 18)
 
+    def test_sample_1qb_X_and_Y(self):
+        # More terms than qubits, sharing their flipped qubit
+        prog = Program()
+        qbits = prog.qalloc(1)
+        prog.apply(RX(0.7), qbits)
+        prog.apply(RZ(0.4), qbits)
+        circ = prog.to_circ()
+
+        obs = Observable(1, pauli_terms=[Term(1., "X", [0]), Term(1., "Y", [0])])
+        job = circ.to_job("OBS", observable=obs)
+
+        result = PyLinalg().submit(job)
+        # <X> = sin(0.7) sin(0.4), <Y> = -sin(0.7) cos(0.4)
+        self.assertAlmostEqual(result.value, np.sin(0.7) * (np.sin(0.4) - np.cos(0.4)))
+
     def test_sample_2qb_several_terms(self):
 
         qpu = PyLinalg()
@@ -245,6 +261,45 @@ class TestSimpleObservables(unittest.TestCase):
         self.assertAlmostEqual(result.value, -1)
 
 
+class TestGroupedTerms(unittest.TestCase):
+
+    @staticmethod
+    def dense_average(state_vec, observable):
+        """
+        Computes the average of an observable with its dense matrix
+        """
+        paulis = {"I": np.eye(2), "X": np.array([[0, 1], [1, 0]]),
+                  "Y": np.array([[0, -1j], [1j, 0]]), "Z": np.diag([1, -1])}
+        psi = state_vec.ravel()
+        value = observable.constant_coeff
+        for term in observable.terms:
+            ops = ["I"] * observable.nbqbits
+            for op, qb in zip(term.op, term.qbits):
+                ops[qb] = op
+            matrix = np.eye(1)
+            for op in ops:
+                matrix = np.kron(matrix, paulis[op])
+            value += term.coeff * np.vdot(psi, matrix.dot(psi))
+        return value
+
+    def test_grouped_terms(self):
+        rng = np.random.default_rng(3)
+        state_vec = rng.normal(size=32) + 1j * rng.normal(size=32)
+        state_vec = (state_vec / np.linalg.norm(state_vec)).reshape((2,) * 5)
+
+        # Few terms, then more terms than qubits, sharing flipped qubits
+        for nbterms in [4, 30]:
+            terms = []
+            for _ in range(nbterms):
+                qbits = [int(qb) for qb in rng.permutation(5)[:rng.integers(1, 4)]]
+                ops = "".join(rng.choice(["X", "Y", "Z", "Z"], size=len(qbits)))
+                terms.append(Term(rng.normal(), ops, qbits))
+            obs = Observable(5, pauli_terms=terms, constant_coeff=0.5)
+
+            self.assertAlmostEqual(compute_observable_average(state_vec, obs),
+                                   self.dense_average(state_vec, obs))
+
+
 class TestRaiseExceptNbshotsFinite(unittest.TestCase):
     def test_basic(self):
         with self.assertRaises(QPUException):
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the out-of-core simulation mode of PyLinalg
+"""
+
+import pytest
+import numpy as np
+from qat.comm.exceptions.ttypes import QPUException
+from qat.pylinalg import PyLinalg
+from qat.pylinalg.outofcore import simulate_out_of_core, sample_counts_out_of_core
+from qat.pylinalg.simulator import simulate
+
+
+@pytest.mark.parametrize("block_qubits", [3, 5, 8])
+def test_simulate_out_of_core(tmp_path, block_qubits, entangling_circuit):
+    """
+    Checks that the state stored on disk is equal to the in-memory state
+    """
+    circ = entangling_circuit(8)
+    expected, _ = simulate(circ)
+    state, position = simulate_out_of_core(circ, str(tmp_path / "state.bin"), block_qubits)
+
+    assert state.shape == (2 ** (8 - block_qubits), 2 ** block_qubits)
+    # Qubit q is stored along axis position[q]
+    result = np.asarray(state).reshape((2,) * 8).transpose(position)
+    assert np.allclose(result, expected)
+
+
+def test_sample_out_of_core(tmp_path, entangling_circuit):
+    """
+    Checks the distribution sampled from a state stored on disk
+    """
+    circ = entangling_circuit(6)
+    expected, _ = simulate(circ)
+    probs = (np.abs(expected) ** 2).transpose((4, 1, 0, 2, 3, 5)).reshape((4, 4, 4)).sum(axis=-1)
+
+    state, position = simulate_out_of_core(circ, str(tmp_path / "state.bin"), 3)
+    res_ints, counts = sample_counts_out_of_core(state, position, [4, 1, 0, 2], 100000)
+
+    assert counts.sum() == 100000
+    frequencies = np.zeros(16)
+    frequencies[res_ints] = counts / 100000
+    assert np.allclose(frequencies, probs.ravel(), atol=1e-2)
+
+
+def test_pylinalg_out_of_core(tmp_path, entangling_circuit):
+    """
+    Checks sampling jobs in out-of-core mode, and the rejected jobs
+    """
+    circ = entangling_circuit(6)
+    qpu = PyLinalg(out_of_core_dir=str(tmp_path), block_qubits=3)
+
+    result = qpu.submit(circ.to_job(nbshots=1000, qubits=[0, 5]))
+    assert sum(sample.probability for sample in result) == pytest.approx(1.)
+    assert result.meta_data["nbshots"] == "1000"
+
+    result = qpu.submit(circ.to_job(nbshots=10, aggregate_data=False))
+    assert len(result) == 10
+
+    # Temporary files are removed
+    assert not list(tmp_path.iterdir())
+
+    with pytest.raises(QPUException):
+        qpu.submit(circ.to_job())
+
+    with pytest.raises(ValueError):
+        PyLinalg(block_qubits=0)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the Pauli string engine of PyLinalg
+"""
+
+import pytest
+import numpy as np
+from qat.pylinalg.pauli import PauliString, mask_qubits, pauli_expectation, pauli_expectations
+
+
+def random_state(nbqbits, seed):
+    """
+    Generates a random normalized state vector
+    """
+    rng = np.random.default_rng(seed)
+    state_vec = rng.normal(size=2**nbqbits) + 1j * rng.normal(size=2**nbqbits)
+    return (state_vec / np.linalg.norm(state_vec)).reshape((2,) * nbqbits)
+
+
+def dense_expectation(state_vec, ops, qbits):
+    """
+    Computes an expectation value with the dense matrix of the Pauli product
+    """
+    paulis = {"I": np.eye(2), "X": np.array([[0, 1], [1, 0]]),
+              "Y": np.array([[0, -1j], [1j, 0]]), "Z": np.diag([1, -1])}
+    all_ops = ["I"] * state_vec.ndim
+    for op, qb in zip(ops, qbits):
+        all_ops[qb] = op
+    matrix = np.eye(1)
+    for op in all_ops:
+        matrix = np.kron(matrix, paulis[op])
+    psi = state_vec.ravel()
+    return np.vdot(psi, matrix.dot(psi))
+
+
+def test_pauli_string():
+    """
+    Checks the masks of a Pauli string (qubit 0 is the most significant bit)
+    """
+    pauli = PauliString.from_ops("XYZ", [0, 2, 3], 4)
+    assert pauli.x_mask == 0b1010
+    assert pauli.z_mask == 0b0011
+    assert pauli.phase == 1j
+    assert mask_qubits(pauli.x_mask, 4) == (0, 2)
+
+
+def test_pauli_expectation():
+    """
+    Checks expectation values against dense matrices and flat index XORs
+    """
+    state_vec = random_state(4, 0)
+    psi = state_vec.ravel()
+    indices = np.arange(16)
+
+    for ops, qbits in [("Z", [1]), ("XX", [0, 3]), ("YZ", [2, 0]), ("XYZY", [3, 1, 0, 2])]:
+        pauli = PauliString.from_ops(ops, qbits, 4)
+        value = pauli_expectation(state_vec, pauli)
+        assert value == pytest.approx(dense_expectation(state_vec, ops, qbits))
+
+        parities = np.array([bin(j).count("1") % 2 for j in indices & pauli.z_mask])
+        expected = pauli.phase * np.vdot(psi[indices ^ pauli.x_mask], (-1)**parities * psi)
+        assert value == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("nbpaulis", [3, 20])
+def test_pauli_expectations(nbpaulis):
+    """
+    Checks grouped evaluation, with and without Walsh-Hadamard transform
+    """
+    rng = np.random.default_rng(1)
+    state_vec = random_state(5, 1)
+    products = []
+    for _ in range(nbpaulis):
+        qbits = [int(qb) for qb in rng.permutation(5)[:rng.integers(1, 4)]]
+        products.append(("".join(rng.choice(["X", "Y", "Z"], size=len(qbits))), qbits))
+
+    values = pauli_expectations(state_vec, [PauliString.from_ops(ops, qbits, 5)
+                                            for ops, qbits in products])
+    for value, (ops, qbits) in zip(values, products):
+        assert value == pytest.approx(dense_expectation(state_vec, ops, qbits))
+
+
+def test_pauli_expectations_one_qubit():
+    """
+    Checks the Walsh-Hadamard transform on a single qubit, with more
+    products than qubits
+    """
+    state_vec = random_state(1, 2)
+    products = [("X", [0]), ("Y", [0])]
+    values = pauli_expectations(state_vec, [PauliString.from_ops(ops, qbits, 1)
+                                            for ops, qbits in products])
+    for value, (ops, qbits) in zip(values, products):
+        assert value == pytest.approx(dense_expectation(state_vec, ops, qbits))
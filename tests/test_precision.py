@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the single precision mode of PyLinalg
+"""
+
+import pytest
+import numpy as np
+from qat.core import Observable, Term
+from qat.lang.AQASM import Program, H, RX, RY, CNOT, SWAP
+from qat.pylinalg import PyLinalg
+from qat.pylinalg.simulator import simulate
+
+
+def generate_circuit():
+    """
+    Generates a small entangling circuit
+    """
+    prog = Program()
+    qbits = prog.qalloc(5)
+    for qb in range(5):
+        prog.apply(H, qbits[qb])
+        prog.apply(RY(0.3 * qb + 0.1), qbits[qb])
+    for qb in range(4):
+        prog.apply(CNOT, qbits[qb], qbits[qb + 1])
+        prog.apply(RX(0.7).ctrl(), qbits[qb + 1], qbits[qb])
+    prog.apply(SWAP, qbits[0], qbits[4])
+    return prog.to_circ()
+
+
+def test_simulate_single_precision():
+    """
+    Checks the dtype and the accuracy of a single precision simulation
+    """
+    circ = generate_circuit()
+    expected, _ = simulate(circ)
+    result, _ = simulate(circ, dtype=np.complex64)
+
+    assert result.dtype == np.complex64
+    assert np.allclose(result, expected, atol=1e-6)
+
+
+def test_pylinalg_single_precision():
+    """
+    Checks sampling and observable evaluation in single precision
+    """
+    circ = generate_circuit()
+    qpu, reference = PyLinalg(precision="single"), PyLinalg()
+
+    result = qpu.submit(circ.to_job())
+    expected = reference.submit(circ.to_job())
+    assert len(result) == len(expected)
+    for sample, expected_sample in zip(result, expected):
+        assert sample.state.int == expected_sample.state.int
+        assert sample.probability == pytest.approx(expected_sample.probability, abs=1e-6)
+
+    result = qpu.submit(circ.to_job(nbshots=100, qubits=[0, 3]))
+    assert sum(sample.probability for sample in result) == pytest.approx(1.)
+
+    obs = Observable(5, pauli_terms=[Term(1., "ZZ", [0, 1]), Term(-0.5, "XY", [2, 4])])
+    result = qpu.submit(circ.to_job("OBS", observable=obs))
+    expected = reference.submit(circ.to_job("OBS", observable=obs))
+    assert result.value == pytest.approx(expected.value, abs=1e-6)
+
+
+def test_invalid_precision():
+    """
+    Checks that unknown precisions are rejected
+    """
+    with pytest.raises(ValueError):
+        PyLinalg(precision="half")
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the compiled temperature schedules
+"""
+
+import pytest
+import numpy as np
+from qat.core import Variable
+from qat.core.variables import cos, exp, sqrt, heaviside, vmax
+from qat.simulated_annealing import SimulatedAnnealing, service
+from qat.simulated_annealing.schedule import compile_expression
+
+t = Variable("t", float)
+
+
+@pytest.mark.parametrize("expression", [
+    t**3 + 8 * t + 1,
+    2 * (1 - t) + 0.01 * t,
+    3 / (t + 1) - t,
+    exp(-t) * 2 + cos(t) + sqrt(t),
+    heaviside(t, 0.25, 0.75) + 0.1,
+    vmax(t, 0.3),
+])
+def test_compile_expression(expression):
+    """
+    Checks that compiled expressions match their evaluation time by time
+    """
+    times = np.linspace(0, 1, 101)
+    expected = [expression(t=time) for time in times.tolist()]
+    assert np.allclose(compile_expression(expression)(times), expected)
+
+
+def test_temperature_cache():
+    """
+    Checks that the temperatures of a QPU are cached per annealing time
+    """
+    qpu = SimulatedAnnealing(temp_t=2 * (1 - t) + 0.01, n_steps=50)
+    temperatures = qpu.temperatures(2.)
+
+    assert np.allclose(temperatures, 2 * (1 - np.linspace(0, 2, 50)) + 0.01)
+    assert qpu.temperatures(2.) is temperatures
+    assert qpu.temperatures(1.) is not temperatures
+    assert not temperatures.flags.writeable
+
+    # The least recently used temperatures are evicted first
+    for tmax in range(3, 3 + service.TEMPERATURE_CACHE_SIZE):
+        qpu.temperatures(float(tmax))
+        qpu.temperatures(2.)
+    assert len(qpu.temperature_cache) == service.TEMPERATURE_CACHE_SIZE
+    assert qpu.temperatures(2.) is temperatures
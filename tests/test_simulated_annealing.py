@@ -169,6 +169,28 @@ class TestSimulatedAnnealing(unittest.TestCase):
         result = qpu_valid.submit_job(TestSimulatedAnnealing.job_valid)
         assert isinstance(result, Result)
 
+    def test_replicas(self):
+        """
+        Tests the annealing of all the replicas of a job at once, in the
+        current process or in a pool of processes
+        """
+        observable = get_observable(TestSimulatedAnnealing.J_valid[:12, :12],
+                                    TestSimulatedAnnealing.h_valid[:12], 0.)
+        job = Schedule(drive=[(1, observable)], tmax=1.).to_job(nbshots=40, aggregate_data=False)
+
+        for options in [dict(vectorized=True), dict(workers=2)]:
+            qpu = SimulatedAnnealing(temp_t=TestSimulatedAnnealing.temp_t_valid, n_steps=100,
+                                     seed=42, **options)
+            result = qpu.submit(job)
+            assert len(result) == 40
+
+            # Seeded results are reproducible
+            assert [sample.state.int for sample in result] == \
+                [sample.state.int for sample in qpu.submit(job)]
+
+        with pytest.raises(ValueError):
+            SimulatedAnnealing(temp_t=TestSimulatedAnnealing.temp_t_valid, n_steps=100, workers=-1)
+
     def test_extract_j_and_h_from_obs(self):
         """
         Tests if the J coupling and h magnetic field are properly
@@ -187,6 +209,15 @@ class TestSimulatedAnnealing(unittest.TestCase):
         assert np.array_equal(TestSimulatedAnnealing.h_valid, h_extracted)
         assert TestSimulatedAnnealing.offset_valid == offset_extracted
 
+        # The sparse coupling matrix has the same entries
+        J_sparse, h_extracted, offset_extracted = extract_j_and_h_from_obs(observable, sparse=True)
+        rows = np.repeat(np.arange(J_sparse.shape[0]), np.diff(J_sparse.indptr))
+        J_dense = np.zeros(J_sparse.shape)
+        J_dense[rows, J_sparse.indices] = J_sparse.data
+        assert np.array_equal(TestSimulatedAnnealing.J_valid, J_dense)
+        assert np.array_equal(TestSimulatedAnnealing.h_valid, h_extracted)
+        assert TestSimulatedAnnealing.offset_valid == offset_extracted
+
     def test_MaxCut(self):
         """
         A test checking that a tree-graph given to MaxCut is properly cut.
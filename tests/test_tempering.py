@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Licensed to the Apache Software Foundation (ASF) under one
+    or more contributor license agreements.  See the NOTICE file
+    distributed with this work for additional information
+    regarding copyright ownership.  The ASF licenses this file
+    to you under the Apache License, Version 2.0 (the
+    "License"); you may not use this file except in compliance
+    with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing,
+    software distributed under the License is distributed on an
+    "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+    KIND, either express or implied.  See the License for the
+    specific language governing permissions and limitations
+    under the License.
+
+Description: Unit test for the parallel tempering QPU
+"""
+
+import itertools
+import json
+import pytest
+import numpy as np
+from thrift.TSerialization import serialize
+from qat.comm.exceptions.ttypes import QPUException
+from qat.core import Observable, Schedule, Term
+from qat.core.spins import integer_to_spins
+from qat.simulated_annealing import ParallelTempering
+
+
+def spin_glass(n_spins, seed):
+    """
+    Generates a frustrated Ising problem with +-1 couplings, and its
+    observable
+    """
+    rng = np.random.default_rng(seed)
+    J_coupling = np.triu(rng.choice([-1., 0., 1.], size=(n_spins, n_spins)), 1)
+    J_coupling += J_coupling.T
+    h_mag = rng.choice([-1., 0., 1.], size=n_spins)
+
+    observable = Observable(n_spins)
+    for i in range(n_spins):
+        if h_mag[i]:
+            observable.add_term(Term(-h_mag[i], "Z", [i]))
+        for j in range(i + 1, n_spins):
+            if J_coupling[i, j]:
+                observable.add_term(Term(-J_coupling[i, j], "ZZ", [i, j]))
+    return J_coupling, h_mag, observable
+
+
+def test_ground_state():
+    """
+    Checks that each shot finds the ground state of a small spin glass,
+    and the reported acceptance rates
+    """
+    J_coupling, h_mag, observable = spin_glass(12, 0)
+    configurations = np.array(list(itertools.product([1, -1], repeat=12)))
+    ground_energy = np.min(-0.5 * np.einsum("ki,ij,kj->k", configurations, J_coupling,
+                                            configurations) - configurations @ h_mag)
+
+    qpu = ParallelTempering(np.geomspace(0.3, 4., 6), n_sweeps=200, swap_interval=2, seed=3)
+    job = Schedule(drive=[(1, observable)], tmax=1.).to_job(nbshots=10, aggregate_data=False)
+    result = qpu.submit(job)
+
+    assert len(result) == 10
+    for sample in result:
+        spins = integer_to_spins(sample.state.int, 12)
+        assert -0.5 * spins @ J_coupling @ spins - spins @ h_mag == ground_energy
+
+    # Moves are more often accepted at high temperature
+    flip_acceptance = np.array(json.loads(result.meta_data["flip_acceptance"]))
+    swap_acceptance = np.array(json.loads(result.meta_data["swap_acceptance"]))
+    assert len(flip_acceptance) == 6 and len(swap_acceptance) == 5
+    assert np.all(np.diff(flip_acceptance) > 0)
+    assert np.all((swap_acceptance > 0) & (swap_acceptance <= 1))
+
+    # Results can be serialized
+    serialize(result)
+
+    # Seeded results are reproducible
+    assert [sample.state.int for sample in result] == \
+        [sample.state.int for sample in qpu.submit(job)]
+
+
+def test_invalid_arguments():
+    """
+    Checks the rejected arguments and jobs
+    """
+    with pytest.raises(ValueError):
+        ParallelTempering([0., 1.], n_sweeps=10)
+    with pytest.raises(ValueError):
+        ParallelTempering([1., 2.], n_sweeps=-1)
+    with pytest.raises(ValueError):
+        ParallelTempering([1., 2.], n_sweeps=10, swap_interval=0)
+
+    qpu = ParallelTempering([1., 2.], n_sweeps=10)
+    with pytest.raises(QPUException):
+        qpu.submit(Schedule(drive=[(2, spin_glass(4, 0)[2])], tmax=1.).to_job())